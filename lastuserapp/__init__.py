@@ -2,6 +2,7 @@
 
 __version__ = '0.1'
 
+import os
 from flask import Flask, Markup
 from markdown import markdown
 
@@ -10,6 +11,7 @@ __MESSAGES = ['MESSAGE_FOOTER']
 
 # These names are unavailable for use as usernames
 RESERVED_USERNAMES = set([
+    'api',
     'app',
     'apps',
     'auth',
@@ -26,12 +28,17 @@ RESERVED_USERNAMES = set([
 
 app = Flask('lastuserapp')
 app.config.from_object('lastuserapp')
-try:
-    app.config.from_object('lastuserapp.settings')
-except ImportError:
-    import sys
-    print >> sys.stderr, "Please create a settings.py with the necessary settings. See settings-sample.py."
-    sys.exit()
+# LASTUSER_SETTINGS names a settings file to use instead of settings.py,
+# such as the one the tests use
+if os.environ.get('LASTUSER_SETTINGS'):
+    app.config.from_envvar('LASTUSER_SETTINGS')
+else:
+    try:
+        app.config.from_object('lastuserapp.settings')
+    except ImportError:
+        import sys
+        print >> sys.stderr, "Please create a settings.py with the necessary settings. See settings-sample.py."
+        sys.exit()
 
 for msg in __MESSAGES:
     app.config[msg] = Markup(markdown(app.config.get(msg, '')))
@@ -40,6 +47,7 @@ for msg in __MESSAGES:
 import lastuserapp.assets
 import lastuserapp.mailclient
 import lastuserapp.models
+import lastuserapp.instrument
 import lastuserapp.forms
 import lastuserapp.views
 import lastuserapp.loghandler
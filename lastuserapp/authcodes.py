@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+Short-lived OAuth authorization codes. Codes are kept in the database or,
+since they only live for a minute, in a cache where they never touch the
+database. Either way a code can be exchanged for a token only once.
+"""
+
+from datetime import datetime, timedelta
+
+from lastuserapp import app
+from lastuserapp.cache import LRUCache
+from lastuserapp.models import db, AuthCode, _shared_cache
+from lastuserapp.utils import newsecret
+from lastuserapp.worker import QueueWorker
+
+
+class AuthCodeStore(object):
+    """
+    Base class for auth code stores. Codes are returned from consume() as a
+    dictionary of user_id, client_id, scope (a list) and redirect_uri.
+
+    :param ttl: Seconds a code remains valid
+    """
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+
+    def create(self, user, client, scope, redirect_uri):
+        """
+        Make an auth code and return it. The caller must commit.
+        """
+        raise NotImplementedError
+
+    def consume(self, code, client):
+        """
+        Return the details of this code if it is valid for this client, or None
+        if it is unknown, expired or has already been used. A code can be
+        consumed only once, even by concurrent requests.
+        """
+        raise NotImplementedError
+
+    def sweep(self):
+        """
+        Remove expired and used codes. Returns the number of codes removed.
+        """
+        return 0
+
+
+class SQLAuthCodeStore(AuthCodeStore):
+    """
+    Keeps auth codes in the authcode table. Codes are marked as used with
+    a conditional UPDATE, so only one request can consume a code. The
+    UPDATE is committed on a connection of its own, leaving the request's
+    session alone. Expired and used codes are removed by sweep().
+
+    :param batchsize: Codes to delete per statement when sweeping
+    """
+    def __init__(self, ttl=60, batchsize=1000):
+        super(SQLAuthCodeStore, self).__init__(ttl)
+        self.batchsize = batchsize
+
+    def create(self, user, client, scope, redirect_uri):
+        authcode = AuthCode(user=user, client=client, scope=scope, redirect_uri=redirect_uri)
+        authcode.code = newsecret()
+        db.session.add(authcode)
+        return authcode.code
+
+    def consume(self, code, client):
+        table = AuthCode.__table__
+        valid = db.and_(table.c.code == code, table.c.client_id == client.id, table.c.used == False,
+            table.c.created_at >= datetime.utcnow() - timedelta(seconds=self.ttl))
+        # Commit at once, so the code is used up even if the token request fails
+        connection = db.engine.connect()
+        try:
+            transaction = connection.begin()
+            try:
+                rowcount = connection.execute(table.update().where(valid).values(used=True)).rowcount
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+        finally:
+            connection.close()
+        if rowcount != 1:
+            return None
+        authcode = AuthCode.query.filter_by(code=code).first()
+        return {'user_id': authcode.user_id,
+                'client_id': authcode.client_id,
+                'scope': authcode.scope,
+                'redirect_uri': authcode.redirect_uri}
+
+    def sweep(self):
+        table = AuthCode.__table__
+        expired = db.or_(table.c.used == True,
+            table.c.created_at < datetime.utcnow() - timedelta(seconds=self.ttl))
+        count = 0
+        while True:
+            ids = [row[0] for row in db.session.execute(
+                db.select([table.c.id]).where(expired).limit(self.batchsize))]
+            if ids:
+                db.session.execute(table.delete().where(table.c.id.in_(ids)))
+            db.session.commit()
+            count += len(ids)
+            if len(ids) < self.batchsize:
+                return count
+
+
+class CacheAuthCodeStore(AuthCodeStore):
+    """
+    Keeps auth codes in a cache, which expires them. The cache must support
+    an atomic pop(), like LRUCache in a single process or SharedCache across
+    processes. A code presented by the wrong client is discarded.
+    """
+    def __init__(self, cache, ttl=60):
+        super(CacheAuthCodeStore, self).__init__(ttl)
+        self.cache = cache
+
+    def create(self, user, client, scope, redirect_uri):
+        code = newsecret()
+        self.cache.set(code, {'user_id': user.id,
+                              'client_id': client.id,
+                              'scope': list(scope),
+                              'redirect_uri': redirect_uri}, self.ttl)
+        return code
+
+    def consume(self, code, client):
+        authcode = self.cache.pop(code)
+        if authcode is None or authcode['client_id'] != client.id:
+            return None
+        return authcode
+
+
+class AuthCodeSweeper(QueueWorker):
+    """
+    Periodically removes expired and used codes from an auth code store.
+    """
+    def __init__(self, store, interval=300, name='AuthCodeSweeper'):
+        super(AuthCodeSweeper, self).__init__(interval=interval, name=name)
+        self.store = store
+
+    def process(self):
+        self.store.sweep()
+        # Always wait for the next interval
+        return 0
+
+
+def get_authcode_store():
+    """
+    Return the store configured in AUTH_CODE_STORE: 'sql', 'memory' for a
+    store in this process only, or 'cache' for a store on CACHE_SERVERS.
+    """
+    name = app.config.get('AUTH_CODE_STORE', 'sql')
+    ttl = app.config.get('AUTH_CODE_TTL', 60)
+    if name == 'sql':
+        return SQLAuthCodeStore(ttl=ttl)
+    elif name == 'memory':
+        return CacheAuthCodeStore(LRUCache(maxsize=app.config.get('AUTH_CODE_CACHE_SIZE', 10000)), ttl=ttl)
+    elif name == 'cache':
+        cache = _shared_cache('lastuser:authcode:', ttl)
+        if cache is None:
+            raise ValueError("AUTH_CODE_STORE 'cache' requires CACHE_SERVERS")
+        return CacheAuthCodeStore(cache, ttl=ttl)
+    else:
+        raise ValueError("Unknown auth code store '%s'" % name)
+
+authcodes = get_authcode_store()
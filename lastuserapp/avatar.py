@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""
+Resolve avatar URLs for Twitter and GitHub ids in the background
+"""
+
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from urllib2 import urlopen
+
+from flask import json
+from sqlalchemy.exc import IntegrityError
+
+from lastuserapp import app
+from lastuserapp.cache import LRUCache
+from lastuserapp.models import db, AvatarCache
+
+
+def fetch_twitter_avatar(resolver, username):
+    return resolver.urlopen('http://api.twitter.com/1/users/profile_image/%s' % username,
+        timeout=resolver.timeout).geturl()
+
+
+def fetch_github_avatar(resolver, login):
+    ghinfo = json.loads(resolver.urlopen('https://api.github.com/users/%s' % login,
+        timeout=resolver.timeout).read())
+    return ghinfo.get('avatar_url')
+
+
+class AvatarResolver(object):
+    """
+    Resolves avatar URLs for external ids on a pool of worker threads, so
+    requests never wait on an external service. get() always returns at once
+    with the cached URL, which may be stale or None, and schedules a refresh
+    when the cached URL is missing or older than max_age. Resolved URLs are
+    saved in the AvatarCache table, in a session of the resolver's own. A
+    failed lookup keeps the URL from the last one that worked, and is tried
+    again after retry_after seconds.
+
+    For tests, replace urlopen with a fake that serves canned responses, or
+    the fetchers for each service, and call resolve() to fetch synchronously.
+
+    :param workers: Number of worker threads, or 0 to resolve in the caller's thread
+    :param timeout: Seconds to wait for an external service
+    :param max_age: Seconds after which a cached URL is refreshed
+    :param retry_after: Seconds after which a failed lookup is tried again
+    """
+    def __init__(self, workers=2, timeout=5, max_age=86400, retry_after=300, cachesize=10000):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_age = timedelta(seconds=max_age)
+        self.retry_after = timedelta(seconds=min(retry_after, max_age))
+        self.urlopen = urlopen
+        self.fetchers = {
+            'twitter': fetch_twitter_avatar,
+            'github': fetch_github_avatar,
+            }
+        self.memory = LRUCache(maxsize=cachesize)
+        # Not the request's session, so saving an avatar never commits the
+        # request's changes
+        self.session = db.create_scoped_session()
+        self._pending = set()
+        self._lock = Lock()
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    def _cached(self, service, userid):
+        entry = self.memory.get((service, userid))
+        if entry is None:
+            row = AvatarCache.query.filter_by(service=service, userid=userid).first()
+            if row is not None:
+                entry = (row.url, row.fetched_at)
+                self.memory.set((service, userid), entry)
+        return entry
+
+    def get(self, service, userid):
+        """
+        Return the avatar URL for this external id, or None if it isn't known yet.
+        """
+        if not userid or service not in self.fetchers:
+            return None
+        entry = self._cached(service, userid)
+        if entry is None or entry[1] < datetime.utcnow() - self.max_age:
+            self.refresh(service, userid)
+        if entry is not None:
+            return entry[0]
+
+    def refresh(self, service, userid):
+        """
+        Resolve the avatar URL in the background, unless already pending.
+        """
+        with self._lock:
+            if (service, userid) in self._pending:
+                return
+            self._pending.add((service, userid))
+        if self.workers:
+            # apply_async keeps exceptions for a get() nobody calls, so log them here
+            self.pool.apply_async(self._resolve_logged, (service, userid))
+        else:
+            self._resolve_logged(service, userid)
+
+    def _resolve_logged(self, service, userid):
+        try:
+            return self.resolve(service, userid)
+        except Exception:
+            app.logger.exception("Could not save avatar for %s id %s" % (service, userid))
+
+    def resolve(self, service, userid):
+        """
+        Fetch the avatar URL from the external service and cache it.
+        """
+        try:
+            fetched_at = datetime.utcnow()
+            failed = False
+            try:
+                url = self.fetchers[service](self, userid)
+            except Exception, e:
+                app.logger.info("Avatar lookup for %s id %s failed: %s" % (service, userid, e))
+                # Keep the last URL that worked. Dating the entry back makes
+                # it stale after retry_after instead of max_age
+                entry = self.memory.get((service, userid))
+                url = entry[0] if entry is not None else None
+                fetched_at = fetched_at - self.max_age + self.retry_after
+                failed = True
+            self.memory.set((service, userid), (url, fetched_at))
+            try:
+                url = self.save(service, userid, url, fetched_at, failed)
+            finally:
+                self.session.remove()
+            self.memory.set((service, userid), (url, fetched_at))
+            return url
+        finally:
+            with self._lock:
+                self._pending.discard((service, userid))
+
+    def save(self, service, userid, url, fetched_at, failed=False):
+        """
+        Save an avatar URL in AvatarCache. After a failed lookup, the saved
+        URL is kept. Returns the URL saved.
+        """
+        session = self.session()
+        # Reads from a replica may miss a row that was just saved
+        with session.using_primary():
+            for attempt in range(2):
+                row = session.query(AvatarCache).filter_by(service=service, userid=userid).first()
+                if row is None:
+                    row = AvatarCache(service=service, userid=userid)
+                    session.add(row)
+                if not failed or row.id is None:
+                    row.url = url
+                row.fetched_at = fetched_at
+                url = row.url
+                try:
+                    session.commit()
+                    return url
+                except IntegrityError:
+                    # Another process saved this avatar first. Update its row instead
+                    session.rollback()
+                    if attempt:
+                        raise
+
+avatars = AvatarResolver(workers=app.config.get('AVATAR_RESOLVER_WORKERS', 2),
+    timeout=app.config.get('AVATAR_RESOLVER_TIMEOUT', 5),
+    max_age=app.config.get('AVATAR_MAX_AGE', 86400),
+    retry_after=app.config.get('AVATAR_RETRY_AFTER', 300))
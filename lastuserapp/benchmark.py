@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load test for the login and OAuth flows. Seeds a database with benchmark
+users, clients, resources and actions, then runs concurrent sessions
+through the app in-process. Each session logs in, views the profile,
+gets an auth code from /auth, exchanges it at /token, and gets a second
+token with the password grant. Reports throughput, p50/p99 latency and
+SQL queries per request for each step. Run with
+`python manage.py benchmark`.
+
+Results can be saved as a baseline and later runs compared against it,
+to catch regressions in views or models.
+"""
+
+import math
+import random
+import threading
+import urlparse
+from time import time
+
+from flask import json
+
+from lastuserapp import app
+from lastuserapp.models import db, User, Client, Resource, ResourceAction
+from lastuserapp.models.querycount import QueryCounter
+from lastuserapp.passwords import hash_password
+
+__all__ = ['seed', 'run', 'summarize', 'compare', 'load', 'save', 'STEPS']
+
+#: Password of all benchmark users
+PASSWORD = u'benchmark'
+
+#: Steps in each session, in order
+STEPS = ['login', 'profile', 'auth', 'token', 'password']
+
+
+def seed(users=1000, clients=10, resources=2, actions=2, seed=0):
+    """
+    Add benchmark users, clients, resources and actions that don't exist
+    yet. Users are named bench0, bench1...; clients have the titles
+    Benchmark 0, Benchmark 1... Everything made from the same seed is the
+    same, except for keys and secrets. Returns the benchmark clients as a
+    list of (key, secret, redirect_uri, resource name).
+    """
+    rng = random.Random(seed)
+    # Hash the password once; PBKDF2 for each user would dominate seeding
+    pw_hash = hash_password(PASSWORD)
+    existing = set(name for (name,) in db.session.query(User.username).filter(User.username.like(u'bench%')))
+    for index in range(users):
+        username = u'bench%d' % index
+        if username not in existing:
+            db.session.add(User(username=username, fullname=u'Benchmark User %d' % rng.randint(0, 10 ** 6),
+                pw_hash=pw_hash))
+    db.session.commit()
+    owner = User.query.filter_by(username=u'bench0').first()
+    result = []
+    for index in range(clients):
+        title = u'Benchmark %d' % index
+        client = Client.query.filter_by(title=title).first()
+        if client is None:
+            client = Client(user=owner, title=title, owner=owner.fullname,
+                website=u'http://client%d.example.com/' % index,
+                redirect_uri=u'http://client%d.example.com/callback' % index,
+                trusted=True, allow_any_login=True)
+            db.session.add(client)
+            for rindex in range(resources):
+                resource = Resource(client=client, name=u'bench%d-%d' % (index, rindex),
+                    title=u'Benchmark resource %d-%d' % (index, rindex))
+                db.session.add(resource)
+                for aindex, name in enumerate(['read', 'write', 'delete', 'admin'][:actions]):
+                    db.session.add(ResourceAction(resource=resource, name=name,
+                        title=u'%s %d' % (name.title(), aindex)))
+        db.session.commit()
+        result.append((client.key, client.secret, client.redirect_uri,
+            client.resources[0].name if client.resources else None))
+    return result
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(len(values) * percent / 100.0)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def auth_code(response):
+    """
+    Return the code in the redirect from /auth, or None.
+    """
+    code = urlparse.parse_qs(urlparse.urlsplit(response.headers.get('Location', '')).query).get('code')
+    return code[0] if code else None
+
+
+class Session(object):
+    """
+    One simulated user going through the login and OAuth flows.
+    """
+    def __init__(self, recorder, username, client):
+        self.recorder = recorder
+        self.username = username
+        self.key, self.secret, self.redirect_uri, resource = client
+        self.scope = u'id email' + (u' %s/read' % resource if resource else u'')
+        self.http = app.test_client()
+
+    def request(self, step, expected, method, path, check=None, **kwargs):
+        """
+        Make a request and record it. It is an error if the response doesn't
+        have the expected status, or if check(response) is false.
+        """
+        started = time()
+        with QueryCounter(keep_statements=False) as counter:
+            response = self.http.open(path, method=method, **kwargs)
+        ok = response.status_code == expected and (check is None or bool(check(response)))
+        self.recorder.record(step, time() - started, counter.count, ok)
+        return response
+
+    def run(self):
+        self.request('login', 303, 'POST', '/login', data={
+            'form.id': 'login', 'username': self.username, 'password': PASSWORD})
+        self.request('profile', 200, 'GET', '/profile')
+        # A redirect back to the client with an error instead of a code is
+        # still a 302
+        response = self.request('auth', 302, 'GET', '/auth', check=auth_code, query_string={
+            'client_id': self.key, 'response_type': 'code', 'redirect_uri': self.redirect_uri,
+            'scope': self.scope})
+        code = auth_code(response)
+        if code:
+            self.request('token', 200, 'POST', '/token', data={
+                'grant_type': 'authorization_code', 'client_id': self.key, 'client_secret': self.secret,
+                'code': code, 'redirect_uri': self.redirect_uri, 'scope': self.scope})
+        else:
+            # With no code to exchange, the token step fails too
+            self.recorder.error('token')
+        self.request('password', 200, 'POST', '/token', data={
+            'grant_type': 'password', 'client_id': self.key, 'client_secret': self.secret,
+            'username': self.username, 'password': PASSWORD, 'scope': self.scope})
+
+
+class Recorder(object):
+    """
+    Collects latencies, query counts and errors by step, from many threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = dict((step, []) for step in STEPS)
+        self.queries = dict((step, 0) for step in STEPS)
+        self.errors = dict((step, 0) for step in STEPS)
+
+    def record(self, step, latency, queries, ok):
+        with self._lock:
+            self.latencies[step].append(latency)
+            self.queries[step] += queries
+            if not ok:
+                self.errors[step] += 1
+
+    def error(self, step):
+        """
+        Count an error for a step that couldn't be run.
+        """
+        with self._lock:
+            self.errors[step] += 1
+
+
+def run(clients, users=1000, concurrency=4, sessions=100, seed=0):
+    """
+    Run sessions through the app from concurrency threads. Each session is
+    for a random benchmark user and client. Returns the results as from
+    summarize().
+    """
+    rng = random.Random(seed)
+    plan = [(u'bench%d' % rng.randrange(users), rng.choice(clients)) for i in range(sessions)]
+    recorder = Recorder()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not plan:
+                    return
+                username, client = plan.pop()
+            try:
+                Session(recorder, username, client).run()
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    started = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(recorder, time() - started)
+
+
+def summarize(recorder, duration):
+    """
+    Return a dictionary of step: {requests, errors, throughput (requests/sec),
+    p50 and p99 (milliseconds), queries (per request)}.
+    """
+    results = {}
+    for step in STEPS:
+        latencies = sorted(recorder.latencies[step])
+        count = len(latencies)
+        results[step] = {
+            'requests': count,
+            'errors': recorder.errors[step],
+            'throughput': round(count / duration, 1) if duration else 0,
+            'p50': round(percentile(latencies, 50) * 1000, 2) if count else None,
+            'p99': round(percentile(latencies, 99) * 1000, 2) if count else None,
+            'queries': round(float(recorder.queries[step]) / count, 2) if count else None,
+            }
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare results with a baseline. Returns a list of regressions: steps
+    with more queries per request, more errors, or with p99 latency or
+    throughput worse by more than tolerance (a fraction).
+    """
+    regressions = []
+    for step in STEPS:
+        now, then = results.get(step), baseline.get(step)
+        if not now or not then:
+            continue
+        # Errors count even for steps that were never run
+        if now['errors'] > then['errors']:
+            regressions.append("%s: %d errors, was %d" % (step, now['errors'], then['errors']))
+        if not now['requests'] or not then['requests']:
+            continue
+        if now['queries'] > then['queries']:
+            regressions.append("%s: %.2f queries per request, was %.2f" % (step, now['queries'], then['queries']))
+        if now['p99'] > then['p99'] * (1 + tolerance):
+            regressions.append("%s: p99 %.1f ms, was %.1f ms" % (step, now['p99'], then['p99']))
+        if now['throughput'] < then['throughput'] / (1 + tolerance):
+            regressions.append("%s: %.1f requests/sec, was %.1f" % (step, now['throughput'], then['throughput']))
+    return regressions
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save(filename, results):
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process caches for data that is read far more often than it is written
+"""
+
+from collections import OrderedDict
+from threading import RLock
+from time import time
+
+from flask import json
+
+__all__ = ['LRUCache', 'SharedCache', 'TieredCache']
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping with least-recently-used eviction and an optional
+    time-to-live for entries. Tracks hits and misses so that cache efficiency
+    can be reported.
+
+    :param maxsize: Maximum number of entries to hold
+    :param ttl: Seconds an entry remains valid, or None for no expiry
+    """
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = RLock()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for key, or default if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time():
+                    # Reinsert to mark as most recently used
+                    self._data[key] = entry
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache value under key. The ttl parameter overrides the cache default.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = time() + ttl if ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Remove key from the cache. Returns True if it was present.
+        """
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def pop(self, key, default=None):
+        """
+        Remove key from the cache and return its value, or default if it is
+        missing or expired. Only one caller can pop a given entry.
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time():
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Return a dictionary of cache statistics.
+        """
+        return {'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class SharedCache(object):
+    """
+    Adapter for a cache shared between processes. The client may be any
+    object with memcached-style get(key), set(key, value, ttl) and delete(key)
+    methods, such as python-memcached, redis-py or an LRUCache standing in
+    for either in tests. Values are stored as JSON.
+
+    :param client: Cache client
+    :param prefix: Prefix for all keys, to share a server between caches
+    :param ttl: Seconds an entry remains valid
+    """
+    def __init__(self, client, prefix='', ttl=None):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return default
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.client.set(self.prefix + key, json.dumps(value), ttl or 0)
+
+    def delete(self, key):
+        return self.client.delete(self.prefix + key)
+
+    def pop(self, key, default=None):
+        """
+        Remove key from the cache and return its value, or default if it is
+        missing. Only one caller can pop a given entry: callers race to add
+        a marker key, which the cache server only allows once. Requires a
+        client with memcached-style add(key, value, ttl).
+        """
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return default
+        if not self.client.add(self.prefix + key + ':popped', '1', self.ttl or 0):
+            return default
+        self.client.delete(self.prefix + key)
+        return json.loads(value)
+
+
+class TieredCache(object):
+    """
+    A local LRUCache in front of an optional SharedCache. Reads are served
+    from the local cache where possible. Writes and deletes go to both, so
+    deleting an entry evicts it from the shared cache immediately; other
+    processes may serve their local copy until its ttl expires.
+    """
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key, default=None):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        if value is None:
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        # The local copy never outlives the shared one
+        local_ttl = self.local.ttl
+        if ttl and (not local_ttl or ttl < local_ttl):
+            local_ttl = ttl
+        self.local.set(key, value, local_ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        return self.local.stats()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic data at production scale, for benchmarks, query plan checks and
+migration tests. Generates clients, and users with email addresses,
+external ids, access tokens and client permissions, using bulk inserts
+that bypass the ORM. The login name index (UserIdentifier) is filled in
+alongside, as the ORM's mapper events don't run for bulk inserts.
+
+The same seed generates the same rows. Timestamps are relative to the time
+of the run. Primary keys follow on from the rows already in each table,
+so runs with different seeds can add to the same database; the same seed
+twice would break unique constraints. Run with
+`python manage.py generate`.
+"""
+
+import random
+from base64 import urlsafe_b64encode
+from datetime import datetime, timedelta
+from hashlib import md5
+from time import time
+
+from lastuserapp.models import (db, User, UserEmail, UserExternalId, UserIdentifier, IDENTIFIER_KIND,
+    normalize_identifier, Client, AuthToken, UserClientPermissions)
+from lastuserapp.passwords import hash_password
+
+__all__ = ['DataGenerator']
+
+FIRST_NAMES = [u'Aarti', u'Abhishek', u'Anand', u'Anjali', u'Arjun', u'Deepa', u'Divya', u'Farhan',
+    u'Gaurav', u'Jaya', u'Kiran', u'Lakshmi', u'Meera', u'Mohan', u'Nikhil', u'Priya', u'Rahul',
+    u'Ravi', u'Sanjay', u'Shreya', u'Sunil', u'Tara', u'Vikram', u'Zoya']
+
+LAST_NAMES = [u'Bhat', u'Chopra', u'Das', u'Fernandes', u'Gupta', u'Iyer', u'Joshi', u'Kapoor',
+    u'Khan', u'Menon', u'Nair', u'Patel', u'Rao', u'Reddy', u'Shah', u'Singh', u'Varma']
+
+PERMISSIONS = [u'read', u'write', u'admin', u'moderate', u'billing']
+
+# Tables in the order rows must be inserted, for foreign keys
+TABLES = [User.__table__, Client.__table__, UserEmail.__table__, UserExternalId.__table__,
+    UserIdentifier.__table__, AuthToken.__table__, UserClientPermissions.__table__]
+
+
+class DataGenerator(object):
+    """
+    Generates rows and inserts them in batches.
+
+    :param engine: The database engine
+    :param seed: Random seed
+    :param batchsize: Rows per table to insert per statement
+    :param password: Password of all generated users
+    :param log: Function to log progress with
+    """
+    def __init__(self, engine=None, seed=0, batchsize=10000, password=u'password', log=None):
+        self.engine = engine or db.engine
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.batchsize = batchsize
+        self.log = log or (lambda message: None)
+        self.now = datetime.utcnow().replace(microsecond=0)
+        # Hashing is by far the slowest part of making a user, and every user
+        # has the same password, so hash it once
+        self.pw_hash = hash_password(password)
+        self.pending = dict((table, []) for table in TABLES)
+        self.next_ids = {}
+        self.counts = dict((table.name, 0) for table in TABLES)
+
+    def randid(self):
+        """
+        Return a random 22 character id, like utils.newid().
+        """
+        return urlsafe_b64encode(('%032x' % self.rng.getrandbits(128)).decode('hex')).rstrip('=')
+
+    def next_id(self, table):
+        """
+        Return the next primary key for a table.
+        """
+        if table not in self.next_ids:
+            self.next_ids[table] = (self.engine.execute(db.select([db.func.max(table.c.id)])).scalar() or 0) + 1
+        value = self.next_ids[table]
+        self.next_ids[table] += 1
+        return value
+
+    def add(self, table, row):
+        self.pending[table].append(row)
+        if len(self.pending[table]) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        """
+        Insert pending rows, in foreign key order.
+        """
+        connection = self.engine.connect()
+        transaction = connection.begin()
+        try:
+            for table in TABLES:
+                rows = self.pending[table]
+                if rows:
+                    connection.execute(table.insert(), rows)
+                    self.counts[table.name] += len(rows)
+                    self.pending[table] = []
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def finish(self):
+        """
+        Insert pending rows and move PostgreSQL's id sequences past the ids
+        used. Returns the number of rows inserted by table name.
+        """
+        self.flush()
+        if self.engine.dialect.name == 'postgresql':
+            for table in self.next_ids:
+                name = self.engine.dialect.identifier_preparer.quote_identifier(table.name)
+                self.engine.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                    "(SELECT MAX(id) FROM %s))" % (name, name))
+        return self.counts
+
+    def timestamp(self, days=365):
+        """
+        Return a random time in the past number of days.
+        """
+        return self.now - timedelta(seconds=self.rng.randrange(days * 86400))
+
+    def identifier(self, kind, name, user_id, source_id):
+        self.add(UserIdentifier.__table__, dict(id=self.next_id(UserIdentifier.__table__),
+            identifier=normalize_identifier(name), user_id=user_id, kind=kind, source_id=source_id,
+            verified=kind != IDENTIFIER_KIND.EMAIL_CLAIM, created_at=self.now, updated_at=self.now))
+
+    def clients(self, count, owners):
+        """
+        Generate clients owned by users with these ids. Returns the new
+        clients' ids.
+        """
+        table = Client.__table__
+        ids = []
+        for index in range(count):
+            id = self.next_id(table)
+            created = self.timestamp()
+            self.add(table, dict(id=id, user_id=self.rng.choice(owners), created_at=created, updated_at=created,
+                title=u'Generated app %d-%d' % (self.seed, index), description=u'', owner=u'Generated',
+                website=u'http://app%d-%d.example.com/' % (self.seed, index),
+                redirect_uri=u'http://app%d-%d.example.com/login/callback' % (self.seed, index),
+                notification_uri=None, resource_uri=None, active=True, allow_any_login=True,
+                key=self.randid(), secret=self.randid() + self.randid(), trusted=self.rng.random() < 0.1))
+            ids.append(id)
+        return ids
+
+    def user(self, index, client_ids, emails=1, externalids=0.3, tokens=0, permissions=0):
+        """
+        Generate a user and their rows in other tables. Fractions of emails,
+        external ids, tokens and permissions are chances of one more. Returns
+        the user's id.
+        """
+        rng = self.rng
+        table = User.__table__
+        user_id = self.next_id(table)
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        username = u'%s-%d-%d' % (first.lower(), self.seed, index)
+        created = self.timestamp()
+        self.add(table, dict(id=user_id, userid=self.randid(), fullname=u'%s %s' % (first, last),
+            username=username, pw_hash=self.pw_hash, description=u'', created_at=created, updated_at=created))
+        self.identifier(IDENTIFIER_KIND.USERNAME, username, user_id, user_id)
+
+        for number in range(_count(rng, emails)):
+            email = u'%s.%s.%d.%d.%d@example.com' % (first.lower(), last.lower(), self.seed, index, number)
+            email_id = self.next_id(UserEmail.__table__)
+            self.add(UserEmail.__table__, dict(id=email_id, user_id=user_id, email=email,
+                md5sum=md5(email).hexdigest(), primary=number == 0, created_at=created, updated_at=created))
+            self.identifier(IDENTIFIER_KIND.EMAIL, email, user_id, email_id)
+
+        for number in range(_count(rng, externalids)):
+            service = rng.choice(['twitter', 'github'])
+            extname = u'%s%s%d%d%d' % (first.lower(), last.lower(), self.seed, index, number)
+            external_id = self.next_id(UserExternalId.__table__)
+            self.add(UserExternalId.__table__, dict(id=external_id, user_id=user_id, service=service,
+                userid='%d-%d-%d' % (self.seed, index, number), username=extname,
+                oauth_token=self.randid(), oauth_token_secret=self.randid(), oauth_token_type=None,
+                created_at=created, updated_at=created))
+            if service == 'twitter':
+                self.identifier(IDENTIFIER_KIND.TWITTER, u'@' + extname, user_id, external_id)
+
+        # One token and one set of permissions per user and client
+        token_count = min(_count(rng, tokens), len(client_ids))
+        permission_count = min(_count(rng, permissions), len(client_ids))
+        clients = rng.sample(client_ids, max(token_count, permission_count))
+        for client_id in clients[:token_count]:
+            issued = self.timestamp(days=30)
+            self.add(AuthToken.__table__, dict(id=self.next_id(AuthToken.__table__), user_id=user_id,
+                client_id=client_id, token=self.randid(), token_type='bearer',
+                secret=self.randid() + self.randid(), algorithm=None, scope=u'id email', validity=0,
+                refresh_token=self.randid(), expires_at=issued + timedelta(hours=1),
+                refresh_expires_at=issued + timedelta(days=30), created_at=issued, updated_at=issued))
+        for client_id in clients[:permission_count]:
+            self.add(UserClientPermissions.__table__, dict(id=self.next_id(UserClientPermissions.__table__),
+                user_id=user_id, client_id=client_id,
+                permissions=u' '.join(rng.sample(PERMISSIONS, rng.randint(1, 3))),
+                created_at=created, updated_at=created))
+        return user_id
+
+    def generate(self, users=1000, clients=100, emails=1, externalids=0.3, tokens=2, permissions=1):
+        """
+        Generate users and clients. Clients are owned by the first generated
+        users, who have no tokens or permissions. Returns the number of rows
+        inserted by table name.
+        """
+        started = time()
+        # Owners come first, without tokens or permissions, as there are no
+        # clients yet
+        owner_count = max(min(users, clients), 1) if clients else 0
+        owners = [self.user(index, [], emails, externalids) for index in range(owner_count)]
+        client_ids = self.clients(clients, owners)
+        for index in range(owner_count, max(users, owner_count)):
+            self.user(index, client_ids, emails, externalids, tokens, permissions)
+            if index and index % 100000 == 0:
+                self.log("%d users in %d seconds" % (index, time() - started))
+        counts = self.finish()
+        self.log("%d users in %d seconds" % (users, time() - started))
+        return counts
+
+
+def _count(rng, mean):
+    """
+    Return a whole number whose average over many calls is mean.
+    """
+    whole = int(mean)
+    return whole + (1 if rng.random() < mean - whole else 0)
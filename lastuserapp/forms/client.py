@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import re
+
 from flask import g
 import flaskext.wtf as wtf
 
@@ -95,6 +97,22 @@ class UserPermissionEditForm(wtf.Form):
     perms = wtf.SelectMultipleField("Permissions", validators=[wtf.Required()])
 
 
+class UserPermissionBulkForm(wtf.Form):
+    """
+    Grant or revoke a permission for many users at once
+    """
+    users = wtf.TextAreaField("Users", validators=[wtf.Required()],
+        description="Usernames, email addresses or userids, separated by spaces, commas or new lines")
+    perm = wtf.SelectField("Permission", validators=[wtf.Required()])
+    action = wtf.RadioField("Action", choices=[('grant', "Grant"), ('revoke', "Revoke")], default='grant',
+        validators=[wtf.Required()])
+
+    def validate_users(self, field):
+        self.names = [name for name in re.split(r'[\s,]+', field.data) if name]
+        if not self.names:
+            raise wtf.ValidationError, "No users given"
+
+
 class ResourceForm(wtf.Form):
     """
     Edit a resource provided by an application
@@ -4,7 +4,7 @@ from flask import Markup, url_for
 import flaskext.wtf as wtf
 
 from lastuserapp import RESERVED_USERNAMES
-from lastuserapp.models import User, UserEmail, getuser
+from lastuserapp.models import UserEmail, getuser
 from lastuserapp.utils import valid_username
 
 
@@ -45,7 +45,7 @@ class RegisterForm(wtf.Form):
             raise wtf.ValidationError, "That name is reserved"
         if not valid_username(field.data):
             raise wtf.ValidationError, u"Invalid characters in name. Names must be made of ‘a-z’, ‘0-9’ and ‘-’, without trailing dashes"
-        existing = User.query.filter_by(username=field.data).first()
+        existing = getuser(field.data)
         if existing is not None:
             raise wtf.ValidationError, "That username is taken"
 
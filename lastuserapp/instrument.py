@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+Request instrumentation. For each request, records the number of SQL
+queries and their time, and the time spent in outbound HTTP calls,
+template rendering and sending mail. These are sent to the browser in a
+Server-Timing header, logged for requests slower than
+SLOW_REQUEST_THRESHOLD seconds, and aggregated into per-endpoint
+histograms for the /admin/metrics page.
+
+Code that calls out to other services wraps the call in timed()::
+
+    with timed('http'):
+        info = json.loads(urlopen(url).read())
+
+Histograms are kept in memory, so each server process reports its own.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+
+from flask import g, request, json, _request_ctx_stack
+from jinja2 import Template
+
+from lastuserapp import app
+from lastuserapp.models.querycount import QueryCounter
+
+__all__ = ['timed', 'Histogram', 'RequestMetrics', 'metrics']
+
+#: Timings recorded for each request, with their Server-Timing descriptions
+TIMINGS = [
+    ('db', u"Database"),
+    ('http', u"Outbound HTTP"),
+    ('tpl', u"Templates"),
+    ('mail', u"Mail"),
+    ]
+
+
+@contextmanager
+def timed(name):
+    """
+    Add the time taken by the enclosed block to the current request's timing
+    of this name. Does nothing outside a request.
+    """
+    timings = getattr(g, '_timings', None) if _request_ctx_stack.top is not None else None
+    if timings is None:
+        yield
+        return
+    started = time()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time() - started
+
+
+class TimedTemplate(Template):
+    """
+    Jinja template that times rendering, including templates it includes.
+    """
+    def render(self, *args, **kwargs):
+        with timed('tpl'):
+            return super(TimedTemplate, self).render(*args, **kwargs)
+
+
+class Histogram(object):
+    """
+    Counts of observed values in buckets, with their sum.
+
+    :param buckets: Upper bounds of the buckets, in ascending order. Values
+        above the last bound are counted in an overflow bucket
+    """
+    #: Bucket bounds for durations, in milliseconds
+    DURATION_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    #: Bucket bounds for query counts
+    COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        """
+        Return the upper bound of the bucket holding this percentile, or None
+        if it is in the overflow bucket or nothing was observed.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def as_dict(self):
+        cumulative = []
+        seen = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            seen += count
+            cumulative.append((bound, seen))
+        return {'count': self.count,
+                'sum': round(self.sum, 3),
+                'buckets': cumulative,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99)}
+
+
+class RequestMetrics(object):
+    """
+    Histograms of request timings by endpoint and timing name.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, values):
+        """
+        Record a request's timings, given as a dictionary of name: value.
+        """
+        with self._lock:
+            histograms = self.endpoints.setdefault(endpoint, {})
+            for name, value in values.items():
+                histogram = histograms.get(name)
+                if histogram is None:
+                    histogram = histograms[name] = Histogram(
+                        Histogram.COUNT_BUCKETS if name == 'queries' else Histogram.DURATION_BUCKETS)
+                histogram.observe(value)
+
+    def as_dict(self):
+        with self._lock:
+            return dict((endpoint, dict((name, histogram.as_dict()) for name, histogram in histograms.items()))
+                for endpoint, histograms in self.endpoints.items())
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+
+
+metrics = RequestMetrics()
+
+
+def _server_timing(values, queries):
+    entries = []
+    for name, description in TIMINGS:
+        if name in values:
+            if name == 'db':
+                description = u"%s (%d queries)" % (description, queries)
+            entries.append(u'%s;dur=%.1f;desc="%s"' % (name, values[name], description))
+    entries.append(u'total;dur=%.1f' % values['total'])
+    return u', '.join(entries)
+
+
+@app.before_request
+def start_instrumentation():
+    if app.config.get('INSTRUMENTATION', True):
+        g._timings = {}
+        g._started = time()
+        g._queries = QueryCounter(keep_statements=False).start()
+
+
+@app.after_request
+def finish_instrumentation(response):
+    timings = getattr(g, '_timings', None)
+    if timings is None:
+        return response
+    counter = g._queries.stop()
+    g._timings = None
+    duration = time() - g._started
+    timings['db'] = counter.duration
+    # Durations in milliseconds
+    values = dict((name, value * 1000) for name, value in timings.items())
+    values['total'] = duration * 1000
+    if app.config.get('SERVER_TIMING_HEADER', True):
+        response.headers['Server-Timing'] = _server_timing(values, counter.count)
+    values['queries'] = counter.count
+    endpoint = request.endpoint or '<unmatched>'
+    metrics.record(endpoint, values)
+    threshold = app.config.get('SLOW_REQUEST_THRESHOLD', 1.0)
+    if threshold is not None and duration >= threshold:
+        record = dict((name, round(value, 1)) for name, value in values.items())
+        record.update(endpoint=endpoint, method=request.method, path=request.path,
+            status=response.status_code)
+        app.logger.warning("Slow request: %s" % json.dumps(record, sort_keys=True))
+    return response
+
+
+@app.teardown_request
+def stop_instrumentation(exc=None):
+    # after_request doesn't run when a view raises; don't leave the counter running
+    counter = getattr(g, '_queries', None)
+    if counter is not None:
+        counter.stop()
+
+
+app.jinja_env.template_class = TimedTemplate
@@ -1,12 +1,103 @@
 # -*- coding: utf-8 -*-
 
+"""
+Error reporting. Exceptions are logged with the local variables of the
+innermost frames, with long values cut short and secrets redacted.
+Identical errors are reported once per LOG_DEDUP_WINDOW seconds. Records
+are handed to a background thread that writes the log file and sends
+error mail, so logging never blocks a request.
+"""
+
+import atexit
+import copy
 import logging
+import logging.handlers
+import re
 import cStringIO
 import traceback
+from Queue import Queue, Full
+from itertools import islice
+from repr import Repr
+from threading import Thread, Lock
+from time import time
 
 from lastuserapp import app
 
+#: Local variables, dictionary keys and query string parameters with names
+#: matching this are not logged
+SECRET_NAMES = re.compile(r'pass(wd|word)?|secret|pw_hash|token|auth|cookie|csrf', re.I)
+
+#: Secret parameters in query strings and form bodies, such as
+#: client_secret=... in a URL. The value ends at & or whitespace or a quote
+SECRET_PARAMS = re.compile(r'([\w.\[\]-]*(?:%s)[\w.\[\]-]*=)[^&\s\'"]*' % SECRET_NAMES.pattern, re.I)
+
+REDACTED = '<redacted>'
+
+
+class RedactingRepr(Repr):
+    """
+    A Repr that leaves out the values of secret-looking keys in
+    dictionaries, including subclasses such as Werkzeug's MultiDict, and
+    in (key, value) pairs, as in lists of query parameters.
+    """
+    def repr1(self, x, level):
+        if isinstance(x, dict) and type(x) is not dict:
+            return '%s(%s)' % (type(x).__name__, self.repr_dict(dict(x), level))
+        return Repr.repr1(self, x, level)
+
+    def repr_dict(self, x, level):
+        if not x:
+            return '{}'
+        if level <= 0:
+            return '{...}'
+        pieces = []
+        for key in islice(sorted(x), self.maxdict):
+            if isinstance(key, basestring) and SECRET_NAMES.search(key):
+                value = REDACTED
+            else:
+                value = self.repr1(x[key], level - 1)
+            pieces.append('%s: %s' % (self.repr1(key, level - 1), value))
+        if len(x) > self.maxdict:
+            pieces.append('...')
+        return '{%s}' % ', '.join(pieces)
+
+    def repr_tuple(self, x, level):
+        if len(x) == 2 and isinstance(x[0], basestring) and SECRET_NAMES.search(x[0]) and level > 0:
+            return '(%s, %s)' % (self.repr1(x[0], level - 1), REDACTED)
+        return Repr.repr_tuple(self, x, level)
+
+
 class LocalVarFormatter(logging.Formatter):
+    """
+    Formats exceptions with the local variables in each frame, for the
+    innermost max_frames frames. Values are cut short at max_repr
+    characters. Values of variables that may hold secrets are left out, as
+    are secret-looking keys in dictionaries and parameters in query strings.
+
+    :param max_frames: Number of frames to show local variables for
+    :param max_repr: Maximum length of a value
+    """
+    def __init__(self, fmt=None, datefmt=None, max_frames=10, max_repr=200):
+        logging.Formatter.__init__(self, fmt, datefmt)
+        self.max_frames = max_frames
+        self.max_repr = max_repr
+        # Repr limits the size of containers and strings before building
+        # them, so large values aren't rendered in full only to be cut short
+        self.repr = RedactingRepr()
+        self.repr.maxstring = self.repr.maxother = max_repr
+        self.repr.maxlist = self.repr.maxtuple = self.repr.maxdict = self.repr.maxset = 10
+
+    def format_value(self, key, value):
+        if SECRET_NAMES.search(key):
+            return REDACTED
+        try:
+            text = SECRET_PARAMS.sub(r'\1' + REDACTED, self.repr.repr(value))
+        except:
+            return "<ERROR WHILE PRINTING VALUE>"
+        if len(text) > self.max_repr:
+            text = text[:self.max_repr] + '...'
+        return text
+
     def formatException(self, ei):
         tb = ei[2]
         while 1:
@@ -15,7 +106,7 @@ class LocalVarFormatter(logging.Formatter):
             tb = tb.tb_next
         stack = []
         f = tb.tb_frame
-        while f:
+        while f and len(stack) < self.max_frames:
             stack.append(f)
             f = f.f_back
         stack.reverse()
@@ -28,12 +119,8 @@ class LocalVarFormatter(logging.Formatter):
             print >> sio, "Frame %s in %s at line %s" % (frame.f_code.co_name,
                                                          frame.f_code.co_filename,
                                                          frame.f_lineno)
-            for key, value in frame.f_locals.items():
-                print >> sio, "\t%20s = " % key,
-                try:
-                    print >> sio, repr(value)
-                except:
-                    print >> sio, "<ERROR WHILE PRINTING VALUE>"
+            for key, value in sorted(frame.f_locals.items()):
+                print >> sio, "\t%20s = %s" % (key, self.format_value(key, value))
 
         s = sio.getvalue()
         sio.close()
@@ -41,12 +128,138 @@ class LocalVarFormatter(logging.Formatter):
             s = s[:-1]
         return s
 
-formatter = LocalVarFormatter()
+
+class DuplicateFilter(logging.Filter):
+    """
+    Lets through one of each identical exception per window seconds. An
+    exception is identical to another if it has the same type and was
+    raised through the same lines of code. The next one let through says
+    how many were left out; exceptions left out are remembered until then.
+
+    :param window: Seconds to hold back identical exceptions for
+    """
+    def __init__(self, window=300):
+        logging.Filter.__init__(self)
+        self.window = window
+        self.seen = {} # Key: [first seen at, number left out]
+        self._lock = Lock()
+
+    def key(self, exc_info):
+        return (exc_info[0], tuple((filename, lineno) for filename, lineno, name, line
+            in traceback.extract_tb(exc_info[2])))
+
+    def filter(self, record):
+        if not record.exc_info or not self.window:
+            return True
+        key = self.key(record.exc_info)
+        now = time()
+        with self._lock:
+            entry = self.seen.get(key)
+            if entry is not None and entry[0] + self.window > now:
+                entry[1] += 1
+                return False
+            self.seen[key] = [now, 0]
+            # Forget exceptions not seen in a while, unless some were left
+            # out and have yet to be reported
+            for other, (seen_at, count) in self.seen.items():
+                if seen_at + self.window <= now and not count:
+                    del self.seen[other]
+        if entry is not None and entry[1]:
+            record.msg = '%s\n(%d identical errors since the last one logged were not logged)' % (
+                record.msg, entry[1])
+        return True
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a queue for a QueueListener to handle. Never blocks: if
+    the queue is full, the record is dropped and counted. Backported from
+    Python 3's logging.handlers.
+
+    :param queue: The queue
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Format the record now, traceback and local variables included, as
+        # they may change once the request moves on. The copy keeps neither
+        # the arguments nor the traceback, so it holds no frames alive
+        msg = self.format(record)
+        record = copy.copy(record)
+        record.message = msg
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    Handles records from a queue with the given handlers, in a background
+    thread. Backported from Python 3's logging.handlers.
+
+    :param queue: The queue
+    :param handlers: Handlers for the records. Each handler's level applies
+    """
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            try:
+                self.handle(record)
+            except Exception:
+                # Handlers report their own errors; don't let one stop the thread
+                pass
+
+    def start(self):
+        self._thread = Thread(target=self._monitor, name='LogListener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Handle the records already queued, then stop.
+        """
+        if self._thread is not None:
+            self.queue.put(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
+formatter = LocalVarFormatter(max_frames=app.config.get('LOG_MAX_FRAMES', 10),
+    max_repr=app.config.get('LOG_MAX_REPR', 200))
+
+handlers = []
 
 file_handler = logging.FileHandler(app.config['LOGFILE'])
 file_handler.setFormatter(formatter)
 file_handler.setLevel(logging.WARNING)
-app.logger.addHandler(file_handler)
+handlers.append(file_handler)
 if app.config['ADMINS']:
     mail_handler = logging.handlers.SMTPHandler(app.config['MAIL_SERVER'],
         app.config['DEFAULT_MAIL_SENDER'][1],
@@ -55,4 +268,15 @@ if app.config['ADMINS']:
         credentials = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD']))
     mail_handler.setFormatter(formatter)
     mail_handler.setLevel(logging.ERROR)
-    app.logger.addHandler(mail_handler)
+    handlers.append(mail_handler)
+
+log_queue = Queue(maxsize=app.config.get('LOG_QUEUE_SIZE', 1000))
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(formatter)
+queue_handler.setLevel(logging.WARNING)
+queue_handler.addFilter(DuplicateFilter(window=app.config.get('LOG_DEDUP_WINDOW', 300)))
+app.logger.addHandler(queue_handler)
+
+log_listener = QueueListener(log_queue, *handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
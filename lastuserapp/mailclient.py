@@ -1,27 +1,236 @@
 # -*- coding: utf-8 -*-
 
+import re
+from datetime import datetime, timedelta
+from threading import Lock
+
 from markdown import markdown
-from flask import render_template
+from flask import render_template, url_for
 from flaskext.mail import Mail, Message
 from lastuserapp import app
+from lastuserapp.models import db, OutboundMail, MAIL_STATUS
+from lastuserapp.instrument import timed
+from lastuserapp.worker import QueueWorker, backoff
 
 mail = Mail(app)
 
 
+def send_message(msg):
+    """
+    Send a message. If MAIL_QUEUE is enabled, the message is saved in the
+    mail queue for a MailQueueWorker to send, and the caller must commit
+    the database session.
+    """
+    if app.config.get('MAIL_QUEUE'):
+        db.session.add(OutboundMail(subject=msg.subject,
+            recipients=u'\n'.join(msg.recipients),
+            body=msg.body,
+            html=msg.html,
+            next_attempt_at=datetime.utcnow()))
+    else:
+        with timed('mail'):
+            mail.send(msg)
+
+
+# Values of these kinds pass through markdown unchanged and need no escaping
+SAFE_SLOT_VALUE = {
+    'text': re.compile(r"^[^\W_]+(?:[ .'-]+[^\W_]+)*\.?$", re.UNICODE),
+    'url': re.compile(r'^[A-Za-z0-9_.:/~%-]+$'),
+    }
+
+SLOT_RE = re.compile(r'MAILSLOT(\w+?)ENDSLOT')
+
+
+class MailTemplate(object):
+    """
+    A markdown mail template that is rendered once, with placeholders for its
+    variables, into text and HTML skeletons. Messages are then rendered by
+    substituting values into the skeletons instead of running Jinja and
+    markdown for each message. Values that markdown might transform fall
+    back to a full render, so the output is always the same.
+
+    :param template: Name of the markdown template
+    :param slots: Dictionary of template variable: kind, where kind is 'text' or 'url'
+    """
+    def __init__(self, template, slots):
+        self.template = template
+        self.slots = slots
+        self._skeletons = None
+
+    def compile(self):
+        """
+        Render the text and HTML skeletons. Returns False if the template
+        can't be compiled, such as when markdown moves a placeholder.
+        """
+        body = render_template(self.template, **dict(
+            (name, u'MAILSLOT%sENDSLOT' % name) for name in self.slots))
+        html = markdown(body)
+        if sorted(SLOT_RE.findall(body)) != sorted(SLOT_RE.findall(html)):
+            self._skeletons = False
+        else:
+            self._skeletons = (body, html)
+        return bool(self._skeletons)
+
+    def render(self, **values):
+        """
+        Return the text and HTML parts of a message with these values.
+        """
+        if self._skeletons is None:
+            self.compile()
+        if self._skeletons:
+            values = dict((name, unicode(value)) for name, value in values.items())
+            if all(SAFE_SLOT_VALUE[kind].match(values[name]) for name, kind in self.slots.items()):
+                substitute = lambda match: values[match.group(1)]
+                return tuple(SLOT_RE.sub(substitute, skeleton) for skeleton in self._skeletons)
+        body = render_template(self.template, **values)
+        return body, markdown(body)
+
+
+email_verify_template = MailTemplate('emailverify.md', {'fullname': 'text', 'confirm_url': 'url'})
+email_reset_template = MailTemplate('emailreset.md', {'fullname': 'text', 'reset_url': 'url'})
+
+
 def send_email_verify_link(useremail):
     """
     Mail a verification link to the user.
     """
     msg = Message(subject="Confirm your email address",
         recipients=[useremail.email])
-    msg.body = render_template("emailverify.md", useremail=useremail)
-    msg.html = markdown(msg.body)
-    mail.send(msg)
+    msg.body, msg.html = email_verify_template.render(fullname=useremail.user.fullname,
+        confirm_url=url_for('confirm_email', _external=True,
+            md5sum=useremail.md5sum, secret=useremail.verification_code))
+    send_message(msg)
 
 
 def send_password_reset_link(email, user, secret):
     msg = Message(subject="Reset your password",
         recipients=[email])
-    msg.body = render_template("emailreset.md", user=user, secret=secret)
-    msg.html = markdown(msg.body)
-    mail.send(msg)
+    msg.body, msg.html = email_reset_template.render(fullname=user.fullname,
+        reset_url=url_for('reset_email', _external=True, userid=user.userid, secret=secret))
+    send_message(msg)
+
+
+class MailQueueWorker(QueueWorker):
+    """
+    Sends queued messages in batches over a single SMTP connection per batch.
+    Failed messages are retried with exponential backoff and marked as failed
+    after max_attempts. Several workers may run at once; each message is
+    claimed by one worker at a time.
+
+    :param batchsize: Maximum messages to send per SMTP connection
+    :param interval: Seconds to wait when the queue is empty
+    :param lease: Seconds before a claimed but unsent message may be claimed again
+    :param max_attempts: Attempts before a message is marked as failed
+    """
+    #: Counters for this process, shared by all workers
+    stats = {'sent': 0, 'retried': 0, 'failed': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+    _stats_lock = Lock()
+
+    def __init__(self, batchsize=50, interval=5, lease=300, max_attempts=5, name='MailQueueWorker'):
+        super(MailQueueWorker, self).__init__(interval=interval, name=name)
+        self.batchsize = batchsize
+        self.lease = timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+
+    def claim(self):
+        """
+        Claim a batch of messages that are due to be sent.
+        """
+        now = datetime.utcnow()
+        table = OutboundMail.__table__
+        due = db.and_(table.c.status.in_([MAIL_STATUS.QUEUED, MAIL_STATUS.SENDING]),
+            table.c.next_attempt_at <= now)
+        candidates = [row[0] for row in db.session.query(OutboundMail.id).filter(due).order_by(
+            OutboundMail.next_attempt_at).limit(self.batchsize)]
+        claimed = []
+        for id in candidates:
+            result = db.session.execute(table.update().where(db.and_(table.c.id == id, due)).values(
+                status=MAIL_STATUS.SENDING, next_attempt_at=now + self.lease))
+            if result.rowcount == 1:
+                claimed.append(id)
+        db.session.commit()
+        if not claimed:
+            return []
+        return OutboundMail.query.filter(OutboundMail.id.in_(claimed)).all()
+
+    def sent(self, message):
+        message.status = MAIL_STATUS.SENT
+        message.attempts += 1
+        message.sent_at = datetime.utcnow()
+        message.fail_reason = None
+        latency = message.sent_at - message.created_at
+        latency = latency.days * 86400 + latency.seconds + latency.microseconds / 1000000.0
+        with self._stats_lock:
+            self.stats['sent'] += 1
+            self.stats['latency_total'] += latency
+            self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+
+    def failed(self, message, error):
+        message.attempts += 1
+        message.fail_reason = unicode(error)[:250]
+        if message.attempts >= self.max_attempts:
+            message.status = MAIL_STATUS.FAILED
+            with self._stats_lock:
+                self.stats['failed'] += 1
+            app.logger.error("Giving up on mail %d to %s: %s" % (message.id, message.recipients, error))
+        else:
+            message.status = MAIL_STATUS.QUEUED
+            message.next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff(message.attempts))
+            with self._stats_lock:
+                self.stats['retried'] += 1
+
+    def process(self):
+        # flaskext.mail looks for the app on the request context stack, which
+        # is empty in a worker thread
+        with app.test_request_context():
+            return self.send_batch()
+
+    def send_batch(self):
+        messages = self.claim()
+        if not messages:
+            return 0
+        pending = list(messages)
+        try:
+            with mail.connect() as connection:
+                while pending:
+                    message = pending[0]
+                    try:
+                        connection.send(Message(subject=message.subject,
+                            sender=app.config['DEFAULT_MAIL_SENDER'],
+                            recipients=message.recipients.split(u'\n'),
+                            body=message.body,
+                            html=message.html))
+                    except Exception, e:
+                        self.failed(message, e)
+                    else:
+                        self.sent(message)
+                    pending.pop(0)
+        except Exception, e:
+            # Couldn't connect, or the connection broke. Retry the rest later
+            for message in pending:
+                self.failed(message, e)
+        db.session.commit()
+        return len(messages)
+
+
+def mail_queue_stats():
+    """
+    Return the queue depth, the age in seconds of the oldest queued message,
+    and this process's counters for sent, retried and failed messages and
+    the queue latency of sent messages.
+    """
+    depth, oldest = db.session.query(db.func.count(OutboundMail.id), db.func.min(OutboundMail.created_at)).filter(
+        OutboundMail.status.in_([MAIL_STATUS.QUEUED, MAIL_STATUS.SENDING])).first()
+    with MailQueueWorker._stats_lock:
+        stats = dict(MailQueueWorker.stats)
+    stats['depth'] = depth
+    if oldest is not None:
+        age = datetime.utcnow() - oldest
+        stats['oldest_age'] = age.days * 86400 + age.seconds
+    else:
+        stats['oldest_age'] = 0
+    if stats['sent']:
+        stats['latency_avg'] = stats['latency_total'] / stats['sent']
+    else:
+        stats['latency_avg'] = 0.0
+    return stats
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Management commands for LastUser. Run with --help for a list of commands.
+"""
+
+import sys
+from argparse import ArgumentParser
+from time import sleep, time
+
+from lastuserapp import app
+
+
+def run_workers(workers):
+    """
+    Start worker threads and wait until interrupted.
+    """
+    for worker in workers:
+        worker.start()
+    try:
+        while True:
+            sleep(60)
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.stop()
+
+
+def mailworker(args):
+    """
+    Send queued mail.
+    """
+    from lastuserapp.mailclient import MailQueueWorker
+    run_workers([MailQueueWorker(batchsize=args.batchsize, name='MailQueueWorker-%d' % i)
+        for i in range(args.threads)])
+
+
+def smsworker(args):
+    """
+    Send queued text messages.
+    """
+    from lastuserapp.smsclient import SMSDispatchWorker
+    run_workers([SMSDispatchWorker(batchsize=args.batchsize, name='SMSDispatchWorker-%d' % i)
+        for i in range(args.threads)])
+
+
+def passwordbench(args):
+    """
+    Measure password checks per second on one core for each PBKDF2 cost, and
+    the queue time when checking through a pool of worker processes.
+    """
+    from lastuserapp.passwords import hash_password, check_password, PasswordHasherPool
+    for iterations in args.iterations:
+        pw_hash = hash_password('password', iterations)
+        count = 0
+        started = time()
+        while time() - started < args.seconds:
+            check_password(pw_hash, 'password')
+            count += 1
+        rate = count / (time() - started)
+        line = "%8d iterations: %8.1f logins/sec/core" % (iterations, rate)
+        if args.processes:
+            from multiprocessing.pool import ThreadPool
+            pool = PasswordHasherPool(processes=args.processes)
+            # Submit a burst of twice as many checks as the pool can handle in a
+            # second, from more threads than there are processes
+            callers = ThreadPool(args.processes * 4)
+            callers.map(lambda i: pool.check_password(pw_hash, 'password'),
+                range(int(rate * args.processes * 2) or 1))
+            callers.terminate()
+            pool.pool.terminate()
+            line += ", %.1f ms mean queue time with %d processes" % (
+                pool.mean_queue_time() * 1000, args.processes)
+        print line
+
+
+def mailbench(args):
+    """
+    Measure messages rendered per second for each mail template, compiled
+    and with a full Jinja and markdown render, as for a bulk mailing to
+    many users. Every escape'th user has a name that needs a full render.
+    Exits with status 1 if the two renders differ.
+    """
+    from flask import render_template
+    from markdown import markdown
+    from lastuserapp.mailclient import email_verify_template, email_reset_template
+    values = []
+    for index in range(args.users):
+        if args.escape and index % args.escape == 0:
+            fullname = u'*User* <%d>' % index
+        else:
+            fullname = u'User %d' % index
+        values.append((fullname, u'https://lastuser.example.com/confirm/%032x/%022d' % (index, index)))
+    differs = False
+    with app.test_request_context():
+        for template in [email_verify_template, email_reset_template]:
+            names = dict((kind, name) for name, kind in template.slots.items())
+            messages = [{names['text']: fullname, names['url']: url} for fullname, url in values]
+            template.compile()
+            started = time()
+            compiled = [template.render(**message) for message in messages]
+            compiled_rate = len(messages) / (time() - started)
+            started = time()
+            full = []
+            for message in messages:
+                body = render_template(template.template, **message)
+                full.append((body, markdown(body)))
+            full_rate = len(messages) / (time() - started)
+            print "%-14s %9.1f messages/sec compiled, %9.1f full render (%.1fx)%s" % (template.template,
+                compiled_rate, full_rate, compiled_rate / full_rate,
+                '' if compiled == full else ", OUTPUT DIFFERS")
+            differs = differs or compiled != full
+    if differs:
+        sys.exit(1)
+
+
+def indexusers(args):
+    """
+    Rebuild the UserIdentifier index that getuser() uses.
+    """
+    from lastuserapp.models import db, UserIdentifier, IDENTIFIER_SOURCES, identifier_row
+    table = UserIdentifier.__table__
+    db.session.execute(table.delete())
+    for kind, model in IDENTIFIER_SOURCES.items():
+        count = 0
+        rows = []
+        for target in model.query.order_by(model.id).yield_per(args.batchsize):
+            row = identifier_row(kind, target)
+            if row is not None:
+                rows.append(row)
+            if len(rows) >= args.batchsize:
+                db.session.execute(table.insert(), rows)
+                count += len(rows)
+                rows = []
+        if rows:
+            db.session.execute(table.insert(), rows)
+            count += len(rows)
+        print "%s: %d identifiers" % (model.__name__, count)
+    db.session.commit()
+
+
+def sweepauthcodes(args):
+    """
+    Remove expired and used auth codes.
+    """
+    from lastuserapp.authcodes import authcodes
+    print "Removed %d auth codes" % authcodes.sweep()
+
+
+def sweeptokens(args):
+    """
+    Remove tokens that can no longer be used or refreshed.
+    """
+    from lastuserapp.tokens import sweep_tokens
+    print "Removed %d tokens" % sweep_tokens(args.batchsize)
+
+
+def migrate(args):
+    """
+    Apply schema migrations.
+    """
+    from lastuserapp.migrations import migrate as apply_migrations
+    def log(message):
+        print message
+    done = apply_migrations(dry_run=args.dry_run, log=log)
+    if not done:
+        print "No migrations to apply"
+
+
+def checkplans(args):
+    """
+    Report queries that scan whole tables. Exits with status 1 if any do.
+    """
+    from lastuserapp.queryplans import check_plans
+    failures = check_plans(threshold=args.rows)
+    for name, scans in failures:
+        print "%s: %s" % (name, ', '.join("full scan of %s (%d rows)" % scan for scan in scans))
+    if failures:
+        sys.exit(1)
+    print "No full table scans over %d rows" % args.rows
+
+
+def benchmark(args):
+    """
+    Load test the login and OAuth flows, and compare with a baseline.
+    Exits with status 1 if any request failed, or on a regression.
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    app.config['SQLALCHEMY_REPLICA_URIS'] = []
+    app.config['CSRF_ENABLED'] = False
+    from lastuserapp.models import db
+    from lastuserapp import benchmark as bench
+    db.create_all()
+    clients = bench.seed(users=args.users, clients=args.clients, resources=args.resources,
+        actions=args.actions, seed=args.seed)
+    results = bench.run(clients, users=args.users, concurrency=args.concurrency, sessions=args.sessions,
+        seed=args.seed)
+    print "%-10s %9s %7s %11s %9s %9s %8s" % ('step', 'requests', 'errors', 'requests/s', 'p50 ms', 'p99 ms',
+        'queries')
+    for step in bench.STEPS:
+        r = results[step]
+        print "%-10s %9d %7d %11.1f %9s %9s %8s" % (step, r['requests'], r['errors'], r['throughput'],
+            r['p50'], r['p99'], r['queries'])
+    errors = sum(results[step]['errors'] for step in bench.STEPS)
+    if errors:
+        # Failed requests skew the timings, so don't keep them as a baseline
+        print "%d requests failed" % errors
+        sys.exit(1)
+    if args.save:
+        bench.save(args.save, results)
+    if args.compare:
+        regressions = bench.compare(results, bench.load(args.compare), tolerance=args.tolerance)
+        for regression in regressions:
+            print regression
+        if regressions:
+            sys.exit(1)
+        print "No regressions against %s" % args.compare
+
+
+def generate(args):
+    """
+    Fill the database with generated users, clients, tokens and permissions.
+    """
+    if args.database:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    from lastuserapp.models import db
+    from lastuserapp.datagen import DataGenerator
+    def log(message):
+        print message
+    db.create_all()
+    generator = DataGenerator(seed=args.seed, batchsize=args.batchsize, log=log)
+    counts = generator.generate(users=args.users, clients=args.clients, emails=args.emails,
+        externalids=args.externalids, tokens=args.tokens, permissions=args.permissions)
+    for name, count in sorted(counts.items()):
+        print "%s: %d rows" % (name, count)
+
+
+parser = ArgumentParser(description="LastUser management commands")
+subparsers = parser.add_subparsers()
+
+subparser = subparsers.add_parser('mailworker', help="Send queued mail")
+subparser.add_argument('--threads', type=int, default=1, help="Number of worker threads")
+subparser.add_argument('--batchsize', type=int, default=50, help="Messages to send per SMTP connection")
+subparser.set_defaults(func=mailworker)
+
+subparser = subparsers.add_parser('smsworker', help="Send queued text messages")
+subparser.add_argument('--threads', type=int, default=1, help="Number of worker threads")
+subparser.add_argument('--batchsize', type=int, default=50, help="Messages to send per batch")
+subparser.set_defaults(func=smsworker)
+
+subparser = subparsers.add_parser('passwordbench', help="Benchmark password hashing costs")
+subparser.add_argument('iterations', type=int, nargs='*', default=[10000, 20000, 50000, 100000],
+    help="PBKDF2 iterations to measure")
+subparser.add_argument('--seconds', type=float, default=2, help="Seconds to measure each cost for")
+subparser.add_argument('--processes', type=int, default=0, help="Also measure queue time with this many processes")
+subparser.set_defaults(func=passwordbench)
+
+subparser = subparsers.add_parser('mailbench', help="Benchmark rendering mail for many users")
+subparser.add_argument('--users', type=int, default=10000, help="Messages to render for each template")
+subparser.add_argument('--escape', type=int, default=100,
+    help="Give every this many users a name that needs a full render, or 0 for none")
+subparser.set_defaults(func=mailbench)
+
+subparser = subparsers.add_parser('indexusers', help="Rebuild the index of usernames and email addresses")
+subparser.add_argument('--batchsize', type=int, default=1000, help="Rows to insert per statement")
+subparser.set_defaults(func=indexusers)
+
+subparser = subparsers.add_parser('sweepauthcodes', help="Remove expired and used auth codes")
+subparser.set_defaults(func=sweepauthcodes)
+
+subparser = subparsers.add_parser('sweeptokens', help="Remove expired tokens")
+subparser.add_argument('--batchsize', type=int, default=1000, help="Tokens to delete per statement")
+subparser.set_defaults(func=sweeptokens)
+
+subparser = subparsers.add_parser('migrate', help="Apply schema migrations")
+subparser.add_argument('--dry-run', action='store_true', help="Show the statements without running them")
+subparser.set_defaults(func=migrate)
+
+subparser = subparsers.add_parser('checkplans', help="Check query plans for full table scans")
+subparser.add_argument('--rows', type=int, default=1000, help="Report full scans over this many rows")
+subparser.set_defaults(func=checkplans)
+
+subparser = subparsers.add_parser('benchmark', help="Load test the login and OAuth flows")
+subparser.add_argument('--database', default='sqlite:////tmp/lastuser-benchmark.db',
+    help="Database to seed and run against")
+subparser.add_argument('--users', type=int, default=1000, help="Benchmark users")
+subparser.add_argument('--clients', type=int, default=10, help="Benchmark clients")
+subparser.add_argument('--resources', type=int, default=2, help="Resources per client")
+subparser.add_argument('--actions', type=int, default=2, help="Actions per resource")
+subparser.add_argument('--sessions', type=int, default=200, help="Sessions to run")
+subparser.add_argument('--concurrency', type=int, default=4, help="Sessions to run at once")
+subparser.add_argument('--seed', type=int, default=0, help="Random seed")
+subparser.add_argument('--save', help="Save the results as a baseline in this file")
+subparser.add_argument('--compare', help="Compare the results with the baseline in this file")
+subparser.add_argument('--tolerance', type=float, default=0.2,
+    help="Fraction by which latency and throughput may be worse than the baseline")
+subparser.set_defaults(func=benchmark)
+
+subparser = subparsers.add_parser('generate', help="Fill the database with generated data")
+subparser.add_argument('--database', help="Database to fill, instead of SQLALCHEMY_DATABASE_URI")
+subparser.add_argument('--users', type=int, default=1000, help="Users to generate")
+subparser.add_argument('--clients', type=int, default=100, help="Clients to generate")
+subparser.add_argument('--emails', type=float, default=1, help="Email addresses per user, on average")
+subparser.add_argument('--externalids', type=float, default=0.3, help="Twitter or GitHub ids per user, on average")
+subparser.add_argument('--tokens', type=float, default=2, help="Access tokens per user, on average")
+subparser.add_argument('--permissions', type=float, default=1, help="Client permissions per user, on average")
+subparser.add_argument('--seed', type=int, default=0, help="Random seed. Use a new seed to add to generated data")
+subparser.add_argument('--batchsize', type=int, default=10000, help="Rows to insert per statement")
+subparser.set_defaults(func=generate)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+Schema migrations for existing databases. db.create_all() makes new tables
+but doesn't change existing ones; migrations add the columns, tables and
+indexes that were introduced since. Run with `python manage.py migrate`.
+
+Each migration is a function that takes a Migrator and is applied once,
+in order. Migrations check what exists before changing anything, so they
+are safe to run on a database made by db.create_all(). Indexes are built
+with CREATE INDEX CONCURRENTLY on PostgreSQL, so tables stay writable
+while they are built.
+"""
+
+from datetime import datetime
+
+from sqlalchemy.engine.reflection import Inspector
+
+from lastuserapp.models import (db, SMSMessage, OutboundMail, AvatarCache, UserIdentifier,
+    AuthToken, RevokedToken, Client, UserClientPermissions)
+
+__all__ = ['Migrator', 'MIGRATIONS', 'migrate']
+
+
+schemamigration = db.Table('schemamigration', db.metadata,
+    db.Column('name', db.String(80), primary_key=True),
+    db.Column('applied_at', db.DateTime, nullable=False))
+
+
+class Migrator(object):
+    """
+    Helpers for migrations. In a dry run, statements are logged but not run.
+
+    :param engine: The database engine
+    :param dry_run: Log statements without running them
+    :param log: Function to log each statement with
+    """
+    def __init__(self, engine, dry_run=False, log=None):
+        self.engine = engine
+        self.dry_run = dry_run
+        self.log = log or (lambda message: None)
+
+    @property
+    def inspector(self):
+        # A fresh inspector each time, as reflection results are cached
+        return Inspector.from_engine(self.engine)
+
+    def quote(self, name):
+        return self.engine.dialect.identifier_preparer.quote_identifier(name)
+
+    def has_table(self, table):
+        return table in self.inspector.get_table_names()
+
+    def has_column(self, table, column):
+        return column in [c['name'] for c in self.inspector.get_columns(table)]
+
+    def has_index(self, table, index):
+        return index in [i['name'] for i in self.inspector.get_indexes(table)]
+
+    def execute(self, sql, online=False):
+        """
+        Run a statement. Online statements run outside a transaction, as
+        PostgreSQL requires for CREATE INDEX CONCURRENTLY.
+        """
+        self.log(sql)
+        if self.dry_run:
+            return
+        if online and self.engine.dialect.name == 'postgresql':
+            raw = self.engine.raw_connection()
+            try:
+                raw.connection.autocommit = True
+                raw.cursor().execute(sql)
+            finally:
+                raw.connection.autocommit = False
+                raw.close()
+        else:
+            self.engine.execute(sql)
+
+    def create_table(self, model):
+        """
+        Create the table for a model, with its indexes, unless it exists.
+        """
+        table = model.__table__
+        if not self.has_table(table.name):
+            self.log("Create table %s" % table.name)
+            if not self.dry_run:
+                table.create(bind=self.engine)
+
+    def add_column(self, model, name):
+        """
+        Add a column to a model's table, unless it exists. Existing rows get
+        the column's default. A NOT NULL constraint is added where the
+        database allows adding one to an existing column.
+        """
+        table = model.__table__
+        column = table.c[name]
+        if self.has_column(table.name, column.name):
+            return
+        self.execute('ALTER TABLE %s ADD COLUMN %s %s' % (self.quote(table.name), self.quote(column.name),
+            column.type.compile(dialect=self.engine.dialect)))
+        if column.default is not None and column.default.is_scalar:
+            self.log("Fill %s.%s with %r" % (table.name, column.name, column.default.arg))
+            if not self.dry_run:
+                self.engine.execute(table.update().values({column.name: column.default.arg}))
+        if not column.nullable and self.engine.dialect.name == 'postgresql':
+            self.execute('ALTER TABLE %s ALTER COLUMN %s SET NOT NULL' % (
+                self.quote(table.name), self.quote(column.name)))
+
+    def create_index(self, index):
+        """
+        Create an index, unless it exists.
+        """
+        table = index.table
+        if self.has_index(table.name, index.name):
+            return
+        self.execute('CREATE %sINDEX %s%s ON %s (%s)' % (
+            'UNIQUE ' if index.unique else '',
+            'CONCURRENTLY ' if self.engine.dialect.name == 'postgresql' else '',
+            self.quote(index.name), self.quote(table.name),
+            ', '.join(self.quote(column.name) for column in index.columns)), online=True)
+
+    def create_expression_index(self, table, name, expression):
+        """
+        Create an index on an SQL expression, unless it exists.
+        """
+        if self.has_index(table.name, name):
+            return
+        self.execute('CREATE INDEX %s%s ON %s (%s)' % (
+            'CONCURRENTLY ' if self.engine.dialect.name == 'postgresql' else '',
+            self.quote(name), self.quote(table.name), expression), online=True)
+
+    def create_indexes(self, table):
+        """
+        Create the indexes defined on a table that don't exist yet.
+        """
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            self.create_index(index)
+
+
+def m001_queues(m):
+    m.create_table(OutboundMail)
+    m.add_column(SMSMessage, 'attempts')
+    m.add_column(SMSMessage, 'next_attempt_at')
+
+
+def m002_lookups(m):
+    m.create_table(AvatarCache)
+    m.create_table(UserIdentifier)
+
+
+def m003_tokens(m):
+    m.add_column(AuthToken, 'expires_at')
+    m.add_column(AuthToken, 'refresh_expires_at')
+    m.create_table(RevokedToken)
+
+
+def m004_indexes(m):
+    for table in db.metadata.sorted_tables:
+        if m.has_table(table.name):
+            m.create_indexes(table)
+
+
+def m005_client_list(m):
+    table = Client.__table__
+    m.create_indexes(table)
+    # Indexes on lower(column) for case insensitive prefix searches.
+    # text_pattern_ops lets PostgreSQL use them for LIKE in any locale.
+    # SQLite and MySQL don't use expression indexes for LIKE
+    if m.engine.dialect.name == 'postgresql':
+        for column in ['title', 'owner', 'website']:
+            m.create_expression_index(table, 'ix_client_lower_%s' % column,
+                'lower(%s) text_pattern_ops' % m.quote(column))
+
+
+def m006_permission_list(m):
+    m.create_indexes(UserClientPermissions.__table__)
+
+
+#: Migrations, in the order they are applied. Never rename or reorder these
+MIGRATIONS = [
+    ('001_queues', m001_queues),
+    ('002_lookups', m002_lookups),
+    ('003_tokens', m003_tokens),
+    ('004_indexes', m004_indexes),
+    ('005_client_list', m005_client_list),
+    ('006_permission_list', m006_permission_list),
+    ]
+
+
+def migrate(engine=None, dry_run=False, log=None):
+    """
+    Apply migrations that haven't been applied yet. Returns their names.
+    """
+    if engine is None:
+        engine = db.engine
+    schemamigration.create(bind=engine, checkfirst=True)
+    applied = set(row[0] for row in engine.execute(db.select([schemamigration.c.name])))
+    migrator = Migrator(engine, dry_run=dry_run, log=log)
+    done = []
+    for name, migration in MIGRATIONS:
+        if name in applied:
+            continue
+        migrator.log("-- Migration %s" % name)
+        migration(migrator)
+        if not dry_run:
+            engine.execute(schemamigration.insert().values(name=name, applied_at=datetime.utcnow()))
+        done.append(name)
+    return done
@@ -1,9 +1,21 @@
 # -*- coding: utf-8 -*-
 
-from flaskext.sqlalchemy import SQLAlchemy
+import calendar
+import itertools
+import math
+from datetime import datetime, timedelta
+from time import time
+from flask import g, _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import get_history
+from lastusertokens import token_id
 from lastuserapp import app
+from lastuserapp.cache import LRUCache, SharedCache, TieredCache
 
-db = SQLAlchemy(app)
+from lastuserapp.models.routing import RoutingSQLAlchemy, use_replica
+
+db = RoutingSQLAlchemy(app)
 
 class IdMixin(object):
     id = db.Column(db.Integer, primary_key=True)
@@ -22,23 +34,244 @@ class BaseMixin(IdMixin, TimestampMixin):
 from lastuserapp.models.user import *
 from lastuserapp.models.client import *
 from lastuserapp.models.sms import *
+from lastuserapp.models.mail import *
+from lastuserapp.models.querycount import QueryCounter, assert_max_queries
 
-def getuser(name):
-    if '@' in name:
-        if name.startswith('@'):
-            extid = UserExternalId.query.filter_by(service='twitter', username=name[1:]).first()
-            if extid:
-                return extid.user
-            else:
-                return None
-        else:
-            useremail = UserEmail.query.filter_by(email=name).first()
-            if useremail:
-                return useremail.user
-            # No verified email id. Look for an unverified id; return first found
-            useremail = UserEmailClaim.query.filter_by(email=name).first()
-            if useremail:
-                return useremail.user
-            return None
+def _getuser(name):
+    # Verified ids win over claimed email addresses; among claims, the oldest
+    return User.query.join(UserIdentifier, UserIdentifier.user_id == User.id).filter(
+        UserIdentifier.identifier == normalize_identifier(name)).order_by(
+        UserIdentifier.kind, UserIdentifier.id).first()
+
+
+def _getuser_unindexed(name):
+    """
+    Look up a user the way getuser did before UserIdentifier, for databases
+    upgraded without `python manage.py indexusers`. Names are matched
+    exactly, as they were then.
+    """
+    if name.startswith('@'):
+        extid = UserExternalId.query.filter_by(service='twitter', username=name[1:]).first()
+        return extid.user if extid else None
+    elif '@' in name:
+        useremail = UserEmail.query.filter_by(email=name).first()
+        if useremail:
+            return useremail.user
+        # No verified email id. Look for an unverified id; return first found
+        useremail = UserEmailClaim.query.filter_by(email=name).first()
+        return useremail.user if useremail else None
     else:
         return User.query.filter_by(username=name).first()
+
+
+_unindexed_warned = []
+
+def _lookup_user(name):
+    user = _getuser(normalize_identifier(name))
+    if user is None and app.config.get('USER_INDEX_FALLBACK', True):
+        user = _getuser_unindexed(name.strip())
+        if user is not None and not _unindexed_warned:
+            _unindexed_warned.append(True)
+            app.logger.warning("User %s is missing from the login name index. "
+                "Run `python manage.py indexusers`" % user.userid)
+    return user
+
+
+def _getuser_memo():
+    """
+    Return this request's getuser results, or None outside a request.
+    """
+    if _request_ctx_stack.top is None:
+        return None
+    memo = getattr(g, '_getuser_memo', None)
+    if memo is None:
+        memo = g._getuser_memo = {}
+    return memo
+
+
+def getuser(name):
+    """
+    Return the user with this username, email address or @twitter id, or None.
+    Names are not case sensitive. Results, including misses, are remembered
+    for the rest of the request, so that forms and views validating the same
+    name share one lookup. With USER_INDEX_FALLBACK, names missing from the
+    index are looked up as before it existed.
+    """
+    memo = _getuser_memo()
+    if memo is None:
+        return _lookup_user(name)
+    key = normalize_identifier(name)
+    if key not in memo:
+        memo[key] = _lookup_user(name)
+    return memo[key]
+
+
+def _forget_users(session, flush_context):
+    """
+    Forget this request's getuser results when users or their ids change.
+    """
+    memo = _getuser_memo()
+    if memo:
+        for instance in itertools.chain(session.new, session.dirty, session.deleted):
+            if isinstance(instance, tuple(IDENTIFIER_SOURCES.values())):
+                memo.clear()
+                break
+
+event.listen(Session, 'after_flush', _forget_users)
+
+
+#: Registered clients, keyed by Client.key. Cached instances are detached from
+#: any session and must be merged into the current session before use. Each
+#: process has its own cache, so a client changed or deleted in one process
+#: is served by the others for up to CLIENT_CACHE_TTL seconds
+client_cache = LRUCache(maxsize=app.config.get('CLIENT_CACHE_SIZE', 1000),
+    ttl=app.config.get('CLIENT_CACHE_TTL', 5))
+
+def getclient(key):
+    """
+    Return the client with the given key, or None. Clients are served from
+    an in-process cache and only looked up in the database on a cache miss.
+    Views that modify a client must call client_cache.delete(key) after
+    committing.
+    """
+    client = client_cache.get(key)
+    if client is None:
+        client = Client.query.filter_by(key=key).first()
+        if client is None and db.session.reading_from_replica():
+            # The client may be new and not on the replica yet
+            with db.session.using_primary():
+                client = Client.query.filter_by(key=key).first()
+        if client is None:
+            return None
+        # Keep a detached copy in the cache so that commits in this session
+        # don't expire the cached attributes
+        db.session.expunge(client)
+        client_cache.set(key, client)
+    return db.session.merge(client, load=False)
+
+
+#: Index of resources and actions for scope validation
+resource_index = ResourceIndex(ttl=app.config.get('RESOURCE_INDEX_TTL', 300))
+
+
+def _shared_cache(prefix, ttl):
+    """
+    Return a SharedCache on the memcached servers in CACHE_SERVERS, or None.
+    """
+    servers = app.config.get('CACHE_SERVERS')
+    if not servers:
+        return None
+    import memcache
+    return SharedCache(memcache.Client(servers), prefix=prefix, ttl=ttl)
+
+
+#: Access tokens, keyed by AuthToken.token, for token verification. Each
+#: process holds its own copy of a token for at most TOKEN_CACHE_LOCAL_TTL
+#: seconds, so a token revoked in another process stops working that soon
+token_cache = TieredCache(
+    LRUCache(maxsize=app.config.get('TOKEN_CACHE_SIZE', 10000),
+        ttl=app.config.get('TOKEN_CACHE_LOCAL_TTL', 5)),
+    _shared_cache('lastuser:token:', app.config.get('TOKEN_CACHE_TTL', 300)))
+
+
+def gettoken(token):
+    """
+    Return a dictionary with the userid, scope, client key and client id of the
+    given access token, or None if there is no such token or it has expired.
+    Served from token_cache where possible. Expiring tokens are cached no
+    longer than they are valid.
+    """
+    info = token_cache.get(token)
+    if info is None:
+        query = db.session.query(AuthToken._scope, User.userid, Client.key, Client.id, AuthToken.expires_at).join(
+            (Client, AuthToken.client_id == Client.id)).outerjoin(
+            (User, AuthToken.user_id == User.id)).filter(AuthToken.token == token)
+        row = query.first()
+        if row is None and db.session.reading_from_replica():
+            # The token may be new and not on the replica yet
+            with db.session.using_primary():
+                row = query.first()
+        if row is None:
+            return None
+        info = {'scope': row[0].split(u' '),
+                'userid': row[1],
+                'client': row[2],
+                'client_id': row[3],
+                'expires': calendar.timegm(row[4].utctimetuple()) if row[4] else None}
+        ttl = None
+        if info['expires']:
+            ttl = info['expires'] - time()
+            if ttl <= 0:
+                return None
+            ttl = min(int(math.ceil(ttl)), app.config.get('TOKEN_CACHE_TTL', 300))
+        token_cache.set(token, info, ttl)
+    elif info.get('expires') and info['expires'] <= time():
+        return None
+    return info
+
+
+#: Version tokens for session snapshots of users, keyed by User.userid.
+#: Changing a user's version invalidates snapshots in all sessions.
+user_versions = TieredCache(
+    LRUCache(maxsize=app.config.get('USER_VERSION_CACHE_SIZE', 10000),
+        ttl=app.config.get('TOKEN_CACHE_LOCAL_TTL', 5) if app.config.get('CACHE_SERVERS') else None),
+    _shared_cache('lastuser:userversion:', 0))
+
+
+def _revoke_signed_tokens(connection, tokens):
+    """
+    Add signed tokens issued for these access tokens to the revocation list.
+    """
+    if tokens and app.config.get('TOKEN_SIGNING_KEY'):
+        # Signed tokens are valid for at most SIGNED_TOKEN_VALIDITY seconds
+        expires_at = datetime.utcnow() + timedelta(seconds=app.config.get('SIGNED_TOKEN_VALIDITY', 300))
+        connection.execute(RevokedToken.__table__.insert(), [
+            {'tokenid': token_id(token), 'expires_at': expires_at} for token in tokens])
+
+
+def _evict_on_commit(target, tokens):
+    """
+    Evict tokens from token_cache when the session's transaction ends.
+    Evicting during the flush would let a request that reads the old row
+    before the commit cache it again.
+    """
+    session = object_session(target)
+    if session is None:
+        for token in tokens:
+            token_cache.delete(token)
+        return
+    if getattr(session, '_evict_tokens', None) is None:
+        session._evict_tokens = set()
+    session._evict_tokens.update(tokens)
+
+
+def _evict_tokens(session):
+    tokens = getattr(session, '_evict_tokens', None)
+    if tokens:
+        session._evict_tokens = None
+        for token in tokens:
+            token_cache.delete(token)
+
+# Also on rollback: evicting a token that didn't change only costs a lookup
+event.listen(Session, 'after_commit', _evict_tokens)
+event.listen(Session, 'after_rollback', _evict_tokens)
+
+
+@event.listens_for(AuthToken, 'after_update')
+def _token_updated(mapper, connection, target):
+    """
+    Evict tokens from token_cache when their scope changes or they are
+    renewed. Signed tokens for the replaced token are revoked.
+    """
+    replaced = list(get_history(target, 'token').deleted or [])
+    _evict_on_commit(target, set([target.token] + replaced))
+    _revoke_signed_tokens(connection, replaced)
+
+
+@event.listens_for(AuthToken, 'after_delete')
+def _token_deleted(mapper, connection, target):
+    """
+    Evict deleted tokens from token_cache and revoke their signed tokens.
+    """
+    _evict_on_commit(target, [target.token])
+    _revoke_signed_tokens(connection, [target.token])
@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from threading import Lock
+from time import time
+
 from lastuserapp.models import db, User, BaseMixin
 from lastuserapp.utils import newid, newsecret
 
@@ -6,7 +10,7 @@ class Client(db.Model, BaseMixin):
     """OAuth client applications"""
     __tablename__ = 'client'
     #: User who owns this client
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref = db.backref('clients', cascade="all, delete-orphan"))
     #: Human-readable title
@@ -37,13 +41,18 @@ class Client(db.Model, BaseMixin):
     #: as a trusted client to provide single sign-in across the services
     trusted = db.Column(db.Boolean, nullable=False, default=False)
 
+    # For the client list, which is ordered by title and id. On PostgreSQL,
+    # searches by the start of title, owner or website use indexes on their
+    # lowercase forms, made by the 005_client_list migration
+    __table_args__ = ( db.Index('ix_client_title_id', 'title', 'id'), {} )
+
 
 class UserFlashMessage(db.Model, BaseMixin):
     """
     Saved messages for a user, to be relayed to trusted clients.
     """
     __tablename__ = 'userflashmessage'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref=db.backref("flashmessages", cascade="delete, delete-orphan"))
     seq = db.Column(db.Integer, default=0, nullable=False)
@@ -60,7 +69,7 @@ class Resource(db.Model, BaseMixin):
     __tablename__ = 'resource'
     # Resource names are unique across client apps
     name = db.Column(db.Unicode(20), unique=True, nullable=False)
-    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False, index=True)
     client = db.relationship(Client, primaryjoin=client_id == Client.id,
         backref = db.backref('resources', cascade="all, delete-orphan"))
     title = db.Column(db.Unicode(250), nullable=False)
@@ -76,7 +85,7 @@ class ResourceAction(db.Model, BaseMixin):
     """
     __tablename__ = 'resourceaction'
     name = db.Column(db.Unicode(20), nullable=False)
-    resource_id = db.Column(db.Integer, db.ForeignKey('resource.id'), nullable=False)
+    resource_id = db.Column(db.Integer, db.ForeignKey('resource.id'), nullable=False, index=True)
     resource = db.relationship(Resource, primaryjoin=resource_id == Resource.id,
         backref = db.backref('actions', cascade="all, delete-orphan"))
     title = db.Column(db.Unicode(250), nullable=False)
@@ -86,15 +95,123 @@ class ResourceAction(db.Model, BaseMixin):
     __table_args__ = ( db.UniqueConstraint("name", "resource_id"), {} )
 
 
+class ScopeError(ValueError):
+    """Raised by ResourceIndex.resolve when a scope is invalid."""
+    pass
+
+
+class IndexedResource(object):
+    """
+    Lightweight copy of a Resource and its actions, held in the ResourceIndex.
+    """
+    def __init__(self, resource):
+        self.id = resource.id
+        self.name = resource.name
+        self.title = resource.title
+        self.client_id = resource.client_id
+        self.trusted = resource.trusted
+        #: Action name: IndexedResourceAction
+        self.actions = {}
+
+
+class IndexedResourceAction(object):
+    """
+    Lightweight copy of a ResourceAction, held in the ResourceIndex.
+    """
+    def __init__(self, action):
+        self.id = action.id
+        self.name = action.name
+        self.title = action.title
+
+
+class ResourceIndex(object):
+    """
+    In-memory index of all resources and their actions, used to validate
+    scopes without querying the database. Views that change resources or
+    actions must call invalidate() after committing. The index is also
+    rebuilt after ttl seconds to pick up changes made by other processes.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._resources = None
+        self._built_at = 0
+        self._lock = Lock()
+
+    def invalidate(self):
+        self._resources = None
+
+    def _build(self):
+        resources = {}
+        for resource in Resource.query.all():
+            resources[resource.name] = IndexedResource(resource)
+        byid = dict((r.id, r) for r in resources.values())
+        for action in ResourceAction.query.all():
+            if action.resource_id in byid:
+                byid[action.resource_id].actions[action.name] = IndexedResourceAction(action)
+        return resources
+
+    @property
+    def resources(self):
+        """
+        Dictionary of resource name: IndexedResource, rebuilt as required.
+        """
+        resources = self._resources
+        if resources is None or (self.ttl and self._built_at + self.ttl < time()):
+            with self._lock:
+                resources = self._resources
+                if resources is None or (self.ttl and self._built_at + self.ttl < time()):
+                    resources = self._build()
+                    self._resources = resources
+                    self._built_at = time()
+        return resources
+
+    def resolve(self, scope, client):
+        """
+        Validate scope (a list of tokens) for the given client. Returns a
+        dictionary of IndexedResource: [IndexedResourceAction, ...] for the
+        resources in scope. Raises ScopeError with a reason if invalid.
+        """
+        index = self.resources
+        resources = {}
+        for item in scope:
+            if item in [u'id', u'email']:
+                continue
+            # Resource/action must be properly formatted
+            if '/' in item:
+                parts = item.split('/')
+                if len(parts) != 2:
+                    raise ScopeError("Too many / characters in %s in scope" % item)
+                resource_name, action_name = parts
+            else:
+                resource_name = item
+                action_name = None
+            resource = index.get(resource_name)
+            # Resource must exist
+            if resource is None:
+                raise ScopeError("Unknown resource '%s' in scope" % resource_name)
+            # Client must have access to resource
+            if resource.trusted and not client.trusted:
+                raise ScopeError("This application does not have access to resource '%s' in scope" % resource_name)
+            # If action is specified, it must exist for this resource
+            if action_name:
+                action = resource.actions.get(action_name)
+                if action is None:
+                    raise ScopeError("Unknown action '%s' on resource '%s' in scope" % (action_name, resource_name))
+                resources.setdefault(resource, []).append(action)
+            else:
+                resources.setdefault(resource, [])
+        return resources
+
+
 class AuthCode(db.Model, BaseMixin):
     """Short-lived authorization tokens."""
     __tablename__ = 'authcode'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id)
-    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False, index=True)
     client = db.relationship(Client, primaryjoin=client_id == Client.id,
         backref = db.backref("authcodes", cascade="all, delete-orphan"))
-    code = db.Column(db.String(44), default=newsecret, nullable=False)
+    code = db.Column(db.String(44), default=newsecret, nullable=False, index=True, unique=True)
     _scope = db.Column('scope', db.Unicode(250), nullable=False)
     redirect_uri = db.Column(db.Unicode(250), nullable=False)
     used = db.Column(db.Boolean, default=False, nullable=False)
@@ -120,7 +237,7 @@ class AuthToken(db.Model, BaseMixin):
     __tablename__ = 'authtoken'
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True) # Null for client-only
     user = db.relationship(User, primaryjoin=user_id == User.id)
-    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False, index=True)
     client = db.relationship(Client, primaryjoin=client_id == Client.id,
         backref=db.backref("authtokens", cascade="all, delete-orphan"))
     token = db.Column(db.String(22), default=newid, nullable=False, unique=True)
@@ -129,7 +246,10 @@ class AuthToken(db.Model, BaseMixin):
     _algorithm = db.Column('algorithm', db.String(20), nullable=True)
     _scope = db.Column('scope', db.Unicode(250), nullable=False)
     validity = db.Column(db.Integer, nullable=False, default=0) # Validity period in seconds
-    refresh_token = db.Column(db.String(22), default=newid, nullable=False)
+    refresh_token = db.Column(db.String(22), default=newid, nullable=False, index=True, unique=True)
+    # When the access token and refresh token expire. None for never
+    expires_at = db.Column(db.DateTime, nullable=True)
+    refresh_expires_at = db.Column(db.DateTime, nullable=True, index=True)
 
     # Only one authtoken per user and client. Add to scope as needed
     __table_args__ = ( db.UniqueConstraint("user_id", "client_id"), {} )
@@ -155,6 +275,34 @@ class AuthToken(db.Model, BaseMixin):
             additional = [additional]
         self.scope = list(set(self.scope).union(set(additional)))
 
+    def renew(self, validity=0, refresh_validity=0):
+        """
+        Replace the access token and refresh token with new values, valid
+        for the given number of seconds, or forever if 0. The old values stop
+        working at once.
+        """
+        now = datetime.utcnow()
+        self.token = newid()
+        self.refresh_token = newid()
+        self.validity = validity
+        self.expires_at = now + timedelta(seconds=validity) if validity else None
+        self.refresh_expires_at = now + timedelta(seconds=refresh_validity) if refresh_validity else None
+
+    def is_expired(self):
+        return self.expires_at is not None and self.expires_at <= datetime.utcnow()
+
+    def refresh_is_expired(self):
+        return self.refresh_expires_at is not None and self.refresh_expires_at <= datetime.utcnow()
+
+    def expires_in(self):
+        """
+        Seconds until the access token expires, or None if it doesn't.
+        """
+        if self.expires_at is None:
+            return None
+        delta = self.expires_at - datetime.utcnow()
+        return max(delta.days * 86400 + delta.seconds, 0)
+
     @property
     def algorithm(self):
         return self._algorithm
@@ -172,10 +320,21 @@ class AuthToken(db.Model, BaseMixin):
     algorithm = db.synonym('_algorithm', descriptor=algorithm)
 
 
+class RevokedToken(db.Model, BaseMixin):
+    """
+    Signed tokens that were revoked before they expired, for resource servers
+    to poll. The id doubles as a cursor for polling.
+    """
+    __tablename__ = 'revokedtoken'
+    tokenid = db.Column(db.String(16), nullable=False)
+    # No signed token with this id is valid after this time
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
 class Permission(db.Model, BaseMixin):
     __tablename__ = 'permission'
     #: User who created this permission
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref = db.backref('permissions_created', cascade="all, delete-orphan"))
     #: Name token
@@ -195,7 +354,7 @@ class UserClientPermissions(db.Model, BaseMixin):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship(User, primaryjoin=user_id == User.id, backref='permissions')
     # Client app they are assigned on
-    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False, index=True)
     client = db.relationship(Client, primaryjoin=client_id == Client.id,
         backref=db.backref('permissions', cascade="all, delete-orphan"))
     # The permissions as a string of tokens
@@ -205,8 +364,10 @@ class UserClientPermissions(db.Model, BaseMixin):
     # TODO: Also define context for permission:
     # a. User1 has permissions x, y (without context) in app1
     # b. User1 has permissions a, b, c in context p in app1
-    __table_args__ = ( db.UniqueConstraint("user_id", "client_id"), {} )
+    __table_args__ = ( db.UniqueConstraint("user_id", "client_id"),
+        # For the client's list of assignments, ordered by id
+        db.Index('ix_userclientpermissions_client_id_id', 'client_id', 'id'), {} )
 
 
 __all__ = ['Client', 'UserFlashMessage', 'Resource', 'ResourceAction', 'AuthCode', 'AuthToken',
-    'Permission', 'UserClientPermissions']
+    'RevokedToken', 'Permission', 'UserClientPermissions', 'ResourceIndex', 'ScopeError']
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp.models import db, BaseMixin
+
+__all__ = ['OutboundMail', 'MAIL_STATUS']
+
+class MAIL_STATUS:
+    QUEUED = 0
+    SENDING = 1
+    SENT = 2
+    FAILED = 3
+
+class OutboundMail(db.Model, BaseMixin):
+    """
+    Email messages waiting to be sent by the mail queue worker.
+    """
+    __tablename__ = 'outboundmail'
+    subject = db.Column(db.Unicode(250), nullable=False)
+    # Recipients, one per line
+    recipients = db.Column(db.UnicodeText, nullable=False)
+    body = db.Column(db.UnicodeText, nullable=False)
+    html = db.Column(db.UnicodeText, nullable=True)
+    # Flags
+    status = db.Column(db.Integer, default=MAIL_STATUS.QUEUED, nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    # When to try next. Also a lease on messages being sent, so that messages
+    # claimed by a worker that died are retried
+    next_attempt_at = db.Column(db.DateTime, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    fail_reason = db.Column(db.Unicode(250), nullable=True)
+
+    __table_args__ = ( db.Index('ix_outboundmail_status_next_attempt_at', 'status', 'next_attempt_at'), {} )
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Count the SQL statements issued by the current thread
+"""
+
+from contextlib import contextmanager
+from threading import local
+from time import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+__all__ = ['QueryCounter', 'assert_max_queries']
+
+_active = local()
+
+
+def _counters():
+    counters = getattr(_active, 'counters', None)
+    if counters is None:
+        counters = _active.counters = []
+    return counters
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_active, 'counters', None):
+        _active.started = time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    counters = getattr(_active, 'counters', None)
+    if counters:
+        duration = time() - getattr(_active, 'started', time())
+        for counter in counters:
+            counter.record(statement, duration)
+
+
+class QueryCounter(object):
+    """
+    Counts SQL statements executed by this thread on any engine while
+    active. Use as a context manager, or call start() and stop().
+    Counters may be nested.
+
+    :param keep_statements: Keep a list of the statements executed
+    """
+    def __init__(self, keep_statements=True):
+        self.keep_statements = keep_statements
+        self.count = 0
+        self.duration = 0.0
+        self.statements = []
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        if self.keep_statements:
+            self.statements.append(statement)
+
+    def start(self):
+        _counters().append(self)
+        return self
+
+    def stop(self):
+        counters = _counters()
+        if self in counters:
+            counters.remove(self)
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """
+    Raise AssertionError if the enclosed block executes more than limit
+    SQL statements. Tests use this to lock in query budgets (see
+    tests/test_queries.py)::
+
+        with assert_max_queries(2):
+            g.user.email, g.user.phones, g.user.externalids
+    """
+    with QueryCounter() as counter:
+        yield counter
+    if counter.count > limit:
+        raise AssertionError("%d queries executed, expected at most %d:\n%s" % (
+            counter.count, limit, '\n'.join(counter.statements)))
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+Connection pool settings and read replica routing.
+
+Requests marked read-only (with the read_only view decorator) read from a
+replica in SQLALCHEMY_REPLICA_URIS, the same one for the whole request. Writes always go to the primary, and
+once a request has written, its reads go to the primary too, so they see
+its writes. Other requests only use the primary.
+
+To try this locally, point SQLALCHEMY_REPLICA_URIS at a copy of the
+primary's SQLite file; requests marked read-only then read from the copy.
+"""
+
+import random
+from contextlib import contextmanager
+from functools import partial
+from threading import Lock
+
+from flask import g, _request_ctx_stack
+from sqlalchemy import create_engine, event, exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+import flaskext.sqlalchemy
+from flaskext.sqlalchemy import SQLAlchemy
+
+__all__ = ['RoutingSQLAlchemy', 'RoutingSession', 'RoutingScopedSession', 'use_replica']
+
+# Renamed to SignallingSession in later versions of Flask-SQLAlchemy
+SignallingSession = getattr(flaskext.sqlalchemy, 'SignallingSession', None) or \
+    flaskext.sqlalchemy._SignallingSession
+
+
+def use_replica():
+    """
+    Let the rest of this request read from a replica.
+    """
+    g.db_use_replica = True
+
+
+def _replica_requested():
+    return _request_ctx_stack.top is not None and getattr(g, 'db_use_replica', False)
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that reads from a replica when the request allows it and the
+    session hasn't written anything yet.
+    """
+    def __init__(self, db, *args, **kwargs):
+        self.db = db
+        self._wrote = False
+        self._force_primary = 0
+        super(RoutingSession, self).__init__(db, *args, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._wrote and not self._force_primary and not self._flushing
+                and not (self.new or self.dirty or self.deleted) and _replica_requested()):
+            replica = self.db.get_replica()
+            if replica is not None:
+                return replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def reading_from_replica(self):
+        """
+        Would a read now go to a replica?
+        """
+        return not self._wrote and not self._force_primary and _replica_requested() and \
+            bool(self.db.get_replica_uris())
+
+    @contextmanager
+    def using_primary(self):
+        """
+        Read from the primary within this block, such as to retry a lookup
+        that may have missed on a replica that is behind.
+        """
+        self._force_primary += 1
+        try:
+            yield self
+        finally:
+            self._force_primary -= 1
+
+
+class RoutingScopedSession(orm.scoped_session):
+    """
+    A scoped session that also forwards RoutingSession's own methods to the
+    current session, so they can be called on db.session.
+    """
+    def reading_from_replica(self):
+        return self.registry().reading_from_replica()
+
+    def using_primary(self):
+        return self.registry().using_primary()
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _session_wrote(session, flush_context):
+    session._wrote = True
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Check that a pooled connection is still alive before handing it out.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # The pool retries checkout with a new connection
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def _enable_pre_ping(engine):
+    if not getattr(engine, '_pre_ping', False):
+        event.listen(engine.pool, 'checkout', _ping_connection)
+        engine._pre_ping = True
+    return engine
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with pool settings for max overflow and pre-ping, and
+    a RoutingSession that can read from replicas.
+    """
+    def __init__(self, *args, **kwargs):
+        self._replicas = None
+        self._replica_lock = Lock()
+        super(RoutingSQLAlchemy, self).__init__(*args, **kwargs)
+
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        return RoutingScopedSession(partial(RoutingSession, self, **options))
+
+    def apply_pool_defaults(self, app, options):
+        super(RoutingSQLAlchemy, self).apply_pool_defaults(app, options)
+        if app.config.get('SQLALCHEMY_MAX_OVERFLOW') is not None:
+            options['max_overflow'] = app.config['SQLALCHEMY_MAX_OVERFLOW']
+
+    def apply_driver_hacks(self, app, info, options):
+        super(RoutingSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if options.get('poolclass') is NullPool:
+            # SQLite files get a NullPool, which doesn't take queue pool options
+            options.pop('max_overflow', None)
+
+    def _create_engine(self, app, uri):
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, info, options)
+        engine = create_engine(info, **options)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+            _enable_pre_ping(engine)
+        return engine
+
+    def get_replica_uris(self):
+        return self.get_app().config.get('SQLALCHEMY_REPLICA_URIS') or []
+
+    def get_replica(self):
+        """
+        Return the engine for a replica, or None if there are no replicas.
+        A replica is chosen at random once per request, so that replicas
+        lagging by different amounts can't show a row to a request and
+        then lose it.
+        """
+        if self._replicas is None:
+            with self._replica_lock:
+                if self._replicas is None:
+                    app = self.get_app()
+                    self._replicas = [self._create_engine(app, uri) for uri in self.get_replica_uris()]
+        if not self._replicas:
+            return None
+        if _request_ctx_stack.top is None:
+            return random.choice(self._replicas)
+        replica = getattr(g, 'db_replica', None)
+        if replica is None:
+            replica = g.db_replica = random.choice(self._replicas)
+        return replica
+
+    def get_engine(self, app, bind=None):
+        engine = super(RoutingSQLAlchemy, self).get_engine(app, bind)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+            _enable_pre_ping(engine)
+        return engine
@@ -10,6 +10,7 @@ class SMS_STATUS:
     DELIVERED = 2
     FAILED = 3
     UNKNOWN = 4
+    SENDING = 5
 
 class SMSMessage(db.Model, BaseMixin):
     __tablename__ = 'smsmessage'
@@ -22,3 +23,9 @@ class SMSMessage(db.Model, BaseMixin):
     status = db.Column(db.Integer, default=0, nullable=False)
     status_at = db.Column(db.DateTime, nullable=True)
     fail_reason = db.Column(db.Unicode(25), nullable=True)
+    # Dispatch attempts so far, and when to try next. For messages being
+    # sent, next_attempt_at is a lease after which another worker may retry
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = ( db.Index('ix_smsmessage_status_next_attempt_at', 'status', 'next_attempt_at'), {} )
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from hashlib import md5
-from werkzeug import generate_password_hash, check_password_hash
+from sqlalchemy import event
+from sqlalchemy.orm import class_mapper, ColumnProperty
+from sqlalchemy.orm.attributes import instance_state, set_committed_value, get_history
 
+from lastuserapp import app
 from lastuserapp.models import db, BaseMixin
+from lastuserapp.passwords import hash_password, needs_rehash, hasher, PasswordHasherBusy
 from lastuserapp.utils import newid, newsecret, newpin
 
 class User(db.Model, BaseMixin):
@@ -22,18 +26,62 @@ class User(db.Model, BaseMixin):
         if password is None:
             self.pw_hash = None
         else:
-            self.pw_hash = generate_password_hash(password)
+            self.pw_hash = hash_password(password)
 
     password = property(fset=_set_password)
 
     def password_is(self, password):
+        """
+        Check the password. If the stored hash uses an older method or cost,
+        it is replaced with a fresh hash. The caller must commit. Raises
+        PasswordHasherBusy if the password hashing pool is backed up.
+        """
         if self.pw_hash is None:
             return False
-        return check_password_hash(self.pw_hash, password)
+        if not hasher.check_password(self.pw_hash, password):
+            return False
+        if needs_rehash(self.pw_hash):
+            try:
+                self.pw_hash = hasher.hash_password(password)
+            except PasswordHasherBusy:
+                # The password was right; upgrade the hash on another login
+                pass
+        return True
 
     def __repr__(self):
         return '<User %s "%s">' % (self.username or self.userid, self.fullname)
 
+    #: Attributes saved in a session snapshot of the user
+    snapshot_attrs = ['id', 'userid', 'username', 'fullname']
+
+    def snapshot(self):
+        """
+        Return a dictionary of the attributes in snapshot_attrs, for saving
+        in the session.
+        """
+        return dict((attr, getattr(self, attr)) for attr in self.snapshot_attrs)
+
+    @classmethod
+    def from_snapshot(cls, data):
+        """
+        Return a user built from a snapshot and attached to the current session
+        without querying the database. Attributes that are not in the snapshot
+        are loaded from the database when first accessed, as are relationships.
+        """
+        mapper = class_mapper(cls)
+        key = mapper.identity_key_from_primary_key([data['id']])
+        user = db.session.identity_map.get(key)
+        if user is not None:
+            return user
+        user = mapper.class_manager.new_instance()
+        for attr in cls.snapshot_attrs:
+            set_committed_value(user, attr, data[attr])
+        instance_state(user).key = key
+        db.session.add(user)
+        db.session.expire(user, [prop.key for prop in mapper.iterate_properties
+            if isinstance(prop, ColumnProperty) and prop.key not in cls.snapshot_attrs])
+        return user
+
     def profileid(self):
         if self.username:
             return self.username
@@ -67,13 +115,16 @@ class User(db.Model, BaseMixin):
         """
         Returns primary email address for user.
         """
+        # Uses the emails relationship, so this costs at most one query per
+        # session, or none if emails were eagerly loaded with user_query_options
+        emails = self.emails
         # Look for a primary address
-        useremail = UserEmail.query.filter_by(user_id=self.id, primary=True).first()
-        if useremail:
-            return useremail
+        for useremail in emails:
+            if useremail.primary:
+                return useremail
         # No primary? Maybe there's one that's not set as primary?
-        useremail = UserEmail.query.filter_by(user_id=self.id).first()
-        if useremail:
+        if emails:
+            useremail = emails[0]
             # XXX: Mark at primary. This may or may not be saved depending on
             # whether the request ended in a database commit.
             useremail.primary=True
@@ -84,9 +135,33 @@ class User(db.Model, BaseMixin):
         return u''
 
 
+#: Relationship loaders for user_query_options. 'selectin' falls back to
+#: subquery loading on SQLAlchemy versions that don't have it.
+USER_LOADERS = {
+    'joined': db.joinedload,
+    'subquery': db.subqueryload,
+    'selectin': getattr(db, 'selectinload', db.subqueryload),
+    }
+
+def user_query_options(strategy=None, relations=None):
+    """
+    Return query options to eagerly load a user's related collections.
+    Defaults to the USER_EAGER_LOAD strategy ('joined', 'subquery', 'selectin'
+    or None for lazy loading) and USER_EAGER_LOAD_RELATIONS from settings.
+    """
+    if strategy is None:
+        strategy = app.config.get('USER_EAGER_LOAD', 'subquery')
+    if relations is None:
+        relations = app.config.get('USER_EAGER_LOAD_RELATIONS', ['emails', 'phones', 'externalids'])
+    if not strategy:
+        return []
+    loader = USER_LOADERS[strategy]
+    return [loader(relation) for relation in relations]
+
+
 class UserEmail(db.Model, BaseMixin):
     __tablename__ = 'useremail'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref= db.backref('emails', cascade="all, delete-orphan"))
     _email = db.Column('email', db.Unicode(80), unique=True, nullable=False)
@@ -116,10 +191,10 @@ class UserEmail(db.Model, BaseMixin):
 
 class UserEmailClaim(db.Model, BaseMixin):
     __tablename__ = 'useremailclaim'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref = db.backref('emailclaims', cascade="all, delete-orphan"))
-    _email = db.Column('email', db.Unicode(80), nullable=True)
+    _email = db.Column('email', db.Unicode(80), nullable=True, index=True)
     verification_code = db.Column(db.String(44), nullable=False, default=newsecret)
     md5sum = db.Column(db.String(32), unique=True, nullable=False)
 
@@ -147,7 +222,7 @@ class UserEmailClaim(db.Model, BaseMixin):
 
 class UserPhone(db.Model, BaseMixin):
     __tablename__ = 'userphone'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref = db.backref('phones', cascade="all, delete-orphan"))
     primary = db.Column(db.Boolean, nullable=False, default=False)
@@ -176,7 +251,7 @@ class UserPhone(db.Model, BaseMixin):
 
 class UserPhoneClaim(db.Model, BaseMixin):
     __tablename__ = 'userphoneclaim'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref = db.backref('phoneclaims', cascade="all, delete-orphan"))
     _phone = db.Column('phone', db.Unicode(80), unique=True, nullable=False)
@@ -206,10 +281,12 @@ class UserPhoneClaim(db.Model, BaseMixin):
 
 class PasswordResetRequest(db.Model, BaseMixin):
     __tablename__ = 'passwordresetrequest'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id)
     reset_code = db.Column(db.String(44), nullable=False, default=newsecret)
 
+    __table_args__ = ( db.Index('ix_passwordresetrequest_user_id_reset_code', 'user_id', 'reset_code'), {} )
+
     def __init__(self, **kwargs):
         super(PasswordResetRequest, self).__init__(**kwargs)
         self.reset_code = newsecret()
@@ -217,7 +294,7 @@ class PasswordResetRequest(db.Model, BaseMixin):
 
 class UserExternalId(db.Model, BaseMixin):
     __tablename__ = 'userexternalid'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref = db.backref('externalids', cascade="all, delete-orphan"))
     service = db.Column(db.String(20), nullable=False)
@@ -227,8 +304,128 @@ class UserExternalId(db.Model, BaseMixin):
     oauth_token_secret = db.Column(db.String(250), nullable=True)
     oauth_token_type = db.Column(db.String(250), nullable=True)
 
+    __table_args__ = ( db.UniqueConstraint("service", "userid"),
+        db.Index('ix_userexternalid_service_username', 'service', 'username'), {} )
+
+
+class AvatarCache(db.Model, BaseMixin):
+    """
+    Avatar URLs for external ids, as last resolved from the external service.
+    """
+    __tablename__ = 'avatarcache'
+    service = db.Column(db.String(20), nullable=False)
+    userid = db.Column(db.String(250), nullable=False) # External id
+    url = db.Column(db.Unicode(250), nullable=True) # None if the service had no avatar
+    fetched_at = db.Column(db.DateTime, nullable=False)
+
     __table_args__ = ( db.UniqueConstraint("service", "userid"), {} )
 
 
+class IDENTIFIER_KIND:
+    # In order of precedence when more than one user has the same identifier
+    USERNAME = 0
+    EMAIL = 1
+    EMAIL_CLAIM = 2
+    TWITTER = 3
+
+
+class UserIdentifier(db.Model, BaseMixin):
+    """
+    Index of the names a user can login with: username, email addresses
+    (verified or claimed) and @twitter ids. Identifiers are stored in
+    lowercase, so getuser() finds a user with a single indexed query. Rows
+    are kept in sync with their source rows by mapper events. Rebuild with
+    `python manage.py indexusers`.
+    """
+    __tablename__ = 'useridentifier'
+    identifier = db.Column(db.Unicode(81), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    user = db.relationship(User, primaryjoin=user_id == User.id)
+    kind = db.Column(db.Integer, nullable=False)
+    # Id of the User, UserEmail, UserEmailClaim or UserExternalId row
+    source_id = db.Column(db.Integer, nullable=False)
+    verified = db.Column(db.Boolean, nullable=False)
+
+    __table_args__ = ( db.UniqueConstraint("kind", "source_id"), {} )
+
+
+def normalize_identifier(name):
+    """
+    Return the form of a username, email address or @twitter id stored in UserIdentifier.
+    """
+    return name.strip().lower()
+
+
+def identifier_row(kind, target):
+    """
+    Return the UserIdentifier column values for a source row, or None if
+    the row has nothing to login with.
+    """
+    if kind == IDENTIFIER_KIND.USERNAME:
+        name, user_id = target.username, target.id
+    elif kind == IDENTIFIER_KIND.TWITTER:
+        if target.service != 'twitter' or not target.username:
+            return None
+        name, user_id = u'@' + target.username, target.user_id
+    else:
+        name, user_id = target.email, target.user_id
+    if not name:
+        return None
+    return dict(identifier=normalize_identifier(name), user_id=user_id, kind=kind,
+        source_id=target.id, verified=kind != IDENTIFIER_KIND.EMAIL_CLAIM)
+
+
+def _index_identifier(kind, attrs=None):
+    """
+    Return a mapper event listener that updates UserIdentifier for a source
+    row. If attrs are given, the row is only updated when one of them changed.
+    """
+    def listener(mapper, connection, target):
+        if attrs and not [attr for attr in attrs if get_history(target, attr).has_changes()]:
+            return
+        table = UserIdentifier.__table__
+        connection.execute(table.delete().where(db.and_(
+            table.c.kind == kind, table.c.source_id == target.id)))
+        row = identifier_row(kind, target)
+        if row is not None:
+            connection.execute(table.insert().values(**row))
+    return listener
+
+
+def _unindex_identifier(kind):
+    """
+    Return a mapper event listener that removes a deleted source row from UserIdentifier.
+    """
+    def listener(mapper, connection, target):
+        table = UserIdentifier.__table__
+        connection.execute(table.delete().where(db.and_(
+            table.c.kind == kind, table.c.source_id == target.id)))
+    return listener
+
+
+#: Source of each kind of identifier
+IDENTIFIER_SOURCES = {
+    IDENTIFIER_KIND.USERNAME: User,
+    IDENTIFIER_KIND.EMAIL: UserEmail,
+    IDENTIFIER_KIND.EMAIL_CLAIM: UserEmailClaim,
+    IDENTIFIER_KIND.TWITTER: UserExternalId,
+    }
+
+#: Attributes of each source that the identifier depends on
+IDENTIFIER_ATTRS = {
+    IDENTIFIER_KIND.USERNAME: ['username'],
+    IDENTIFIER_KIND.EMAIL: ['_email', 'user_id'],
+    IDENTIFIER_KIND.EMAIL_CLAIM: ['_email', 'user_id'],
+    IDENTIFIER_KIND.TWITTER: ['service', 'username', 'user_id'],
+    }
+
+for _kind, _model in IDENTIFIER_SOURCES.items():
+    event.listen(_model, 'after_insert', _index_identifier(_kind))
+    event.listen(_model, 'after_update', _index_identifier(_kind, IDENTIFIER_ATTRS[_kind]))
+    event.listen(_model, 'after_delete', _unindex_identifier(_kind))
+
+
 __all__ = ['User', 'UserEmail', 'UserEmailClaim', 'PasswordResetRequest', 'UserExternalId',
-           'UserPhone', 'UserPhoneClaim']
+           'UserPhone', 'UserPhoneClaim', 'AvatarCache', 'user_query_options',
+           'UserIdentifier', 'IDENTIFIER_KIND', 'IDENTIFIER_SOURCES', 'identifier_row',
+           'normalize_identifier']
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""
+Password hashing. Hashes are stored as method$cost$salt$hash so that the
+cost can be raised over time. Stored hashes made with an older method or a
+lower cost are upgraded when the user next logs in. Legacy werkzeug hashes
+(method$salt$hash) are still accepted.
+"""
+
+import hashlib
+import hmac
+from base64 import b64encode
+from multiprocessing import Pool, TimeoutError
+from threading import Lock
+from time import time
+
+from werkzeug import check_password_hash
+from werkzeug.exceptions import ServiceUnavailable
+
+from lastuserapp import app
+from lastuserapp.utils import newid
+
+__all__ = ['hash_password', 'check_password', 'needs_rehash', 'PasswordHasherPool', 'PasswordHasherBusy',
+    'hasher']
+
+#: Default PBKDF2 iterations. Override with PASSWORD_HASH_ITERATIONS
+DEFAULT_ITERATIONS = 20000
+
+SALT_LENGTH = 12
+
+
+def pbkdf2_sha256(password, salt, iterations):
+    """
+    Return the PBKDF2-HMAC-SHA256 hash of a password, base64 encoded without padding.
+    """
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    if isinstance(salt, unicode):
+        salt = salt.encode('utf-8')
+    return b64encode(hashlib.pbkdf2_hmac('sha256', password, salt, iterations)).rstrip('=')
+
+
+def hash_password(password, iterations=None):
+    """
+    Return a hash of the password to store in User.pw_hash.
+    """
+    if iterations is None:
+        iterations = app.config.get('PASSWORD_HASH_ITERATIONS', DEFAULT_ITERATIONS)
+    salt = newid()[:SALT_LENGTH]
+    return 'pbkdf2_sha256$%d$%s$%s' % (iterations, salt, pbkdf2_sha256(password, salt, iterations))
+
+
+def check_password(pw_hash, password):
+    """
+    Does the password match this hash?
+    """
+    if pw_hash.startswith('pbkdf2_sha256$'):
+        try:
+            method, iterations, salt, hashval = pw_hash.split('$')
+            iterations = int(iterations)
+            # Hashes loaded from the database are unicode, which
+            # compare_digest won't compare with the str we compute
+            hashval = hashval.encode('ascii')
+        except (ValueError, UnicodeError):
+            return False
+        # Constant time comparison, so as to not leak how much of the hash matched
+        return hmac.compare_digest(pbkdf2_sha256(password, salt, iterations), hashval)
+    return check_password_hash(pw_hash, password)
+
+
+def needs_rehash(pw_hash, iterations=None):
+    """
+    Was this hash made with an older method or a lower cost than configured?
+    """
+    if iterations is None:
+        iterations = app.config.get('PASSWORD_HASH_ITERATIONS', DEFAULT_ITERATIONS)
+    parts = pw_hash.split('$')
+    if len(parts) != 4 or parts[0] != 'pbkdf2_sha256':
+        return True
+    try:
+        return int(parts[1]) < iterations
+    except ValueError:
+        return True
+
+
+def _timed_check_password(submitted, pw_hash, password):
+    """
+    Check a password in a pool process. Returns the result and the seconds
+    the job waited in the queue.
+    """
+    return check_password(pw_hash, password), time() - submitted
+
+
+def _timed_hash_password(submitted, password, iterations):
+    """
+    Hash a password in a pool process. Returns the hash and the seconds the
+    job waited in the queue.
+    """
+    return hash_password(password, iterations), time() - submitted
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    """
+    The pool didn't get to a password within its timeout. Unless the view
+    handles it, the request fails with a 503 error.
+    """
+    description = "Too many people are logging in right now. Please try again in a moment."
+
+
+class PasswordHasherPool(object):
+    """
+    Checks and hashes passwords in a pool of worker processes, so that a
+    burst of logins can't take up all the CPU on web workers. With no
+    processes, passwords are checked inline. The pool is started on first
+    use. Raises PasswordHasherBusy if a job waits longer than the timeout.
+
+    :param processes: Number of worker processes, or 0 to check inline
+    :param timeout: Seconds to wait for a result before giving up
+    """
+    def __init__(self, processes=0, timeout=30):
+        self.processes = processes
+        self.timeout = timeout
+        self.stats = {'checks': 0, 'hashes': 0, 'timeouts': 0, 'queue_time': 0.0, 'max_queue_time': 0.0}
+        self._lock = Lock()
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = Pool(self.processes)
+        return self._pool
+
+    def _run(self, counter, func, *args):
+        if not self.processes:
+            result, queue_time = func(time(), *args)
+        else:
+            try:
+                result, queue_time = self.pool.apply_async(func, (time(),) + args).get(self.timeout)
+            except TimeoutError:
+                with self._lock:
+                    self.stats['timeouts'] += 1
+                app.logger.warning("Password hashing pool busy: no result in %s seconds" % self.timeout)
+                raise PasswordHasherBusy()
+        with self._lock:
+            self.stats[counter] += 1
+            self.stats['queue_time'] += queue_time
+            self.stats['max_queue_time'] = max(self.stats['max_queue_time'], queue_time)
+        return result
+
+    def check_password(self, pw_hash, password):
+        return self._run('checks', _timed_check_password, pw_hash, password)
+
+    def hash_password(self, password, iterations=None):
+        if iterations is None:
+            iterations = app.config.get('PASSWORD_HASH_ITERATIONS', DEFAULT_ITERATIONS)
+        return self._run('hashes', _timed_hash_password, password, iterations)
+
+    def mean_queue_time(self):
+        """
+        Average seconds a password check or hash waited for a free process.
+        """
+        jobs = self.stats['checks'] + self.stats['hashes']
+        if not jobs:
+            return 0.0
+        return self.stats['queue_time'] / jobs
+
+
+hasher = PasswordHasherPool(processes=app.config.get('PASSWORD_HASH_WORKERS', 0),
+    timeout=app.config.get('PASSWORD_HASH_TIMEOUT', 30))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+Permission assignments in bulk. A permission is granted to or revoked from
+any number of users of a client with a few statements, by editing the
+space-separated UserClientPermissions.permissions string in the database
+instead of loading and saving each row. Users are given in chunks, as some
+databases limit the number of parameters in a statement.
+"""
+
+from lastuserapp.models import db, User, UserIdentifier, UserClientPermissions, normalize_identifier
+
+__all__ = ['find_user_ids', 'grant_permission', 'revoke_permission']
+
+#: Users per statement
+CHUNK_SIZE = 500
+
+
+def _chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
+
+
+def find_user_ids(names):
+    """
+    Look up users by userid, username, email address or @twitter id.
+    Returns a set of user ids and a list of the names that matched nobody.
+    """
+    user_ids = set()
+    found = set()
+    for chunk in _chunks(set(names)):
+        normalized = dict((normalize_identifier(name), name) for name in chunk)
+        for identifier, user_id in db.session.query(UserIdentifier.identifier, UserIdentifier.user_id).filter(
+                UserIdentifier.identifier.in_(normalized.keys())):
+            user_ids.add(user_id)
+            found.add(normalized[identifier])
+        for userid, user_id in db.session.query(User.userid, User.id).filter(User.userid.in_(chunk)):
+            user_ids.add(user_id)
+            found.add(userid)
+    return user_ids, [name for name in names if name not in found]
+
+
+def _padded():
+    # ' a b c ', so a token can be matched with ' token ' wherever it is
+    return u' ' + UserClientPermissions.permissions + u' '
+
+
+def _has_permission(permission):
+    escaped = permission.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return _padded().like(u'%% %s %%' % escaped, escape='\\')
+
+
+def grant_permission(client, user_ids, permission):
+    """
+    Grant a permission to these users (by User.id) on a client. Returns the
+    number of users who didn't have it. The caller must commit.
+    """
+    table = UserClientPermissions.__table__
+    count = 0
+    for chunk in _chunks(user_ids):
+        # Add to existing assignments that don't have it
+        count += db.session.execute(table.update().where(db.and_(
+            table.c.client_id == client.id,
+            table.c.user_id.in_(chunk),
+            db.not_(_has_permission(permission)))).values(
+            permissions=UserClientPermissions.permissions + u' ' + permission)).rowcount
+        # New assignments for users who have none
+        assigned = set(user_id for (user_id,) in db.session.query(UserClientPermissions.user_id).filter(
+            UserClientPermissions.client_id == client.id).filter(UserClientPermissions.user_id.in_(chunk)))
+        rows = [{'user_id': user_id, 'client_id': client.id, 'permissions': permission}
+            for user_id in chunk if user_id not in assigned]
+        if rows:
+            db.session.execute(table.insert(), rows)
+            count += len(rows)
+    return count
+
+
+def revoke_permission(client, user_ids, permission):
+    """
+    Revoke a permission from these users (by User.id) on a client. Users
+    left with no permissions lose their assignment. Returns the number of
+    users who had it. The caller must commit.
+    """
+    table = UserClientPermissions.__table__
+    count = 0
+    for chunk in _chunks(user_ids):
+        in_chunk = db.and_(table.c.client_id == client.id, table.c.user_id.in_(chunk))
+        count += db.session.execute(table.update().where(db.and_(in_chunk,
+            _has_permission(permission))).values(
+            permissions=db.func.trim(db.func.replace(_padded(), u' %s ' % permission, u' ')))).rowcount
+        db.session.execute(table.delete().where(db.and_(in_chunk, table.c.permissions == u'')))
+    return count
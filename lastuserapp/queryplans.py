@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+Query plan checks. Runs EXPLAIN on the queries that requests depend on and
+reports those that scan a whole table of more than a given number of rows,
+usually because an index is missing. Run with `python manage.py checkplans`
+against a database with realistic data.
+"""
+
+from datetime import datetime
+
+from flask import json
+
+from lastuserapp.models import (db, User, UserEmail, UserEmailClaim, UserPhone, UserExternalId,
+    UserIdentifier, PasswordResetRequest, Client, Resource, ResourceAction, AuthCode, AuthToken,
+    RevokedToken, UserClientPermissions, UserFlashMessage, SMSMessage, SMS_STATUS, OutboundMail,
+    MAIL_STATUS, AvatarCache)
+
+__all__ = ['PLAN_QUERIES', 'explain', 'check_plans']
+
+
+#: Queries to check, by name. Values don't need to exist in the database
+PLAN_QUERIES = [
+    ('getuser', lambda: User.query.join(UserIdentifier, UserIdentifier.user_id == User.id).filter(
+        UserIdentifier.identifier == u'example@example.com').order_by(UserIdentifier.kind, UserIdentifier.id)),
+    ('user by userid', lambda: User.query.filter_by(userid='x' * 22)),
+    ('user emails', lambda: UserEmail.query.filter_by(user_id=1)),
+    ('user email claims', lambda: UserEmailClaim.query.filter_by(user_id=1)),
+    ('user phones', lambda: UserPhone.query.filter_by(user_id=1)),
+    ('user external ids', lambda: UserExternalId.query.filter_by(user_id=1)),
+    ('email by address', lambda: UserEmail.query.filter_by(email=u'example@example.com')),
+    ('email by md5sum', lambda: UserEmail.query.filter_by(md5sum='0' * 32)),
+    ('email claim by address', lambda: UserEmailClaim.query.filter_by(email=u'example@example.com')),
+    ('external id', lambda: UserExternalId.query.filter_by(service='twitter', userid='1')),
+    ('twitter username', lambda: UserExternalId.query.filter_by(service='twitter', username=u'example')),
+    ('password reset', lambda: PasswordResetRequest.query.filter_by(user_id=1, reset_code='x' * 44)),
+    ('client by key', lambda: Client.query.filter_by(key='x' * 22)),
+    ('client list page', lambda: db.session.query(Client.key, Client.title, Client.owner, Client.website,
+        Client.id).filter(db.or_(Client.title > u'x', db.and_(Client.title == u'x', Client.id > 1))).order_by(
+        Client.title, Client.id).limit(51)),
+    ('clients of user', lambda: Client.query.filter_by(user_id=1)),
+    ('resources of client', lambda: Resource.query.filter_by(client_id=1)),
+    ('actions of resource', lambda: ResourceAction.query.filter_by(resource_id=1)),
+    ('auth code', lambda: AuthCode.query.filter_by(code='x' * 44, client_id=1)),
+    ('token by value', lambda: db.session.query(AuthToken._scope, User.userid, Client.key, Client.id,
+        AuthToken.expires_at).join((Client, AuthToken.client_id == Client.id)).outerjoin(
+        (User, AuthToken.user_id == User.id)).filter(AuthToken.token == 'x' * 22)),
+    ('token by refresh token', lambda: AuthToken.query.filter_by(refresh_token='x' * 22, client_id=1)),
+    ('token of user and client', lambda: AuthToken.query.filter_by(user_id=1, client_id=1)),
+    ('tokens of client', lambda: AuthToken.query.filter_by(client_id=1)),
+    ('revoked tokens', lambda: RevokedToken.query.filter(RevokedToken.id > 1).order_by(RevokedToken.id).limit(1001)),
+    ('user permissions', lambda: UserClientPermissions.query.filter_by(user_id=1, client_id=1)),
+    ('permission list page', lambda: db.session.query(UserClientPermissions.id, User.userid, User.username,
+        User.fullname, UserClientPermissions.permissions).join((User, UserClientPermissions.user_id == User.id)).filter(
+        UserClientPermissions.client_id == 1).filter(UserClientPermissions.id > 1).order_by(
+        UserClientPermissions.id).limit(101)),
+    ('flash messages', lambda: UserFlashMessage.query.filter_by(user_id=1)),
+    ('sms by transaction', lambda: SMSMessage.query.filter_by(transaction_id=u'x')),
+    ('sms queue', lambda: db.session.query(SMSMessage.id).filter(
+        SMSMessage.status.in_([SMS_STATUS.QUEUED, SMS_STATUS.SENDING])).filter(
+        SMSMessage.next_attempt_at <= datetime.utcnow()).order_by(SMSMessage.id)),
+    ('mail queue', lambda: db.session.query(OutboundMail.id).filter(
+        OutboundMail.status.in_([MAIL_STATUS.QUEUED, MAIL_STATUS.SENDING])).filter(
+        OutboundMail.next_attempt_at <= datetime.utcnow()).order_by(OutboundMail.id)),
+    ('avatar', lambda: AvatarCache.query.filter_by(service='github', userid='example')),
+    ]
+
+
+def _run_explain(prefix, query):
+    """
+    Run EXPLAIN on a query with its parameters and return the result rows.
+    """
+    compiled = query.statement.compile(bind=db.engine)
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    return db.engine.execute(prefix + unicode(compiled), params).fetchall()
+
+
+def _postgresql_scans(query, threshold):
+    plan = _run_explain('EXPLAIN (FORMAT JSON) ', query)[0][0]
+    if isinstance(plan, basestring):
+        # Older drivers return the plan as text
+        plan = json.loads(plan)
+    scans = []
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if node['Node Type'] == 'Seq Scan' and node['Plan Rows'] > threshold:
+            scans.append((node['Relation Name'], node['Plan Rows']))
+        nodes.extend(node.get('Plans', []))
+    return scans
+
+
+def _mysql_scans(query, threshold):
+    scans = []
+    for row in _run_explain('EXPLAIN ', query):
+        row = dict(row.items())
+        if row.get('type') == 'ALL' and (row.get('rows') or 0) > threshold:
+            scans.append((row['table'], row['rows']))
+    return scans
+
+
+def _sqlite_scans(query, threshold):
+    scans = []
+    for row in _run_explain('EXPLAIN QUERY PLAN ', query):
+        # The detail is the last column. Older SQLAlchemy rows don't take
+        # negative indexes
+        detail = tuple(row)[-1]
+        words = detail.split()
+        # 'SCAN TABLE name' or 'SCAN name', without 'USING ... INDEX'
+        if words and words[0] == 'SCAN' and 'INDEX' not in words:
+            table = words[2] if words[1] == 'TABLE' else words[1]
+            rows = db.engine.execute('SELECT COUNT(*) FROM "%s"' % table).scalar()
+            if rows > threshold:
+                scans.append((table, rows))
+    return scans
+
+
+def explain(query, threshold=1000):
+    """
+    Return a list of (table, rows) for each full table scan in the query's
+    plan over more than threshold rows. Rows are the planner's estimate on
+    PostgreSQL and MySQL, and the table's size on SQLite.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return _postgresql_scans(query, threshold)
+    elif dialect == 'mysql':
+        return _mysql_scans(query, threshold)
+    elif dialect == 'sqlite':
+        return _sqlite_scans(query, threshold)
+    else:
+        raise ValueError("Can't check query plans on %s" % dialect)
+
+
+def check_plans(threshold=1000, queries=None):
+    """
+    Check the plan of each query in PLAN_QUERIES. Returns a list of (name,
+    scans) for queries with full table scans over threshold rows.
+    """
+    failures = []
+    for name, query in queries or PLAN_QUERIES:
+        scans = explain(query(), threshold)
+        if scans:
+            failures.append((name, scans))
+    return failures
@@ -15,6 +15,66 @@ GA_CODE=''
 #: Database backend
 SQLALCHEMY_DATABASE_URI = 'sqlite:///test.db'
 
+#: Connection pool: connections kept open, extra connections allowed under
+#: load, seconds after which connections are replaced, seconds to wait for
+#: a connection, and whether to check connections before use. None leaves
+#: the driver's default
+SQLALCHEMY_POOL_SIZE = None
+SQLALCHEMY_MAX_OVERFLOW = None
+SQLALCHEMY_POOL_RECYCLE = 3600
+SQLALCHEMY_POOL_TIMEOUT = None
+SQLALCHEMY_POOL_PRE_PING = False
+
+#: Read replicas of the database. Read-only views read from these until the
+#: request writes something
+SQLALCHEMY_REPLICA_URIS = []
+
+#: Client registry cache: number of clients to hold in memory and
+#: seconds before a cached client is looked up again. Each process caches
+#: clients on its own, so other processes keep serving a deleted client, or
+#: its old secret or redirect URI, for up to CLIENT_CACHE_TTL seconds. Keep
+#: it short; it bounds how long a rotated secret keeps working
+CLIENT_CACHE_SIZE = 1000
+CLIENT_CACHE_TTL = 5
+
+#: Seconds before the in-memory index of resources and actions used for
+#: scope validation is rebuilt to pick up changes made by other processes
+RESOURCE_INDEX_TTL = 300
+
+#: Memcached servers shared by all processes, as a list of 'host:port'
+#: strings. Requires python-memcached. Leave empty for in-process caches only
+CACHE_SERVERS = []
+
+#: Access token cache used by /api/1/token/verify: entries held in memory,
+#: seconds an entry is kept in the shared cache, and seconds a process may
+#: hold its own copy of an entry. A token revoked in one process may still
+#: verify in others for TOKEN_CACHE_LOCAL_TTL seconds
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_LOCAL_TTL = 5
+
+#: Eager loading for the current user's emails, phones and external ids:
+#: 'joined', 'subquery', 'selectin' or None to load each on first access
+USER_EAGER_LOAD = 'subquery'
+USER_EAGER_LOAD_RELATIONS = ['emails', 'phones', 'externalids']
+
+#: Save a signed snapshot of the user in the session cookie so that most
+#: requests don't need to load the user from the database. Snapshots are
+#: refreshed after SESSION_USER_SNAPSHOT_TTL seconds, or sooner when the
+#: user edits their profile, password or email addresses. Requires
+#: CACHE_SERVERS, where the versions that invalidate snapshots are kept
+SESSION_USER_SNAPSHOT = False
+SESSION_USER_SNAPSHOT_TTL = 300
+
+#: Avatars for Twitter and GitHub ids are resolved in the background:
+#: number of worker threads, seconds to wait for the external service,
+#: seconds before a cached avatar URL is refreshed, and seconds before a
+#: failed lookup is tried again
+AVATAR_RESOLVER_WORKERS = 2
+AVATAR_RESOLVER_TIMEOUT = 5
+AVATAR_MAX_AGE = 86400
+AVATAR_RETRY_AFTER = 300
+
 #: Secret key
 SECRET_KEY = 'make this something random'
 
@@ -34,12 +94,36 @@ MAIL_FAIL_SILENTLY = False
 MAIL_SERVER = 'localhost'
 DEFAULT_MAIL_SENDER = ('LastUser', 'test@example.com')
 
+#: Queue outgoing mail in the database instead of sending it during the
+#: request. Queued mail is sent by `python manage.py mailworker`, or by a
+#: worker thread in the development server. For a local SMTP sink, run
+#: `python -m smtpd -n -c DebuggingServer localhost:1025` and set MAIL_PORT
+MAIL_QUEUE = False
+
 #: Logging: recipients of error emails
 ADMINS=[]
 
 #: Log file
 LOGFILE='error.log'
 
+#: Error logs: frames to show local variables for, maximum length of a
+#: value, seconds to hold back repeats of an error, and records to queue
+#: for the log writer before dropping them
+LOG_MAX_FRAMES = 10
+LOG_MAX_REPR = 200
+LOG_DEDUP_WINDOW = 300
+LOG_QUEUE_SIZE = 1000
+
+#: Users (by userid) who may see admin pages such as /admin/metrics
+ADMIN_USERIDS = []
+
+#: Request instrumentation: record query, HTTP, template and mail timings
+#: for each request, send them in a Server-Timing header, and log requests
+#: slower than SLOW_REQUEST_THRESHOLD seconds (None to log none)
+INSTRUMENTATION = True
+SERVER_TIMING_HEADER = True
+SLOW_REQUEST_THRESHOLD = 1.0
+
 #: Use SSL for some URLs
 USE_SSL=False
 
@@ -57,10 +141,85 @@ RECAPTCHA_PUBLIC_KEY=''
 RECAPTCHA_PRIVATE_KEY=''
 RECAPTCHA_OPTIONS=''
 
-#: SMS gateways
+#: SMS gateways. SMS_GATEWAY is 'smsgupshup', or 'local' to keep messages
+#: in memory without sending them
+SMS_GATEWAY='smsgupshup'
 SMS_SMSGUPSHUP_MASK=''
 SMS_SMSGUPSHUP_USER=''
 SMS_SMSGUPSHUP_PASS=''
 
+#: Queue text messages for `python manage.py smsworker` instead of sending
+#: them during the request
+SMS_QUEUE=False
+
+#: Buffer delivery reports from the SMS gateway and apply them in bulk, when
+#: SMS_REPORT_BUFFER_SIZE reports are waiting or the oldest has waited
+#: SMS_REPORT_BUFFER_INTERVAL seconds
+SMS_REPORT_BUFFER=False
+SMS_REPORT_BUFFER_SIZE=500
+SMS_REPORT_BUFFER_INTERVAL=2
+
+#: Look up names missing from the login name index the way earlier versions
+#: did, for databases upgraded without `python manage.py indexusers`. Costs
+#: a query or two for names that match nobody; set False once the index is built
+USER_INDEX_FALLBACK=True
+
+#: PBKDF2 iterations for password hashes. Raising this upgrades stored
+#: hashes as users login
+PASSWORD_HASH_ITERATIONS=20000
+
+#: Processes to check and hash passwords in, so logins don't hold up web
+#: workers. 0 checks passwords inline. Logins that wait longer than
+#: PASSWORD_HASH_TIMEOUT seconds for a process fail with a 503 error
+PASSWORD_HASH_WORKERS=0
+PASSWORD_HASH_TIMEOUT=30
+
+#: Where OAuth authorization codes are kept: 'sql', 'memory' (in this
+#: process only; for single process servers) or 'cache' (on CACHE_SERVERS).
+#: Codes expire after AUTH_CODE_TTL seconds
+AUTH_CODE_STORE='sql'
+AUTH_CODE_TTL=60
+AUTH_CODE_CACHE_SIZE=10000
+
+#: Seconds between sweeps of expired and used codes from the authcode
+#: table by the development server, or 0 for none. Under a WSGI server
+#: nothing sweeps on its own: run `python manage.py sweepauthcodes` from cron
+AUTH_CODE_SWEEP_INTERVAL=300
+
+#: Seconds access tokens and refresh tokens are valid for, or 0 for tokens
+#: that never expire. Clients renew expired access tokens with the
+#: refresh_token grant
+ACCESS_TOKEN_VALIDITY=3600
+REFRESH_TOKEN_VALIDITY=2592000
+
+#: Seconds between sweeps of tokens that can no longer be used or
+#: refreshed by the development server, or 0 for none. Under a WSGI server
+#: nothing sweeps on its own: run `python manage.py sweeptokens` from cron
+TOKEN_SWEEP_INTERVAL=3600
+
+#: Keys for signed tokens, which resource servers verify offline with the
+#: lastusertokens package. Clients ask for them with token_type=signed at
+#: /token. TOKEN_SIGNING_KEY is the id of the key new tokens are signed
+#: with; leave it empty to not issue signed tokens. Signed tokens are valid
+#: for SIGNED_TOKEN_VALIDITY seconds
+TOKEN_SIGNING_KEYS = {}
+TOKEN_SIGNING_KEY = ''
+SIGNED_TOKEN_VALIDITY=300
+
+#: Most revoked tokens returned by one poll of /api/1/token/revoked, and
+#: how many ids below the poller's cursor each poll reads again, to catch
+#: revocations whose transactions committed after later ones. Make the
+#: overlap larger than the revocations that can be in flight at once
+REVOKED_TOKEN_PAGE_SIZE = 1000
+REVOKED_TOKEN_OVERLAP = 100
+
+#: Most users a trusted client may ask for in one /api/1/users request
+USERINFO_BATCH_SIZE = 100
+
+#: Applications per page in the /apps list, and permission assignments
+#: per page on an application's page
+CLIENT_LIST_PAGE_SIZE = 50
+PERMISSION_LIST_PAGE_SIZE = 100
+
 #: Messages (in markdown)
 MESSAGE_FOOTER='Copyright &copy; [HasGeek](http://hasgeek.com/). Powered by [LastUser](https://github.com/hasgeek/lastuser "GitHub project page"), open source software from [HasGeek](https://github.com/hasgeek).'
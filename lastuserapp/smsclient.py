@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+"""
+Queue and dispatch text messages through SMS gateways
+"""
+
+from datetime import datetime, timedelta
+from httplib import HTTPSConnection, HTTPException
+from socket import error as SocketError
+from threading import local, Lock
+from time import time
+from urllib import urlencode
+
+from pytz import timezone
+
+from lastuserapp import app
+from lastuserapp.models import db, SMSMessage, SMS_STATUS
+from lastuserapp.instrument import timed
+from lastuserapp.utils import newid
+from lastuserapp.worker import QueueWorker, backoff
+
+
+class SMSGatewayError(Exception):
+    pass
+
+
+class SMSGateway(object):
+    """
+    Base class for SMS gateways. Gateways send a batch of messages at once and
+    report a (transaction_id, error) tuple for each, where exactly one of the
+    two is None.
+    """
+    def supports(self, phone_number):
+        """
+        Can this gateway send to this number?
+        """
+        raise NotImplementedError
+
+    def send(self, messages):
+        """
+        Send a list of SMSMessage instances. Returns a list of (transaction_id, error).
+        Raises SMSGatewayError if the gateway could not be reached at all.
+        Gateways that send a batch in several requests report a failed
+        request as errors for its messages only, so that messages already
+        accepted aren't sent again.
+        """
+        raise NotImplementedError
+
+
+class LocalGateway(SMSGateway):
+    """
+    A gateway that sends nothing and keeps messages in an outbox. Useful in
+    development and as a stand-in for a real gateway in tests.
+    """
+    def __init__(self):
+        self.outbox = []
+
+    def supports(self, phone_number):
+        return True
+
+    def send(self, messages):
+        results = []
+        for msg in messages:
+            self.outbox.append((msg.phone_number, msg.message))
+            results.append((newid(), None))
+        return results
+
+
+class SMSGupShupGateway(SMSGateway):
+    """
+    SMS GupShup, for Indian mobile numbers. Each worker thread keeps a
+    persistent HTTPS connection to the gateway. Messages with the same text
+    are sent in a single request.
+    """
+    host = 'enterprise.smsgupshup.com'
+    path = '/GatewayAPI/rest'
+
+    def __init__(self, userid, password, mask, timeout=10):
+        self.userid = userid
+        self.password = password
+        self.mask = mask
+        self.timeout = timeout
+        self._local = local()
+
+    def supports(self, phone_number):
+        return phone_number.startswith('+91') and len(phone_number) == 13
+
+    def request(self, params):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = HTTPSConnection(self.host, timeout=self.timeout)
+        try:
+            with timed('http'):
+                connection.request('GET', '%s?%s' % (self.path, urlencode(params)))
+                return connection.getresponse().read()
+        except (HTTPException, SocketError), e:
+            # Drop the connection so the next request opens a new one
+            connection.close()
+            self._local.connection = None
+            raise SMSGatewayError(unicode(e))
+
+    def send(self, messages):
+        bytext = {}
+        for msg in messages:
+            bytext.setdefault(msg.message, []).append(msg)
+        results = {}
+        for text, batch in bytext.items():
+            try:
+                response = self.request(dict(
+                    method='SendMessage',
+                    send_to=','.join(msg.phone_number[1:] for msg in batch), # Numbers without leading +
+                    msg=text,
+                    msg_type='TEXT',
+                    format='text',
+                    v='1.1',
+                    auth_scheme='plain',
+                    userid=self.userid,
+                    password=self.password,
+                    mask=self.mask
+                    ))
+            except SMSGatewayError, e:
+                # Earlier requests may have succeeded; fail only this one's messages
+                for msg in batch:
+                    results[msg] = (None, unicode(e))
+                continue
+            # One line per number: status | phone number | transaction id or error
+            byphone = {}
+            for line in response.strip().split('\n'):
+                parts = [item.strip() for item in line.split('|')]
+                if len(parts) == 3:
+                    byphone[parts[1]] = parts
+            for msg in batch:
+                parts = byphone.get(msg.phone_number[1:])
+                if parts is None:
+                    results[msg] = (None, response.strip() or u"No response")
+                elif parts[0] == 'success':
+                    results[msg] = (parts[2], None)
+                else:
+                    results[msg] = (None, parts[2])
+        return [results[msg] for msg in messages]
+
+
+def get_gateway():
+    """
+    Return the gateway configured in SMS_GATEWAY: 'smsgupshup' or 'local'.
+    """
+    name = app.config.get('SMS_GATEWAY', 'smsgupshup')
+    if name == 'local':
+        return LocalGateway()
+    elif name == 'smsgupshup':
+        return SMSGupShupGateway(userid=app.config['SMS_SMSGUPSHUP_USER'],
+            password=app.config['SMS_SMSGUPSHUP_PASS'],
+            mask=app.config['SMS_SMSGUPSHUP_MASK'])
+    else:
+        raise ValueError("Unknown SMS gateway '%s'" % name)
+
+gateway = get_gateway()
+
+
+def deliver(messages, max_attempts=5):
+    """
+    Send messages through the gateway and record the results in the status
+    and fail_reason columns. Failed messages are queued for another attempt
+    with exponential backoff, up to max_attempts.
+    """
+    try:
+        results = gateway.send(messages)
+    except SMSGatewayError, e:
+        results = [(None, unicode(e))] * len(messages)
+    now = datetime.utcnow()
+    for msg, (transaction_id, error) in zip(messages, results):
+        msg.attempts = (msg.attempts or 0) + 1
+        if transaction_id is not None:
+            msg.status = SMS_STATUS.PENDING
+            msg.transaction_id = transaction_id
+            msg.fail_reason = None
+        else:
+            msg.fail_reason = error[:25]
+            if msg.attempts >= max_attempts:
+                msg.status = SMS_STATUS.FAILED
+                msg.status_at = now
+            else:
+                msg.status = SMS_STATUS.QUEUED
+                msg.next_attempt_at = now + timedelta(seconds=backoff(msg.attempts, base=30, maximum=900))
+
+
+def send_message(msg):
+    """
+    Send a message. If SMS_QUEUE is enabled, the message is queued for an
+    SMSDispatchWorker. Either way the caller must add the message to the
+    database session and commit.
+    """
+    if not gateway.supports(msg.phone_number):
+        raise ValueError("Unsupported phone number")
+    msg.status = SMS_STATUS.QUEUED
+    msg.next_attempt_at = datetime.utcnow()
+    if not app.config.get('SMS_QUEUE'):
+        deliver([msg])
+
+
+class SMSDispatchWorker(QueueWorker):
+    """
+    Sends queued messages in batches through the gateway. Several workers may
+    run at once; each message is claimed by one worker at a time.
+
+    :param batchsize: Maximum messages to send per batch
+    :param interval: Seconds to wait when the queue is empty
+    :param lease: Seconds before a claimed but unsent message may be claimed again
+    :param max_attempts: Attempts before a message is marked as failed
+    """
+    def __init__(self, batchsize=50, interval=2, lease=120, max_attempts=5, name='SMSDispatchWorker'):
+        super(SMSDispatchWorker, self).__init__(interval=interval, name=name)
+        self.batchsize = batchsize
+        self.lease = timedelta(seconds=lease)
+        self.max_attempts = max_attempts
+
+    def claim(self):
+        now = datetime.utcnow()
+        table = SMSMessage.__table__
+        due = db.and_(table.c.status.in_([SMS_STATUS.QUEUED, SMS_STATUS.SENDING]),
+            db.or_(table.c.next_attempt_at == None, table.c.next_attempt_at <= now))
+        candidates = [row[0] for row in db.session.query(SMSMessage.id).filter(due).order_by(
+            SMSMessage.id).limit(self.batchsize)]
+        claimed = []
+        for id in candidates:
+            result = db.session.execute(table.update().where(db.and_(table.c.id == id, due)).values(
+                status=SMS_STATUS.SENDING, next_attempt_at=now + self.lease))
+            if result.rowcount == 1:
+                claimed.append(id)
+        db.session.commit()
+        if not claimed:
+            return []
+        return SMSMessage.query.filter(SMSMessage.id.in_(claimed)).all()
+
+    def process(self):
+        messages = self.claim()
+        if messages:
+            deliver(messages, max_attempts=self.max_attempts)
+            db.session.commit()
+        return len(messages)
+
+
+# --- Delivery reports --------------------------------------------------------
+
+# SMS GupShup sends delivery reports with this timezone
+SMSGUPSHUP_TIMEZONE = timezone('Asia/Calcutta')
+
+#: Delivery report status: SMSMessage status
+REPORT_STATUS = {
+    'SUCCESS': SMS_STATUS.DELIVERED,
+    'FAIL': SMS_STATUS.FAILED,
+    }
+
+
+def gupshup_to_utc(timestamps):
+    """
+    Convert a list of SMS GupShup delivery timestamps (milliseconds, in IST)
+    into naive UTC datetimes. None stays None. The timezone offset is looked
+    up once per distinct hour rather than once per timestamp.
+    """
+    local_times = [datetime.fromtimestamp(ts / 1000.0) if ts is not None else None for ts in timestamps]
+    offsets = {}
+    result = []
+    for local_time in local_times:
+        if local_time is None:
+            result.append(None)
+            continue
+        hour = local_time.replace(minute=0, second=0, microsecond=0)
+        if hour not in offsets:
+            offsets[hour] = SMSGUPSHUP_TIMEZONE.utcoffset(hour)
+        result.append(local_time - offsets[hour])
+    return result
+
+
+def parse_delivery_report(params):
+    """
+    Return a delivery report tuple of (transaction_id, phone_number, status,
+    deliveredTS, cause) from SMS GupShup's parameters.
+    """
+    delivered = params.get('deliveredTS')
+    return (params.get('externalId'),
+        '+' + (params.get('phoneNo') or ''),
+        REPORT_STATUS.get(params.get('status'), SMS_STATUS.UNKNOWN),
+        float(delivered) if delivered else None,
+        params.get('cause'))
+
+
+def apply_delivery_reports(reports):
+    """
+    Apply delivery reports to their messages in a single UPDATE statement.
+    Reports whose phone number doesn't match the message are ignored.
+    The caller must commit. Returns the number of messages updated.
+    """
+    if not reports:
+        return 0
+    # The latest report for a message wins
+    reports = dict((report[0], report) for report in reports if report[0]).values()
+    if not reports:
+        return 0
+    status_at = gupshup_to_utc([report[3] for report in reports])
+    table = SMSMessage.__table__
+    tid = table.c.transaction_id
+    result = db.session.execute(table.update().where(db.and_(
+        tid.in_([report[0] for report in reports]),
+        table.c.phone_number == db.case(dict((report[0], report[1]) for report in reports), value=tid)
+        )).values(
+        status=db.case(dict((report[0], report[2]) for report in reports), value=tid),
+        status_at=db.case(dict((report[0], at) for report, at in zip(reports, status_at)), value=tid),
+        fail_reason=db.case(dict((report[0], (report[4] or u'')[:25] or None) for report in reports), value=tid),
+        ))
+    return result.rowcount
+
+
+class DeliveryReportBuffer(object):
+    """
+    Buffers delivery reports and applies them in bulk, when maxsize reports
+    are waiting or the oldest has waited interval seconds. A background
+    thread flushes the buffer when no new reports arrive.
+    """
+    def __init__(self, maxsize=500, interval=2):
+        self.maxsize = maxsize
+        self.interval = interval
+        self._reports = []
+        self._since = None
+        self._lock = Lock()
+        self._worker = None
+
+    def add(self, reports):
+        with self._lock:
+            if not self._reports:
+                self._since = time()
+            self._reports.extend(reports)
+            due = len(self._reports) >= self.maxsize or self._since + self.interval <= time()
+        if due:
+            self.flush()
+        elif self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = DeliveryReportFlushWorker(self)
+                    self._worker.start()
+
+    def due(self):
+        return bool(self._reports) and self._since + self.interval <= time()
+
+    def flush(self):
+        with self._lock:
+            reports, self._reports = self._reports, []
+        if reports:
+            apply_delivery_reports(reports)
+            db.session.commit()
+        return len(reports)
+
+
+class DeliveryReportFlushWorker(QueueWorker):
+    """
+    Flushes a DeliveryReportBuffer whose reports have waited too long.
+    """
+    def __init__(self, buffer):
+        super(DeliveryReportFlushWorker, self).__init__(interval=buffer.interval / 2.0,
+            name='DeliveryReportFlushWorker')
+        self.buffer = buffer
+
+    def process(self):
+        if self.buffer.due():
+            self.buffer.flush()
+        # Always sleep between checks
+        return 0
+
+
+report_buffer = DeliveryReportBuffer(maxsize=app.config.get('SMS_REPORT_BUFFER_SIZE', 500),
+    interval=app.config.get('SMS_REPORT_BUFFER_INTERVAL', 2))
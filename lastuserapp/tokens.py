@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+Access token lifecycle: issuing, refreshing and purging expired tokens
+"""
+
+import calendar
+from datetime import datetime
+from time import time
+
+from lastusertokens import KeyRegistry, token_id
+from lastuserapp import app
+from lastuserapp.models import db, AuthToken, RevokedToken
+from lastuserapp.worker import QueueWorker
+
+#: Keys for signed tokens. Resource servers need the same keys to verify them
+signing_keys = KeyRegistry(app.config.get('TOKEN_SIGNING_KEYS', {}), app.config.get('TOKEN_SIGNING_KEY'))
+
+
+def token_validity():
+    """
+    Return the configured (access token, refresh token) validity in seconds.
+    """
+    return (app.config.get('ACCESS_TOKEN_VALIDITY', 3600),
+            app.config.get('REFRESH_TOKEN_VALIDITY', 2592000))
+
+
+def issue_token(user, client, scope):
+    """
+    Return the token for this user and client with the given scope added.
+    A new token is made if there isn't one, and an existing token is renewed
+    if it has expired or was made before tokens expired. The caller must
+    commit.
+    """
+    validity, refresh_validity = token_validity()
+    token = AuthToken.query.filter_by(user=user, client=client).first()
+    if token:
+        token.add_scope(scope)
+        if token.is_expired() or (validity and token.expires_at is None):
+            token.renew(validity, refresh_validity)
+    else:
+        token = AuthToken(user=user, client=client, scope=scope)
+        token.renew(validity, refresh_validity)
+        db.session.add(token)
+    return token
+
+
+def get_refreshable_token(refresh_token, client):
+    """
+    Return the token with this refresh token, or None if the refresh token is
+    unknown, belongs to another client or has expired.
+    """
+    token = AuthToken.query.filter_by(refresh_token=refresh_token, client_id=client.id).first()
+    if token is None or token.refresh_is_expired():
+        return None
+    return token
+
+
+def refresh_token(token):
+    """
+    Give a token new access and refresh token values. The old values stop
+    working at once. Returns None if another request refreshed the token
+    first. The caller must commit.
+    """
+    table = AuthToken.__table__
+    old = token.refresh_token
+    token.renew(*token_validity())
+    # Claim the old refresh token with a conditional update, so that of two
+    # requests refreshing with it at once only one succeeds. The update
+    # also locks the row until the caller commits
+    result = db.session.execute(table.update().where(db.and_(
+        table.c.id == token.id, table.c.refresh_token == old)).values(refresh_token=token.refresh_token))
+    if result.rowcount != 1:
+        # Discard the renewal
+        db.session.expire(token)
+        return None
+    return token
+
+
+def sign_token(token):
+    """
+    Return a signed token for an access token, that resource servers can
+    verify without calling LastUser, and the seconds until it expires.
+    Signed tokens are valid for SIGNED_TOKEN_VALIDITY seconds at most.
+    """
+    expires = time() + app.config.get('SIGNED_TOKEN_VALIDITY', 300)
+    if token.expires_at is not None:
+        expires = min(expires, calendar.timegm(token.expires_at.utctimetuple()))
+    signed = signing_keys.sign(userid=token.user.userid if token.user else None,
+        client=token.client.key, scope=token.scope, expires=expires, tokenid=token_id(token.token))
+    return signed, max(int(expires - time()), 0)
+
+
+def sweep_tokens(batchsize=1000):
+    """
+    Delete tokens that can no longer be used or refreshed, in batches.
+    Returns the number of tokens deleted.
+    """
+    table = AuthToken.__table__
+    now = datetime.utcnow()
+    dead = db.or_(table.c.refresh_expires_at < now,
+        db.and_(table.c.refresh_expires_at == None, table.c.expires_at < now))
+    count = 0
+    while True:
+        ids = [row[0] for row in db.session.execute(
+            db.select([table.c.id]).where(dead).limit(batchsize))]
+        if ids:
+            # Bulk deletes skip token_cache eviction, but these tokens have
+            # expired, so gettoken no longer returns them from the cache
+            db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        db.session.commit()
+        count += len(ids)
+        if len(ids) < batchsize:
+            break
+    # Revocations are only needed until the signed tokens they revoke expire
+    revoked = RevokedToken.__table__
+    db.session.execute(revoked.delete().where(revoked.c.expires_at < now))
+    db.session.commit()
+    return count
+
+
+class TokenSweeper(QueueWorker):
+    """
+    Periodically deletes tokens that can no longer be used or refreshed.
+    """
+    def __init__(self, interval=3600, batchsize=1000, name='TokenSweeper'):
+        super(TokenSweeper, self).__init__(interval=interval, name=name)
+        self.batchsize = batchsize
+
+    def process(self):
+        sweep_tokens(self.batchsize)
+        # Always wait for the next interval
+        return 0
@@ -1,63 +1,156 @@
 # -*- coding: utf-8 -*-
 
 from functools import wraps
+from time import time
 import urlparse
-from urllib2 import urlopen, URLError
 
-from flask import (g, request, session, flash, redirect, url_for, render_template,
+from flask import (g, request, session, flash, redirect, url_for, render_template, abort,
     Markup, escape, json)
 
 from lastuserapp import app
-from lastuserapp.models import db, User
+from lastuserapp.models import db, User, user_query_options, user_versions, use_replica
+from lastuserapp.utils import newid
+from lastuserapp.avatar import avatars
 from lastuserapp.forms import ConfirmDeleteForm
 
-def avatar_url_email(useremail):
+def avatar_url_email(md5sum):
     if request.url.startswith('https:'):
-        return 'https://secure.gravatar.com/avatar/%s?s=80&d=mm' % useremail.md5sum
+        return 'https://secure.gravatar.com/avatar/%s?s=80&d=mm' % md5sum
     else:
-        return 'http://www.gravatar.com/avatar/%s?s=80&d=mm' % useremail.md5sum
+        return 'http://www.gravatar.com/avatar/%s?s=80&d=mm' % md5sum
 
 
-def avatar_url_twitter(twitterid):
-    if twitterid:
-        try:
-            return urlopen('http://api.twitter.com/1/users/profile_image/%s' % twitterid).geturl()
-        except URLError:
-            return None
+#: Format version of user snapshots saved in the session
+USER_SNAPSHOT_FORMAT = 1
 
+def snapshots_enabled():
+    """
+    Are user snapshots enabled? They need CACHE_SERVERS, so that a change
+    made in one process invalidates snapshots in all of them.
+    """
+    return app.config.get('SESSION_USER_SNAPSHOT') and user_versions.shared is not None
+
+
+def get_user_version(user):
+    """
+    Return the version token for the user's session snapshots, creating one if required.
+    """
+    version = user_versions.get(user.userid)
+    if version is None:
+        version = newid()
+        user_versions.set(user.userid, version)
+    return version
+
+
+def save_user_snapshot(user):
+    """
+    Save a snapshot of the user in the session, if snapshots are enabled.
+    """
+    if not snapshots_enabled() or user.id is None:
+        return
+    snapshot = user.snapshot()
+    email = user.email
+    snapshot['email_md5'] = email.md5sum if email else None
+    snapshot['format'] = USER_SNAPSHOT_FORMAT
+    snapshot['version'] = get_user_version(user)
+    snapshot['at'] = time()
+    session['user'] = snapshot
+
+
+def load_user_snapshot():
+    """
+    Return the user from the snapshot in the session without querying the
+    database, or None if there is no usable snapshot.
+    """
+    if not snapshots_enabled():
+        return None
+    snapshot = session.get('user')
+    if not snapshot or snapshot.get('format') != USER_SNAPSHOT_FORMAT:
+        return None
+    if snapshot.get('userid') != session['userid']:
+        return None
+    if snapshot['at'] + app.config.get('SESSION_USER_SNAPSHOT_TTL', 300) < time():
+        return None
+    # A missing version may have been evicted from the cache, so it can't
+    # vouch for the snapshot either
+    if user_versions.get(snapshot['userid']) != snapshot['version']:
+        return None
+    return User.from_snapshot(snapshot)
+
+
+def invalidate_user_snapshot(user):
+    """
+    Invalidate session snapshots of this user after a change to their profile,
+    password or email addresses. The current session gets a fresh snapshot.
+    """
+    user_versions.set(user.userid, newid())
+    if session.get('userid') == user.userid:
+        save_user_snapshot(user)
 
-def avatar_url_github(githubid):
-    if githubid:
-        try:
-            ghinfo = json.loads(urlopen('https://api.github.com/users/%s' % githubid).read())
-            return ghinfo.get('avatar_url')
-        except URLError:
-            return None
 
 @app.before_request
 def lookup_current_user():
     """
     If there's a userid in the session, retrieve the user object and add
-    to the request namespace object g.
+    to the request namespace object g. If snapshots are enabled (with
+    SESSION_USER_SNAPSHOT and CACHE_SERVERS), the user is recreated from a
+    snapshot in the session and only loaded from the database when the
+    view touches other attributes.
     """
     g.user = None
     if 'userid' in session:
-        g.user = User.query.filter_by(userid=session['userid']).first()
+        if snapshots_enabled():
+            g.user = load_user_snapshot()
+        if g.user is None:
+            # Load the user's emails, phones and external ids along with the user, so
+            # g.user.email and friends don't query again for the rest of the request
+            g.user = User.query.options(*user_query_options()).filter_by(userid=session['userid']).first()
+            if g.user is None:
+                # This user no longer exists
+                logout_internal()
+                session.pop('avatar_url', None)
+                g.avatar_url = None
+                return
+            save_user_snapshot(g.user)
         if not 'avatar_url' in session:
-            if g.user.email:
-                session['avatar_url'] = avatar_url_email(g.user.email)
-            elif session.get('userid_external', {}).get('service') == 'twitter':
-                session['avatar_url'] = avatar_url_twitter(session['userid_external'].get('username'))
-            elif session.get('userid_external', {}).get('service') == 'github':
-                session['avatar_url'] = avatar_url_github(session['userid_external'].get('userid'))
+            if snapshots_enabled() and 'user' in session:
+                email_md5 = session['user']['email_md5']
+            else:
+                email_md5 = g.user.email.md5sum if g.user.email else None
+            userid_external = session.get('userid_external', {})
+            if email_md5:
+                session['avatar_url'] = avatar_url_email(email_md5)
+            elif userid_external.get('service') in ('twitter', 'github'):
+                # Twitter avatars are looked up by username, GitHub by login (the userid)
+                if userid_external['service'] == 'twitter':
+                    extid = userid_external.get('username')
+                else:
+                    extid = userid_external.get('userid')
+                # The resolver returns immediately. If the avatar isn't known
+                # yet, don't save it in the session so we'll ask again next time
+                avatar_url = avatars.get(userid_external['service'], extid)
+                if avatar_url is not None:
+                    session['avatar_url'] = avatar_url
             else:
                 session['avatar_url'] = None
-        g.avatar_url = session['avatar_url']
+        g.avatar_url = session.get('avatar_url')
     else:
         session.pop('avatar_url', None)
         g.avatar_url = None
 
 
+def read_only(f):
+    """
+    Decorator for views that only read from the database, so that they may
+    read from a replica. Writes still go to the primary database.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        use_replica()
+        return f(*args, **kwargs)
+    return decorated_function
+
+
 def requires_login(f):
     """
     Decorator to require a login for the given view.
@@ -72,6 +165,19 @@ def requires_login(f):
     return decorated_function
 
 
+def requires_admin(f):
+    """
+    Decorator to require a login by one of the users in ADMIN_USERIDS.
+    """
+    @wraps(f)
+    @requires_login
+    def decorated_function(*args, **kwargs):
+        if g.user.userid not in app.config.get('ADMIN_USERIDS', []):
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
 def get_next_url(referrer=False, external=False):
     """
     Get the next URL to redirect to. Don't return external URLs unless
@@ -96,11 +202,13 @@ def get_next_url(referrer=False, external=False):
 def login_internal(user):
     g.user = user
     session['userid'] = user.userid
+    save_user_snapshot(user)
 
 
 def logout_internal():
     g.user = None
     session.pop('userid', None)
+    session.pop('user', None)
     session.pop('userid_external', None)
     session.permanent = False
 
@@ -184,7 +292,9 @@ import lastuserapp.views.login
 import lastuserapp.views.oauthclient
 import lastuserapp.views.openidclient
 import lastuserapp.views.oauth
+import lastuserapp.views.api
 import lastuserapp.views.client
+import lastuserapp.views.admin
 import lastuserapp.views.httperror
 import lastuserapp.views.profile
 import lastuserapp.views.sms
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+from flask import jsonify
+
+from lastuserapp import app
+from lastuserapp.instrument import metrics
+from lastuserapp.views import requires_admin
+
+
+@app.route('/admin/metrics')
+@requires_admin
+def admin_metrics():
+    """
+    Request timing histograms by endpoint, for this server process. Durations
+    are in milliseconds.
+    """
+    response = jsonify(endpoints=metrics.as_dict())
+    response.headers['Cache-Control'] = 'no-store'
+    return response
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+
+from flask import request, jsonify
+
+from lastuserapp import app
+from lastuserapp.models import db, User, Permission, RevokedToken, getclient, gettoken, resource_index
+from lastuserapp.permissions import find_user_ids, grant_permission, revoke_permission
+from lastuserapp.views import read_only
+from lastuserapp.views.oauth import oauth_token_error, get_userinfos
+
+
+def get_api_client():
+    """
+    Return the client making an API request, authenticated with its client
+    id and secret in HTTP Basic authentication. Returns None if the client
+    is unknown, inactive or did not authenticate.
+    """
+    if not request.authorization:
+        return None
+    client = getclient(request.authorization.username)
+    if not client or not client.active:
+        return None
+    if request.authorization.password != client.secret:
+        return None
+    return client
+
+
+def resource_client_allowed(client, tokeninfo):
+    """
+    Is this client allowed to see this token? Trusted clients, the client the
+    token was issued to and clients providing a resource in the token's scope
+    are all allowed.
+    """
+    if client.trusted or client.id == tokeninfo['client_id']:
+        return True
+    resources = resource_index.resources
+    for item in tokeninfo['scope']:
+        resource = resources.get(item.split('/')[0])
+        if resource is not None and resource.client_id == client.id:
+            return True
+    return False
+
+
+@app.route('/api/1/token/verify', methods=['POST'])
+@read_only
+def token_verify():
+    """
+    Verify an access token on behalf of a resource server. Resource servers
+    authenticate with their own client credentials and receive the userid,
+    scope and client the token was issued to.
+    """
+    client = get_api_client()
+    if client is None:
+        return oauth_token_error('invalid_client', "Client authentication failed")
+    token = request.form.get('access_token')
+    if not token:
+        return oauth_token_error('invalid_request', "access_token missing")
+    tokeninfo = gettoken(token)
+    if tokeninfo is None:
+        return oauth_token_error('invalid_token', "Unknown access token")
+    if not resource_client_allowed(client, tokeninfo):
+        return oauth_token_error('unauthorized_client', "This client may not verify this token")
+    response = jsonify(userid=tokeninfo['userid'],
+        scope=tokeninfo['scope'],
+        client=tokeninfo['client'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/api/1/token/revoked')
+def token_revoked():
+    """
+    List signed tokens that were revoked before they expired, for resource
+    servers to poll. Returns up to REVOKED_TOKEN_PAGE_SIZE [token id, expiry]
+    pairs revoked after the since cursor, the cursor for the next poll, and
+    whether there are more to fetch.
+
+    Ids are handed out before transactions commit, so a row may show up
+    after rows with higher ids were already returned. Each poll re-reads the
+    last REVOKED_TOKEN_OVERLAP ids below the cursor to catch these, and may
+    repeat tokens from the previous poll.
+    """
+    client = get_api_client()
+    if client is None:
+        return oauth_token_error('invalid_client', "Client authentication failed")
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return oauth_token_error('invalid_request', "since must be a number")
+    page_size = app.config.get('REVOKED_TOKEN_PAGE_SIZE', 1000)
+    # Fewer ids than a page, so a page always has room for new rows
+    overlap = min(app.config.get('REVOKED_TOKEN_OVERLAP', 100), page_size - 1)
+    rows = db.session.query(RevokedToken.id, RevokedToken.tokenid, RevokedToken.expires_at).filter(
+        RevokedToken.id > since - overlap).order_by(RevokedToken.id).limit(page_size + 1).all()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    response = jsonify(
+        revoked=[(tokenid, calendar.timegm(expires_at.utctimetuple())) for id, tokenid, expires_at in rows],
+        cursor=max([since] + [row[0] for row in rows]),
+        more=more)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/api/1/users', methods=['GET', 'POST'])
+@read_only
+def user_info_batch():
+    """
+    Return userinfo for a batch of users, for trusted clients. Users are
+    named with any number of userid and username parameters, up to
+    USERINFO_BATCH_SIZE in all. Pass scope=email to include email
+    addresses. Users that don't exist are left out of the response. Takes
+    the same number of queries however many users are asked for.
+    """
+    client = get_api_client()
+    if client is None:
+        return oauth_token_error('invalid_client', "Client authentication failed")
+    if not client.trusted:
+        return oauth_token_error('unauthorized_client', "Only trusted clients may request user info")
+    userids = request.values.getlist('userid')
+    usernames = request.values.getlist('username')
+    if not userids and not usernames:
+        return oauth_token_error('invalid_request', "userid or username missing")
+    if len(userids) + len(usernames) > app.config.get('USERINFO_BATCH_SIZE', 100):
+        return oauth_token_error('invalid_request', "Too many users requested")
+    scope = request.values.get('scope', u'').split(u' ')
+    conditions = []
+    if userids:
+        conditions.append(User.userid.in_(userids))
+    if usernames:
+        conditions.append(User.username.in_(usernames))
+    users = User.query.filter(db.or_(*conditions)).order_by(User.id).all()
+    response = jsonify(users=get_userinfos(users, client, scope))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/api/1/permissions', methods=['POST'])
+def permission_bulk():
+    """
+    Grant or revoke a permission for many users of the calling client at
+    once. Takes action (grant or revoke), permission, and any number of user
+    parameters, each a username, email address or userid. Returns the number
+    of users changed and the names that matched no user.
+    """
+    client = get_api_client()
+    if client is None:
+        return oauth_token_error('invalid_client', "Client authentication failed")
+    action = request.form.get('action')
+    if action not in ('grant', 'revoke'):
+        return oauth_token_error('invalid_request', "action must be grant or revoke")
+    permission = request.form.get('permission')
+    if not permission or not Permission.query.filter_by(name=permission).filter(
+            db.or_(Permission.allusers == True, Permission.user_id == client.user_id)).first():
+        return oauth_token_error('invalid_request', "Unknown permission")
+    names = request.form.getlist('user')
+    if not names:
+        return oauth_token_error('invalid_request', "user missing")
+    user_ids, unknown = find_user_ids(names)
+    if action == 'grant':
+        count = grant_permission(client, user_ids, permission)
+    else:
+        count = revoke_permission(client, user_ids, permission)
+    db.session.commit()
+    return jsonify(changed=count, unknown=unknown)
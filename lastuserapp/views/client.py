@@ -1,18 +1,99 @@
 # -*- coding: utf-8 -*-
 
-from flask import g, request, render_template, redirect, url_for, flash, abort
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from flask import g, request, render_template, redirect, url_for, flash, abort, json, jsonify
 
 from lastuserapp import app
-from lastuserapp.views import requires_login, render_form, render_message, render_redirect, render_delete
-from lastuserapp.models import db, User, Client, Permission, UserClientPermissions, Resource, ResourceAction
+from lastuserapp.views import read_only, requires_login, render_form, render_message, render_redirect, render_delete
+from lastuserapp.models import (db, User, Client, Permission, UserClientPermissions, Resource, ResourceAction,
+    getclient, client_cache, resource_index)
 from lastuserapp.forms import (RegisterClientForm, PermissionForm, UserPermissionAssignForm,
-    UserPermissionEditForm, ResourceForm, ResourceActionForm)
+    UserPermissionEditForm, UserPermissionBulkForm, ResourceForm, ResourceActionForm)
+from lastuserapp.permissions import find_user_ids, grant_permission, revoke_permission
 
 # --- Routes: client apps -----------------------------------------------------
 
+def _like_prefix(column, prefix):
+    # Case insensitive prefix match that can use an index on lower(column)
+    prefix = prefix.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return db.func.lower(column).like(prefix + u'%', escape='\\')
+
+
+def make_cursor(title, id):
+    return urlsafe_b64encode(json.dumps([title, id]))
+
+
+def parse_cursor(cursor):
+    """
+    Return the (title, id) in a client list cursor, or raise ValueError.
+    """
+    try:
+        title, id = json.loads(urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(title, basestring) or not isinstance(id, int):
+        raise ValueError("Invalid cursor")
+    return title, id
+
+
+def client_page(query=None, after=None):
+    """
+    Return a page of clients ordered by title and id, after the client with
+    the given cursor, and the cursor for the next page or None. Clients are
+    (key, title, owner, website) tuples. Clients may be searched for by
+    the start of their title, owner or website's hostname.
+    """
+    page_size = app.config.get('CLIENT_LIST_PAGE_SIZE', 50)
+    clients = db.session.query(Client.key, Client.title, Client.owner, Client.website, Client.id)
+    if query:
+        clients = clients.filter(db.or_(
+            _like_prefix(Client.title, query),
+            _like_prefix(Client.owner, query),
+            _like_prefix(Client.website, u'http://' + query),
+            _like_prefix(Client.website, u'https://' + query)))
+    if after:
+        title, id = parse_cursor(after)
+        clients = clients.filter(db.or_(Client.title > title, db.and_(Client.title == title, Client.id > id)))
+    # One more than a page, to find out if there is a next page
+    clients = clients.order_by(Client.title, Client.id).limit(page_size + 1).all()
+    cursor = None
+    if len(clients) > page_size:
+        clients = clients[:page_size]
+        cursor = make_cursor(clients[-1].title, clients[-1].id)
+    return [(key, title, owner, website) for key, title, owner, website, id in clients], cursor
+
+
 @app.route('/apps')
+@read_only
 def client_list():
-    return render_template('client_list.html', clients=Client.query.order_by('title').all())
+    query = request.args.get('q', u'').strip()
+    try:
+        clients, cursor = client_page(query, request.args.get('after'))
+    except ValueError:
+        abort(400)
+    return render_template('client_list.html', clients=clients, query=query,
+        first_page=bool(request.args.get('after')),
+        next_url=url_for('client_list', q=query or None, after=cursor) if cursor else None)
+
+
+@app.route('/apps.json')
+@read_only
+def client_list_json():
+    query = request.args.get('q', u'').strip()
+    try:
+        clients, cursor = client_page(query, request.args.get('after'))
+    except ValueError:
+        response = jsonify(error='invalid_request', error_description="Invalid cursor")
+        response.status_code = 400
+        return response
+    return jsonify(clients=[{'key': key,
+                             'title': title,
+                             'owner': owner,
+                             'website': website,
+                             'url': url_for('client_info', key=key, _external=True)}
+                            for key, title, owner, website in clients],
+        next=url_for('client_list_json', q=query or None, after=cursor, _external=True) if cursor else None)
 
 
 @app.route('/apps/new', methods=['GET', 'POST'])
@@ -27,6 +108,7 @@ def client_new():
         client.trusted = False
         db.session.add(client)
         db.session.commit()
+        client_cache.delete(client.key)
         return render_redirect(url_for('client_info', key=client.key), code=303)
 
     return render_form(form=form, title="Register a new client application",
@@ -34,21 +116,61 @@ def client_new():
 
 
 @app.route('/apps/<key>')
+@read_only
 def client_info(key):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
-    permassignments = UserClientPermissions.query.filter_by(client=client).all()
     resources = Resource.query.filter_by(client=client).order_by('name').all()
+    permassignments = next_url = None
+    query = request.args.get('q', u'').strip()
+    if client.user == g.user:
+        # Only the owner sees permission assignments
+        try:
+            after = int(request.args.get('after', 0))
+        except ValueError:
+            abort(400)
+        permassignments, cursor = permission_page(client, query, after)
+        if cursor:
+            next_url = url_for('client_info', key=key, q=query or None, after=cursor)
     return render_template('client_info.html', client=client,
         permassignments=permassignments,
-        resources=resources)
+        resources=resources,
+        query=query,
+        first_page=bool(request.args.get('after')),
+        next_url=next_url)
+
+
+def permission_page(client, query=None, after=0):
+    """
+    Return a page of permission assignments for a client, in the order they
+    were made, with each user's details, and the cursor for the next page
+    or None. Assignments are (userid, displayname, permissions) tuples.
+    Users may be searched for by the start of their username or full name.
+    """
+    page_size = app.config.get('PERMISSION_LIST_PAGE_SIZE', 100)
+    assignments = db.session.query(UserClientPermissions.id, User.userid, User.username, User.fullname,
+        UserClientPermissions.permissions).join((User, UserClientPermissions.user_id == User.id)).filter(
+        UserClientPermissions.client_id == client.id)
+    if query:
+        assignments = assignments.filter(db.or_(_like_prefix(User.username, query),
+            _like_prefix(User.fullname, query)))
+    if after:
+        assignments = assignments.filter(UserClientPermissions.id > after)
+    assignments = assignments.order_by(UserClientPermissions.id).limit(page_size + 1).all()
+    cursor = None
+    if len(assignments) > page_size:
+        assignments = assignments[:page_size]
+        cursor = assignments[-1].id
+    # Display names as from User.displayname()
+    return [(userid, fullname or username or userid, permissions)
+        for id, userid, username, fullname, permissions in assignments], cursor
 
 
 @app.route('/apps/<key>/edit', methods=['GET', 'POST'])
 @requires_login
 def client_edit(key):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
     if client.user != g.user:
@@ -67,6 +189,7 @@ def client_edit(key):
     if form.validate_on_submit():
         form.populate_obj(client)
         db.session.commit()
+        client_cache.delete(client.key)
         return render_redirect(url_for('client_info', key=client.key), code=303)
 
     return render_form(form=form, title="Edit application", formid="client_edit",
@@ -74,15 +197,21 @@ def client_edit(key):
 
 @app.route('/apps/<key>/delete', methods=['GET', 'POST'])
 def client_delete(key):
-    client = Client.query.filter_by(key=key).first()
-    return render_delete(client, title="Confirm delete", message="Delete application '%s'? " % client.title,
+    client = getclient(key)
+    if not client:
+        abort(404)
+    response = render_delete(client, title="Confirm delete", message="Delete application '%s'? " % client.title,
         success="You have deleted application '%s' and all its associated permissions and resources" % client.title,
         next=url_for('client_list'))
+    client_cache.delete(key)
+    resource_index.invalidate()
+    return response
 
 # --- Routes: user permissions ------------------------------------------------
 
 @app.route('/perms')
 @requires_login
+@read_only
 def permission_list():
     allperms = Permission.query.filter_by(allusers=True).order_by('name').all()
     userperms = Permission.query.filter_by(user=g.user).order_by('name').all()
@@ -141,7 +270,7 @@ def permission_delete(id):
 @app.route('/apps/<key>/perms/new', methods=['GET', 'POST'])
 @requires_login
 def permission_user_new(key):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
     if client.user != g.user:
@@ -160,10 +289,38 @@ def permission_user_new(key):
     return render_form(form=form, title="Assign permissions", formid="perm_assign", submit="Assign permissions", ajax=True)
 
 
+@app.route('/apps/<key>/perms/bulk', methods=['GET', 'POST'])
+@requires_login
+def permission_user_bulk(key):
+    client = getclient(key)
+    if not client:
+        abort(404)
+    if client.user != g.user:
+        abort(403)
+    available_perms = Permission.query.filter(db.or_(Permission.allusers == True, Permission.user == g.user)).order_by('name').all()
+    form = UserPermissionBulkForm()
+    form.perm.choices = [(ap.name, u"%s – %s" % (ap.name, ap.title)) for ap in available_perms]
+    if form.validate_on_submit():
+        user_ids, unknown = find_user_ids(form.names)
+        if form.action.data == 'grant':
+            count = grant_permission(client, user_ids, form.perm.data)
+            flash("Permission %s has been granted to %d users" % (form.perm.data, count), "info")
+        else:
+            count = revoke_permission(client, user_ids, form.perm.data)
+            flash("Permission %s has been revoked from %d users" % (form.perm.data, count), "info")
+        db.session.commit()
+        if unknown:
+            flash(u"These users were not found: %s%s" % (u', '.join(unknown[:20]),
+                u" and %d more" % (len(unknown) - 20) if len(unknown) > 20 else u''), "error")
+        return render_redirect(url_for('client_info', key=key), code=303)
+    return render_form(form=form, title="Grant or revoke a permission", formid="perm_bulk",
+        submit="Save changes", ajax=True)
+
+
 @app.route('/apps/<key>/perms/<userid>/edit', methods=['GET', 'POST'])
 @requires_login
 def permission_user_edit(key, userid):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
     if client.user != g.user:
@@ -203,7 +360,7 @@ def permission_user_edit(key, userid):
 @app.route('/apps/<key>/perms/<userid>/delete', methods=['GET', 'POST'])
 @requires_login
 def permission_user_delete(key, userid):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
     if client.user != g.user:
@@ -223,7 +380,7 @@ def permission_user_delete(key, userid):
 @app.route('/apps/<key>/resources/new', methods=['GET', 'POST'])
 @requires_login
 def resource_new(key):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
     if client.user != g.user:
@@ -234,6 +391,7 @@ def resource_new(key):
         form.populate_obj(resource)
         db.session.add(resource)
         db.session.commit()
+        resource_index.invalidate()
         flash("Your new resource has been saved", "info")
         return render_redirect(url_for('client_info', key=key), code=303)
     return render_form(form=form, title="Define a resource", formid="resource_new", submit="Define resource", ajax=True)
@@ -242,7 +400,7 @@ def resource_new(key):
 @app.route('/apps/<key>/resources/<int:idr>/edit', methods=['GET', 'POST'])
 @requires_login
 def resource_edit(key, idr):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
     if client.user != g.user:
@@ -260,6 +418,7 @@ def resource_edit(key, idr):
     if form.validate_on_submit():
         form.populate_obj(resource)
         db.session.commit()
+        resource_index.invalidate()
         flash("Your resource has been edited", "info")
         return render_redirect(url_for('client_info', key=key), code=303)
     return render_form(form=form, title="Edit resource", formid="resource_edit", submit="Save changes", ajax=True)
@@ -268,16 +427,20 @@ def resource_edit(key, idr):
 @app.route('/apps/<key>/resources/<int:idr>/delete', methods=['GET', 'POST'])
 @requires_login
 def resource_delete(key, idr):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
     if client.user != g.user:
         abort(403)
     resource = Resource.query.get(idr)
-    return render_delete(resource, title="Confirm delete", message="Delete resource '%s' from app '%s'?" % (
+    if not resource:
+        abort(404)
+    response = render_delete(resource, title="Confirm delete", message="Delete resource '%s' from app '%s'?" % (
         resource.title, client.title),
         success="You have deleted resource '%s' on app '%s'" % (resource.title, client.title),
         next=url_for('client_info', key=client.key))
+    resource_index.invalidate()
+    return response
 
 
 # --- Routes: resource actions ------------------------------------------------
@@ -285,7 +448,7 @@ def resource_delete(key, idr):
 @app.route('/apps/<key>/resources/<int:idr>/actions/new', methods=['GET', 'POST'])
 @requires_login
 def resource_action_new(key, idr):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
     if client.user != g.user:
@@ -301,6 +464,7 @@ def resource_action_new(key, idr):
         form.populate_obj(action)
         db.session.add(action)
         db.session.commit()
+        resource_index.invalidate()
         flash("Your new action has been saved", "info")
         return render_redirect(url_for('client_info', key=key), code=303)
     return render_form(form=form, title="Define an action", formid="action_new", submit="Define action", ajax=True)
@@ -309,7 +473,7 @@ def resource_action_new(key, idr):
 @app.route('/apps/<key>/resources/<int:idr>/actions/<int:ida>/edit', methods=['GET', 'POST'])
 @requires_login
 def resource_action_edit(key, idr, ida):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
     if client.user != g.user:
@@ -330,6 +494,7 @@ def resource_action_edit(key, idr, ida):
     if form.validate_on_submit():
         form.populate_obj(action)
         db.session.commit()
+        resource_index.invalidate()
         flash("Your action has been edited", "info")
         return render_redirect(url_for('client_info', key=key), code=303)
     return render_form(form=form, title="Edit action", formid="action_edit", submit="Save changes", ajax=True)
@@ -338,7 +503,7 @@ def resource_action_edit(key, idr, ida):
 @app.route('/apps/<key>/resources/<int:idr>/actions/<int:ida>/delete', methods=['GET', 'POST'])
 @requires_login
 def resource_action_delete(key, idr, ida):
-    client = Client.query.filter_by(key=key).first()
+    client = getclient(key)
     if not client:
         abort(404)
     if client.user != g.user:
@@ -347,7 +512,11 @@ def resource_action_delete(key, idr, ida):
     if not resource:
         abort(404)
     action = ResourceAction.query.get(ida)
-    return render_delete(action, title="Confirm delete", message="Delete action '%s' from resource '%s' of app '%s'?" % (
+    if not action:
+        abort(404)
+    response = render_delete(action, title="Confirm delete", message="Delete action '%s' from resource '%s' of app '%s'?" % (
         action.title, resource.title, client.title),
         success="You have deleted action '%s' on resource '%s' of app '%s'" % (action.title, resource.title, client.title),
         next=url_for('client_info', key=client.key))
+    resource_index.invalidate()
+    return response
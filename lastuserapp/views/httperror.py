@@ -15,6 +15,11 @@ def error_404(e):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(503)
+def error_503(e):
+    return render_template('503.html', error=e), 503
+
+
 @app.errorhandler(500)
 def error_500(e):
     return render_template('500.html'), 500
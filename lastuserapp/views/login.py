@@ -8,10 +8,10 @@ from flask import g, redirect, request, session, flash, render_template, url_for
 from lastuserapp import app
 from lastuserapp.views.openidclient import oid
 from lastuserapp.mailclient import send_email_verify_link, send_password_reset_link
-from lastuserapp.models import db, User, UserEmailClaim, PasswordResetRequest, Client
+from lastuserapp.models import db, User, UserEmailClaim, PasswordResetRequest, getclient
 from lastuserapp.forms import LoginForm, OpenIdForm, RegisterForm, PasswordResetForm, PasswordResetRequestForm
 from lastuserapp.views import (get_next_url, login_internal, logout_internal, register_internal,
-    render_form, render_message, render_redirect)
+    render_form, render_message, render_redirect, invalidate_user_snapshot)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -36,6 +36,7 @@ def login():
         if loginform.validate():
             user = loginform.user
             login_internal(user)
+            db.session.commit() # In case the password hash was upgraded
             if loginform.remember.data:
                 session.permanent = True
             else:
@@ -71,7 +72,7 @@ def logout_client():
     """
     Client-initiated logout
     """
-    client = Client.query.filter_by(key=request.args['client_id']).first()
+    client = getclient(request.args['client_id'])
     if client is None:
         # No such client. Possible CSRF. Don't logout and don't send them back
         flash(logout_errormsg, 'error')
@@ -120,8 +121,8 @@ def register():
             user.username = form.username.data
         useremail = UserEmailClaim(user=user, email=form.email.data)
         db.session.add(useremail)
-        db.session.commit()
         send_email_verify_link(useremail)
+        db.session.commit()
         login_internal(user)
         flash("You are now one of us. Welcome aboard!", category='info')
         if 'next' in request.args:
@@ -144,6 +145,7 @@ def confirm_email(md5sum, secret):
                 useremail = emailclaim.user.add_email(emailclaim.email, primary=emailclaim.user.email is None)
                 db.session.delete(emailclaim)
                 db.session.commit()
+                invalidate_user_snapshot(emailclaim.user)
                 return render_message(title="Email address verified",
                     message=Markup("Hello %s! Your email address <code>%s</code> has now been verified." % (
                         escape(emailclaim.user.fullname), escape(useremail.email))))
@@ -220,6 +222,7 @@ def reset_email(userid, secret):
         user.password = form.password.data
         db.session.delete(resetreq)
         db.session.commit()
+        invalidate_user_snapshot(user)
         return render_message(title="Password reset complete", message=Markup(
             'Your password has been reset. You may now <a href="%s">login</a> with your new password.' % escape(url_for('login'))))
     return render_form(form=form, title="Reset password", formid='reset', submit="Reset password",
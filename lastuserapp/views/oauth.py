@@ -1,16 +1,18 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime, timedelta
 import urlparse
 
 from flask import g, render_template, redirect, request, jsonify
 from flask import get_flashed_messages
 
 from lastuserapp import app
-from lastuserapp.models import (db, Client, AuthCode, AuthToken, UserFlashMessage,
-    UserClientPermissions, getuser, Resource, ResourceAction)
+from lastuserapp.models import (db, User, UserEmail, AuthToken, UserFlashMessage,
+    UserClientPermissions, getuser, getclient, resource_index, ScopeError)
+from lastuserapp.authcodes import authcodes
+from lastuserapp.passwords import PasswordHasherBusy
+from lastuserapp.tokens import issue_token, get_refreshable_token, refresh_token, signing_keys, sign_token
 from lastuserapp.forms import AuthorizeForm
-from lastuserapp.utils import make_redirect_url, newid, newsecret
+from lastuserapp.utils import make_redirect_url, newid
 from lastuserapp.views import requires_login
 
 
@@ -26,10 +28,7 @@ def oauth_make_auth_code(client, scope, redirect_uri):
     Make an auth code for a given client. Caller must commit
     the database session for this to work.
     """
-    authcode = AuthCode(user=g.user, client=client, scope=scope, redirect_uri=redirect_uri)
-    authcode.code = newsecret()
-    db.session.add(authcode)
-    return authcode.code
+    return authcodes.create(user=g.user, client=client, scope=scope, redirect_uri=redirect_uri)
 
 
 def clear_flashed_messages():
@@ -100,7 +99,7 @@ def oauth_authorize():
         else:
             return oauth_auth_403("Missing client_id")
     # Validation 1.2: Client exists
-    client = Client.query.filter_by(key=client_id).first()
+    client = getclient(client_id)
     if not client:
         if redirect_uri:
             return oauth_auth_error(redirect_uri, state, 'unauthorized_client')
@@ -137,38 +136,11 @@ def oauth_authorize():
     if not scope:
         return oauth_auth_error(redirect_uri, state, 'invalid_request', "Scope not specified")
 
-    resources = {} # resource_object: [action_object, ...]
-
     # Validation 3.2: Scope valid?
-    for item in scope:
-        if item not in [u'id', u'email']:
-            # Validation 3.2.1: resource/action is properly formatted
-            if '/' in item:
-                parts = item.split('/')
-                if len(parts) != 2:
-                    return oauth_auth_error(redirect_uri, state, 'invalid_scope', "Too many / characters in %s in scope" % item)
-                resource_name, action_name = parts
-            else:
-                resource_name = item
-                action_name = None
-            resource = Resource.query.filter_by(name=resource_name).first()
-            # Validation 3.2.2: Resource exists
-            if not resource:
-                return oauth_auth_error(redirect_uri, state, 'invalid_scope', "Unknown resource '%s' in scope" % resource_name)
-            # Validation 3.2.3: Client has access to resource
-            if resource.trusted and not client.trusted:
-                return oauth_auth_error(redirect_uri, state, 'invalid_scope',
-                    "This application does not have access to resource '%s' in scope" % resource_name)
-            # Validation 3.2.4: If action is specified, it exists for this resource
-            if action_name:
-                action = ResourceAction.query.filter_by(name=action_name, resource=resource).first()
-                if not action:
-                    return oauth_auth_error(redirect_uri, state, 'invalid_scope',
-                        "Unknown action '%s' on resource '%s' in scope" % (action_name, resource_name))
-                resources.setdefault(resource, []).append(action)
-            else:
-                action = None
-                resources.setdefault(resource, [])
+    try:
+        resources = resource_index.resolve(scope, client) # resource: [action, ...]
+    except ScopeError, e:
+        return oauth_auth_error(redirect_uri, state, 'invalid_scope', unicode(e))
 
     # Validations complete. Now ask user for permission
     # If the client is trusted (LastUser feature, not in OAuth2 spec), don't ask user.
@@ -214,12 +186,7 @@ def oauth_token_error(error, error_description=None, error_uri=None):
 
 
 def oauth_make_token(user, client, scope):
-    token = AuthToken.query.filter_by(user=user, client=client).first()
-    if token:
-        token.add_scope(scope)
-    else:
-        token = AuthToken(user=user, client=client, scope=scope)
-        db.session.add(token)
+    token = issue_token(user=user, client=client, scope=scope)
     # TODO: Look up Resources for items in scope; look up their providing clients apps,
     # and notify each client app of this token
     return token
@@ -237,9 +204,14 @@ def oauth_token_success(token, **params):
                 'message': ufm.message
                 })
             db.session.delete(ufm)
-    # TODO: Understand how refresh_token works.
-    if token.validity:
-        params['expires_in'] = token.validity
+    if token.expires_at is not None:
+        params['expires_in'] = token.expires_in()
+        params['refresh_token'] = token.refresh_token
+    if request.form.get('token_type') == 'signed' and signing_keys.current:
+        # The client asked for a signed token that resource servers can verify
+        # offline. It's short-lived; the client refreshes it with refresh_token
+        params['access_token'], params['expires_in'] = sign_token(token)
+        params['token_type'] = 'signed'
         params['refresh_token'] = token.refresh_token
     response = jsonify(**params)
     response.headers['Cache-Control'] = 'no-store'
@@ -247,16 +219,39 @@ def oauth_token_success(token, **params):
     return response
 
 
-def get_userinfo(user, client, scope=[]):
-    userinfo = {'userid': user.userid,
-                'username': user.username,
-                'fullname': user.fullname}
+def get_userinfos(users, client, scope=[]):
+    """
+    Return userinfo for each of these users, in the same order. Email
+    addresses and permissions for all the users are each fetched in one
+    query, so this takes at most two queries however many users there are.
+    """
+    if not users:
+        return []
+    user_ids = [user.id for user in users]
+    emails = {}
     if 'email' in scope:
-        userinfo['email'] = unicode(user.email)
-    perms = UserClientPermissions.query.filter_by(user=user, client=client).first()
-    if perms:
-        userinfo['permissions'] = perms.permissions.split(u' ')
-    return userinfo
+        # The primary address, or the oldest if none is marked primary
+        for user_id, email, primary in db.session.query(UserEmail.user_id, UserEmail.email,
+                UserEmail.primary).filter(UserEmail.user_id.in_(user_ids)).order_by(UserEmail.id):
+            if primary or user_id not in emails:
+                emails[user_id] = email
+    perms = dict(db.session.query(UserClientPermissions.user_id, UserClientPermissions.permissions).filter(
+        UserClientPermissions.client_id == client.id).filter(UserClientPermissions.user_id.in_(user_ids)))
+    userinfos = []
+    for user in users:
+        userinfo = {'userid': user.userid,
+                    'username': user.username,
+                    'fullname': user.fullname}
+        if 'email' in scope:
+            userinfo['email'] = emails.get(user.id, u'')
+        if user.id in perms:
+            userinfo['permissions'] = perms[user.id].split(u' ')
+        userinfos.append(userinfo)
+    return userinfos
+
+
+def get_userinfo(user, client, scope=[]):
+    return get_userinfos([user], client, scope)[0]
 
 
 @app.route('/token', methods=['POST'])
@@ -279,6 +274,8 @@ def oauth_token():
     # if grant_type == 'password' (GET)
     username = request.form.get('username')
     password = request.form.get('password')
+    # if grant_type == 'refresh_token' (POST)
+    refresh_token_value = request.form.get('refresh_token')
 
     # Validations 0: HTTP Basic authentication matches client_id
     if request.authorization:
@@ -287,12 +284,11 @@ def oauth_token():
     # Validations 1: Required parameters
     if not grant_type or not client_id or not client_secret:
         return oauth_token_error('invalid_request', "Missing one of grant_type, client_id or client_secret")
-    # grant_type == 'refresh_token' is not supported. All tokens are permanent unless revoked
-    if grant_type not in ['authorization_code', 'client_credentials', 'password']:
+    if grant_type not in ['authorization_code', 'client_credentials', 'password', 'refresh_token']:
         return oauth_token_error('unsupported_grant_type')
 
     # Validations 2: client
-    client = Client.query.filter_by(key=client_id).first()
+    client = getclient(client_id)
     if not client or not client.active:
         return oauth_token_error('invalid_client', "Unknown client_id")
     if client_secret != client.secret:
@@ -306,26 +302,24 @@ def oauth_token():
         return oauth_token_success(token)
     elif grant_type == 'authorization_code':
         # Validations 3: auth code
-        authcode = AuthCode.query.filter_by(code=code, client=client).first()
+        # Codes expire after AUTH_CODE_TTL seconds and can only be used once
+        authcode = authcodes.consume(code, client) if code else None
         if not authcode:
-            return oauth_token_error('invalid_grant', "Unknown auth code")
-        if authcode.created_at < (datetime.utcnow()-timedelta(minutes=1)): # XXX: Time limit: 1 minute
-            db.session.delete(authcode)
-            db.session.commit()
-            return oauth_token_error('invalid_grant', "Expired auth code")
+            return oauth_token_error('invalid_grant', "Unknown or expired auth code")
         # Validations 3.1: scope in authcode
         if not scope or scope[0] == '':
             return oauth_token_error('invalid_scope', "Scope is blank")
-        if not set(scope).issubset(set(authcode.scope)):
+        if not set(scope).issubset(set(authcode['scope'])):
             return oauth_token_error('invalid_scope', "Scope expanded")
         else:
             # Scope not provided. Use whatever the authcode allows
-            scope = authcode.scope
-        if redirect_uri != authcode.redirect_uri:
+            scope = authcode['scope']
+        if redirect_uri != authcode['redirect_uri']:
             return oauth_token_error('invalid_client', "redirect_uri does not match")
 
-        token = oauth_make_token(user=authcode.user, client=client, scope=scope)
-        return oauth_token_success(token, userinfo=get_userinfo(user=authcode.user, client=client, scope=scope))
+        user = User.query.get(authcode['user_id'])
+        token = oauth_make_token(user=user, client=client, scope=scope)
+        return oauth_token_success(token, userinfo=get_userinfo(user=user, client=client, scope=scope))
 
     elif grant_type == 'password':
         # Validations 4.1: password grant_type is only for trusted clients
@@ -338,9 +332,32 @@ def oauth_token():
         user = getuser(username)
         if not user:
             return oauth_token_error('invalid_client', "No such user") # XXX: invalid_client doesn't seem right
-        if not user.password_is(password):
-            return oauth_token_error('invalid_client', "Password mismatch")
+        try:
+            if not user.password_is(password):
+                return oauth_token_error('invalid_client', "Password mismatch")
+        except PasswordHasherBusy:
+            response = oauth_token_error('temporarily_unavailable', "Too many logins; try again shortly")
+            response.status_code = 503
+            return response
 
         # All good. Grant access
         token = oauth_make_token(user=user, client=client, scope=scope)
         return oauth_token_success(token, userinfo=get_userinfo(user=user, client=client, scope=scope))
+
+    elif grant_type == 'refresh_token':
+        # Validations 5: refresh token
+        if not refresh_token_value:
+            return oauth_token_error('invalid_request', "refresh_token not provided")
+        token = get_refreshable_token(refresh_token_value, client)
+        if token is None:
+            return oauth_token_error('invalid_grant', "Unknown or expired refresh token")
+        # Validations 5.1: scope, if provided, must be within the token's scope
+        if scope and scope[0] != '' and not set(scope).issubset(set(token.scope)):
+            return oauth_token_error('invalid_scope', "Scope expanded")
+        # Issue new access and refresh tokens. The old ones stop working
+        if refresh_token(token) is None:
+            return oauth_token_error('invalid_grant', "Unknown or expired refresh token")
+        if token.user:
+            return oauth_token_success(token, userinfo=get_userinfo(user=token.user, client=client, scope=token.scope))
+        else:
+            return oauth_token_success(token)
@@ -9,6 +9,7 @@ from flaskext.oauth import OAuth, OAuthException # OAuth 1.0a
 
 from lastuserapp import app
 from lastuserapp.models import db, UserExternalId, UserEmail, User
+from lastuserapp.instrument import timed
 from lastuserapp.views import get_next_url, login_internal, register_internal
 from lastuserapp.utils import valid_username, get_gravatar_md5sum
 
@@ -61,7 +62,8 @@ def login_twitter_authorized(resp):
 
     # Try to read more from the user's Twitter profile
     try:
-        twinfo = json.loads(urlopen('http://api.twitter.com/1/users/lookup.json?%s' % urlencode({'user_id': resp['user_id']})).read())[0]
+        with timed('http'):
+            twinfo = json.loads(urlopen('http://api.twitter.com/1/users/lookup.json?%s' % urlencode({'user_id': resp['user_id']})).read())[0]
         return_url = config_external_id(service='twitter',
                                         service_name='Twitter',
                                         user=None,
@@ -115,11 +117,13 @@ def login_github_authorized():
 
     # Try to read more from the user's Github profile
     try:
-        response = urlopen(github['token_url'], params).read()
+        with timed('http'):
+            response = urlopen(github['token_url'], params).read()
         respdict = parse_qs(response)
         access_token = respdict['access_token'][0]
         token_type = respdict['token_type'][0]
-        ghinfo = json.loads(urlopen(github['user_info'] % access_token).read())
+        with timed('http'):
+            ghinfo = json.loads(urlopen(github['user_info'] % access_token).read())
         md5sum = get_gravatar_md5sum(ghinfo['avatar_url'])
         user = None
         if md5sum:
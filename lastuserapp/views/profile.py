@@ -5,7 +5,8 @@ from flask import g, request, abort, flash, redirect, render_template, url_for,
 from lastuserapp import app
 from lastuserapp.models import db, User, UserEmail, UserEmailClaim, UserPhone, UserPhoneClaim
 from lastuserapp.mailclient import send_email_verify_link
-from lastuserapp.views import get_next_url, requires_login, render_form, render_redirect, render_delete
+from lastuserapp.views import (get_next_url, read_only, requires_login, render_form, render_redirect, render_delete,
+    invalidate_user_snapshot)
 from lastuserapp.views.sms import send_phone_verify_code
 from lastuserapp.forms import (ProfileForm, PasswordResetForm, PasswordChangeForm, NewEmailAddressForm,
     NewPhoneForm, VerifyPhoneForm)
@@ -13,9 +14,10 @@ from lastuserapp.forms import (ProfileForm, PasswordResetForm, PasswordChangeFor
 
 @app.route('/profile')
 @requires_login
+@read_only
 def profile():
     # TODO: move the avatar in the user model
-    return render_template('profile.html', avatar = session['avatar_url'])
+    return render_template('profile.html', avatar=g.avatar_url)
 
 
 @app.route('/profile/edit', methods=['GET', 'POST'])
@@ -31,6 +33,7 @@ def profile_edit():
         g.user.username = form.username.data or None
         g.user.description = form.description.data
         db.session.commit()
+        invalidate_user_snapshot(g.user)
 
         next_url = get_next_url()
         if(next_url is not None):
@@ -51,6 +54,7 @@ def change_password():
     if form.validate_on_submit():
         g.user.password = form.password.data
         db.session.commit()
+        invalidate_user_snapshot(g.user)
         flash("Your new password has been saved.", category='info')
         return render_redirect(url_for('profile'), code=303)
     return render_form(form=form, title="Change password", formid="changepassword", submit="Change password", ajax=True)
@@ -63,8 +67,9 @@ def add_email():
     if form.validate_on_submit():
         useremail = UserEmailClaim(user=g.user, email=form.email.data)
         db.session.add(useremail)
-        db.session.commit()
         send_email_verify_link(useremail)
+        db.session.commit()
+        invalidate_user_snapshot(g.user)
         flash("We sent you an email to confirm your address.", "info")
         return render_redirect(url_for('profile'), code=303)
     return render_form(form=form, title="Add an email address", formid="email_add", submit="Add email", ajax=True)
@@ -80,9 +85,11 @@ def remove_email(md5sum):
     if useremail.primary:
         flash("You cannot remove your primary email address", "error")
         return render_redirect(url_for('profile'), code=303)
-    return render_delete(useremail, title="Confirm removal", message="Remove email address %s?" % useremail,
+    response = render_delete(useremail, title="Confirm removal", message="Remove email address %s?" % useremail,
         success="You have removed your email address %s." % useremail,
         next=url_for('profile'))
+    invalidate_user_snapshot(g.user)
+    return response
 
 
 @app.route('/profile/phone/new', methods=['GET', 'POST'])
@@ -6,4 +6,16 @@ from lastuserapp.models import db
 
 if __name__=='__main__':
     db.create_all()
+    if app.config.get('MAIL_QUEUE'):
+        from lastuserapp.mailclient import MailQueueWorker
+        MailQueueWorker().start()
+    if app.config.get('SMS_QUEUE'):
+        from lastuserapp.smsclient import SMSDispatchWorker
+        SMSDispatchWorker().start()
+    if app.config.get('AUTH_CODE_SWEEP_INTERVAL'):
+        from lastuserapp.authcodes import authcodes, AuthCodeSweeper
+        AuthCodeSweeper(authcodes, interval=app.config['AUTH_CODE_SWEEP_INTERVAL']).start()
+    if app.config.get('TOKEN_SWEEP_INTERVAL'):
+        from lastuserapp.tokens import TokenSweeper
+        TokenSweeper(interval=app.config['TOKEN_SWEEP_INTERVAL']).start()
     app.run('0.0.0.0', port=7000, debug=True)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+"""
+Background worker threads for queues stored in the database
+"""
+
+from threading import Thread, Event
+
+from lastuserapp import app
+from lastuserapp.models import db
+
+__all__ = ['QueueWorker', 'backoff']
+
+
+def backoff(attempts, base=60, maximum=3600):
+    """
+    Return the delay in seconds before retrying after the given number of
+    failed attempts, doubling with each attempt up to maximum.
+    """
+    return min(base * 2 ** max(attempts - 1, 0), maximum)
+
+
+class QueueWorker(Thread):
+    """
+    A daemon thread that calls process() until stopped. process() should
+    handle one batch of work and return the number of items it handled.
+    The worker sleeps for interval seconds whenever there is no work.
+    Each batch gets a fresh database session.
+    """
+    def __init__(self, interval=5, name=None):
+        super(QueueWorker, self).__init__(name=name)
+        self.daemon = True
+        self.interval = interval
+        self._stopped = Event()
+
+    def process(self):
+        raise NotImplementedError
+
+    def run(self):
+        while not self._stopped.is_set():
+            count = 0
+            try:
+                count = self.process()
+            except Exception:
+                app.logger.exception("%s failed" % self.name)
+                db.session.rollback()
+            finally:
+                db.session.remove()
+            if not count:
+                self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""
+Signed LastUser access tokens, for resource servers to verify without
+calling LastUser. This package has no dependencies outside the standard
+library, so it can be installed alongside any resource server.
+
+A signed token is key_id.claims.signature, where claims is JSON with the
+userid (u), client key (c), scope (s), expiry (e, seconds since the epoch,
+UTC) and token id (i), and the signature is an HMAC-SHA256 of
+key_id.claims. All parts are base64 encoded for URLs without padding.
+
+Resource servers verify tokens with a KeyRegistry holding the keys shared
+with LastUser, and a RevocationList that polls LastUser for tokens revoked
+before they expired::
+
+    registry = KeyRegistry({'2012-01': 'secret'})
+    revoked = RevocationList('https://auth.example.com/api/1/token/revoked',
+        client_id, client_secret)
+    claims = registry.verify(token, revoked=revoked)
+"""
+
+import hashlib
+import hmac
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode, b64encode
+from threading import Lock
+from time import time
+from urllib import urlencode
+import urllib2
+
+__all__ = ['TokenError', 'KeyRegistry', 'RevocationList', 'token_id']
+
+
+class TokenError(ValueError):
+    pass
+
+
+def _encode(data):
+    return urlsafe_b64encode(data).rstrip('=')
+
+
+def _decode(data):
+    return urlsafe_b64decode(str(data) + '=' * (-len(data) % 4))
+
+
+def token_id(token):
+    """
+    Return the id of a signed token issued for an opaque access token. The id
+    identifies the token in revocation lists without revealing it.
+    """
+    return _encode(hashlib.sha256(token).digest()[:12])
+
+
+class KeyRegistry(object):
+    """
+    Signing keys by key id. New tokens are signed with the current key;
+    tokens signed with any key in the registry are accepted. To rotate keys,
+    add a new key, make it current and remove the old key once the tokens
+    it signed have expired.
+
+    :param keys: Dictionary of key id: secret
+    :param current: Key id to sign new tokens with
+    :param leeway: Seconds of clock difference to allow for when checking expiry
+    """
+    def __init__(self, keys, current=None, leeway=0):
+        self.keys = dict(keys)
+        self.current = current
+        self.leeway = leeway
+
+    def _signature(self, key_id, signed):
+        key = self.keys[key_id]
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return _encode(hmac.new(key, signed, hashlib.sha256).digest())
+
+    def sign(self, userid, client, scope, expires, tokenid):
+        """
+        Return a signed token with these claims.
+        """
+        if self.current is None:
+            raise TokenError("No current signing key")
+        claims = {'u': userid, 'c': client, 's': u' '.join(scope), 'e': int(expires), 'i': tokenid}
+        signed = '%s.%s' % (self.current, _encode(json.dumps(claims, separators=(',', ':'))))
+        return '%s.%s' % (signed, self._signature(self.current, signed))
+
+    def verify(self, token, revoked=None, now=None):
+        """
+        Return the claims in a signed token as a dictionary of userid, client,
+        scope (a list), expires and id. Raises TokenError if the token is
+        malformed, signed with an unknown key, tampered with, expired or in
+        the revocation list.
+        """
+        if isinstance(token, unicode):
+            token = token.encode('ascii', 'replace')
+        parts = token.split('.')
+        if len(parts) != 3:
+            raise TokenError("Malformed token")
+        key_id, encoded, signature = parts
+        if key_id not in self.keys:
+            raise TokenError("Unknown signing key")
+        if not hmac.compare_digest(self._signature(key_id, '%s.%s' % (key_id, encoded)), signature):
+            raise TokenError("Invalid signature")
+        try:
+            claims = json.loads(_decode(encoded))
+        except (TypeError, ValueError):
+            raise TokenError("Malformed token")
+        if now is None:
+            now = time()
+        if claims['e'] + self.leeway <= now:
+            raise TokenError("Token expired")
+        if revoked is not None and claims['i'] in revoked:
+            raise TokenError("Token revoked")
+        return {'userid': claims['u'],
+                'client': claims['c'],
+                'scope': claims['s'].split(u' ') if claims['s'] else [],
+                'expires': claims['e'],
+                'id': claims['i']}
+
+
+class RevocationList(object):
+    """
+    Ids of signed tokens revoked before they expired, polled from LastUser.
+    Each poll only fetches tokens revoked since the last poll. Supports the
+    'in' operator, polling first if the list is older than interval seconds.
+
+    :param url: URL of LastUser's /api/1/token/revoked endpoint
+    :param client_id: The resource server's client id
+    :param client_secret: The resource server's client secret
+    :param interval: Seconds between polls
+    :param timeout: Seconds to wait for LastUser
+    """
+    def __init__(self, url, client_id, client_secret, interval=30, timeout=5):
+        self.url = url
+        self.auth = 'Basic ' + b64encode('%s:%s' % (client_id, client_secret))
+        self.interval = interval
+        self.timeout = timeout
+        self.cursor = 0
+        self.revoked = {} # Token id: expiry
+        self.polled_at = None
+        self._lock = Lock()
+
+    def fetch(self, since):
+        request = urllib2.Request('%s?%s' % (self.url, urlencode({'since': since})),
+            headers={'Authorization': self.auth})
+        return json.loads(urllib2.urlopen(request, timeout=self.timeout).read())
+
+    def poll(self):
+        """
+        Fetch tokens revoked since the last poll and forget expired ones.
+        """
+        with self._lock:
+            more = True
+            while more:
+                data = self.fetch(self.cursor)
+                for tokenid, expires in data['revoked']:
+                    self.revoked[tokenid] = expires
+                self.cursor = data['cursor']
+                more = data.get('more', False)
+            now = time()
+            for tokenid, expires in self.revoked.items():
+                if expires <= now:
+                    del self.revoked[tokenid]
+            self.polled_at = now
+
+    def __contains__(self, tokenid):
+        if self.polled_at is None or self.polled_at + self.interval <= time():
+            try:
+                self.poll()
+            except Exception, e:
+                # Keep using the list we have. If we never got one, fail closed
+                if self.polled_at is None:
+                    raise TokenError("Revocation list unavailable: %s" % e)
+        return tokenid in self.revoked
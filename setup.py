@@ -9,7 +9,7 @@ CHANGES = open(os.path.join(here, 'CHANGES.rst')).read()
 requires = [
     'Flask',
     'Flask-SQLAlchemy',
-    'SQLAlchemy>=0.6',
+    'SQLAlchemy>=0.7',
     'Flask-WTF',
     'Flask-OpenID',
     'Flask-OAuth',
@@ -42,6 +42,6 @@ setup(name='lastuserapp',
       packages=find_packages(),
       include_package_data=True,
       zip_safe=False,
-      test_suite='lastuserapp',
+      test_suite='tests',
       install_requires=requires,
       )
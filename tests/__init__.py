@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for LastUser. Run with `python setup.py test`. The app is configured
+with tests/settings.py, and each test starts with empty tables.
+"""
+
+import os
+import unittest
+
+os.environ.setdefault('LASTUSER_SETTINGS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.py'))
+
+from lastuserapp import app
+from lastuserapp.models import db, User, Client, client_cache, token_cache
+
+#: Password of users made with make_user
+PASSWORD = u'secret'
+
+
+class TestCase(unittest.TestCase):
+    """
+    Creates the tables before each test and drops them after. Tests run in
+    a request context.
+    """
+    def setUp(self):
+        db.create_all()
+        self.ctx = app.test_request_context()
+        self.ctx.push()
+        self.http = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        client_cache.clear()
+        token_cache.clear()
+        self.ctx.pop()
+
+    def make_user(self, username=u'user', email=None):
+        user = User(username=username, fullname=username.title(), password=PASSWORD)
+        db.session.add(user)
+        if email:
+            user.add_email(email, primary=True)
+        db.session.commit()
+        return user
+
+    def make_client(self, user, **kwargs):
+        kwargs.setdefault('title', u'Test app')
+        kwargs.setdefault('website', u'http://app.example.com/')
+        kwargs.setdefault('redirect_uri', u'http://app.example.com/callback')
+        client = Client(user=user, owner=user.fullname, **kwargs)
+        db.session.add(client)
+        db.session.commit()
+        return client
+
+    def login(self, username=u'user', password=PASSWORD):
+        return self.http.post('/login', data={'form.id': 'login', 'username': username,
+            'password': password})
+
+    def assertLoggedIn(self, response):
+        # Logins redirect with 303; failed logins show the form again
+        self.assertEqual(response.status_code, 303)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+"""
+Settings for the tests: the sample settings, with a temporary database and
+nothing sent out.
+"""
+
+import os
+import tempfile
+
+execfile(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'lastuserapp', 'settings-sample.py'))
+
+TESTING = True
+CSRF_ENABLED = False
+SECRET_KEY = 'testing'
+
+# A file rather than an in-memory database, so background threads see it
+SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='lastuser'), 'test.db')
+
+LOGFILE = os.devnull
+ADMINS = []
+PASSWORD_HASH_ITERATIONS = 1000
+SMS_GATEWAY = 'local'
+AUTH_CODE_SWEEP_INTERVAL = 0
+TOKEN_SWEEP_INTERVAL = 0
+SLOW_REQUEST_THRESHOLD = None
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from StringIO import StringIO
+from urllib2 import URLError
+
+from flask import json
+
+from lastuserapp.avatar import AvatarResolver
+from lastuserapp.models import db, AvatarCache, UserExternalId
+from tests import TestCase
+
+GITHUB_AVATAR = u'https://avatars.example.com/octocat.png'
+
+
+class FakeResponse(StringIO):
+    def __init__(self, url, body=''):
+        StringIO.__init__(self, body)
+        self.url = url
+
+    def geturl(self):
+        return self.url
+
+
+class FakeHTTP(object):
+    """
+    Stands in for urlopen, serving canned responses by URL. Unknown URLs
+    fail as an unreachable server would.
+    """
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def __call__(self, url, timeout=None):
+        self.requests.append(url)
+        if url not in self.responses:
+            raise URLError('connection refused')
+        return self.responses[url]
+
+
+class AvatarResolverTest(TestCase):
+    def setUp(self):
+        super(AvatarResolverTest, self).setUp()
+        self.http_fake = FakeHTTP({
+            'https://api.github.com/users/octocat': FakeResponse('https://api.github.com/users/octocat',
+                json.dumps({'login': 'octocat', 'avatar_url': GITHUB_AVATAR})),
+            'http://api.twitter.com/1/users/profile_image/jack': FakeResponse(
+                'https://avatars.example.com/jack.png'),
+            })
+        self.resolver = AvatarResolver(workers=0, max_age=3600, retry_after=60)
+        self.resolver.urlopen = self.http_fake
+
+    def test_resolve(self):
+        # Resolved in this thread, as there are no workers
+        self.assertEqual(self.resolver.get('github', 'octocat'), None)
+        self.assertEqual(self.resolver.get('github', 'octocat'), GITHUB_AVATAR)
+        self.assertEqual(self.resolver.get('twitter', 'jack'), None)
+        self.assertEqual(self.resolver.get('twitter', 'jack'), u'https://avatars.example.com/jack.png')
+        self.assertEqual(len(self.http_fake.requests), 2)
+        row = AvatarCache.query.filter_by(service='github', userid='octocat').one()
+        self.assertEqual(row.url, GITHUB_AVATAR)
+
+    def test_saved_for_other_processes(self):
+        self.resolver.resolve('github', 'octocat')
+        other = AvatarResolver(workers=0)
+        other.urlopen = FakeHTTP({})
+        self.assertEqual(other.get('github', 'octocat'), GITHUB_AVATAR)
+        self.assertEqual(other.urlopen.requests, [])
+
+    def test_failure_is_retried_soon(self):
+        self.resolver.resolve('github', 'nobody')
+        url, fetched_at = self.resolver.memory.get(('github', 'nobody'))
+        self.assertEqual(url, None)
+        # Stale after retry_after, not max_age
+        self.assertEqual(self.resolver.get('github', 'nobody'), None)
+        self.assertEqual(len(self.http_fake.requests), 1)
+        self.resolver.memory.set(('github', 'nobody'),
+            (None, fetched_at - self.resolver.retry_after - timedelta(seconds=1)))
+        self.resolver.get('github', 'nobody')
+        self.assertEqual(len(self.http_fake.requests), 2)
+
+    def test_failure_keeps_last_url(self):
+        self.resolver.resolve('github', 'octocat')
+        self.resolver.urlopen = FakeHTTP({})
+        self.resolver.memory.clear()
+        self.assertEqual(self.resolver.resolve('github', 'octocat'), GITHUB_AVATAR)
+        db.session.expire_all()
+        self.assertEqual(AvatarCache.query.filter_by(service='github', userid='octocat').one().url,
+            GITHUB_AVATAR)
+
+    def test_request_session_untouched(self):
+        user = self.make_user()
+        extid = UserExternalId(user=user, service='github', userid='octocat', username=u'octocat')
+        db.session.add(extid)
+        self.resolver.get('github', 'octocat')
+        # Saving the avatar didn't commit the request's changes
+        self.assertTrue(extid in db.session.new)
+        db.session.rollback()
+        self.assertEqual(UserExternalId.query.count(), 0)
+        self.assertEqual(AvatarCache.query.count(), 1)
+
+    def test_workers(self):
+        resolver = AvatarResolver(workers=1)
+        resolver.urlopen = self.http_fake
+        resolver.get('github', 'octocat')
+        resolver.pool.close()
+        resolver.pool.join()
+        self.assertEqual(resolver.get('github', 'octocat'), GITHUB_AVATAR)
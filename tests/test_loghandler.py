@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import sys
+import unittest
+from Queue import Queue
+
+from lastuserapp.loghandler import LocalVarFormatter, DuplicateFilter, QueueHandler, REDACTED
+
+
+def make_record(message='Failed', args=(), exc_info=None):
+    return logging.LogRecord('lastuserapp', logging.ERROR, __file__, 1, message, args, exc_info)
+
+
+def fail():
+    client_secret = 'frame-secret'
+    params = {'client_id': 'key', 'client_secret': 'dict-secret'}
+    url = 'https://github.com/login/oauth/access_token?client_id=key&client_secret=query-secret'
+    raise ValueError("Failed")
+
+
+def failure():
+    try:
+        fail()
+    except ValueError:
+        return sys.exc_info()
+
+
+class FormatterTest(unittest.TestCase):
+    def test_secrets_redacted(self):
+        text = LocalVarFormatter().formatException(failure())
+        for secret in ['frame-secret', 'dict-secret', 'query-secret']:
+            self.assertFalse(secret in text)
+        self.assertTrue('client_id=key&client_secret=%s' % REDACTED in text)
+        self.assertTrue("'client_id': 'key'" in text)
+
+    def test_pairs_redacted(self):
+        text = LocalVarFormatter().format_value('form', [('password', 'hunter2'), ('username', 'user')])
+        self.assertEqual(text, "[('password', %s), ('username', 'user')]" % REDACTED)
+
+
+class DuplicateFilterTest(unittest.TestCase):
+    def test_count_kept_past_window(self):
+        dedup = DuplicateFilter(window=300)
+        exc_info = failure()
+        self.assertTrue(dedup.filter(make_record(exc_info=exc_info)))
+        self.assertFalse(dedup.filter(make_record(exc_info=exc_info)))
+        # The window passes. Another error cleans up, but the count stays
+        for entry in dedup.seen.values():
+            entry[0] -= 600
+        self.assertTrue(dedup.filter(make_record(exc_info=(KeyError, KeyError(), None))))
+        record = make_record(exc_info=exc_info)
+        self.assertTrue(dedup.filter(record))
+        self.assertTrue('1 identical errors' in record.msg)
+
+
+class QueueHandlerTest(unittest.TestCase):
+    def test_prepare_formats_record(self):
+        handler = QueueHandler(Queue())
+        handler.setFormatter(LocalVarFormatter())
+        record = make_record('Failed for %s', ('user',), failure())
+        prepared = handler.prepare(record)
+        self.assertTrue(prepared.msg.startswith('Failed for user\nTraceback'))
+        self.assertTrue('ValueError: Failed' in prepared.msg)
+        self.assertEqual((prepared.args, prepared.exc_info, prepared.exc_text), (None, None, None))
+        # The original record is left for other handlers
+        self.assertNotEqual(record.exc_info, None)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+from multiprocessing import TimeoutError
+
+from flask import json
+from werkzeug import generate_password_hash
+
+from lastuserapp import app
+from lastuserapp.models import db, User, UserIdentifier, getuser
+from lastuserapp.passwords import check_password, hasher
+from tests import TestCase, PASSWORD
+
+
+class LoginTest(TestCase):
+    def setUp(self):
+        super(LoginTest, self).setUp()
+        self.make_user()
+
+    def reload_user(self):
+        db.session.remove()
+        return User.query.filter_by(username=u'user').one()
+
+    def test_hash_from_database(self):
+        user = self.reload_user()
+        self.assertTrue(isinstance(user.pw_hash, unicode))
+        self.assertTrue(user.password_is(PASSWORD))
+        self.assertFalse(user.password_is(u'wrong'))
+
+    def test_login(self):
+        self.assertLoggedIn(self.login())
+
+    def test_wrong_password(self):
+        self.assertEqual(self.login(password=u'wrong').status_code, 200)
+
+    def test_legacy_hash_is_upgraded(self):
+        user = self.reload_user()
+        user.pw_hash = generate_password_hash(PASSWORD)
+        db.session.commit()
+        self.assertLoggedIn(self.login())
+        user = self.reload_user()
+        self.assertTrue(user.pw_hash.startswith(u'pbkdf2_sha256$'))
+        # The upgraded hash, read back from the database, still works. A new
+        # client, as logged in users are sent back without a password check
+        self.http = app.test_client()
+        self.assertLoggedIn(self.login())
+
+    def test_malformed_hash(self):
+        self.assertFalse(check_password(u'pbkdf2_sha256$1000$salt$\u2603', PASSWORD))
+        self.assertFalse(check_password(u'pbkdf2_sha256$many$salt$hash', PASSWORD))
+
+
+class UnindexedUserTest(TestCase):
+    """
+    Users of a database upgraded without `manage.py indexusers`.
+    """
+    def setUp(self):
+        super(UnindexedUserTest, self).setUp()
+        self.make_user(u'Kiran', email=u'Kiran@example.com')
+        UserIdentifier.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['USER_INDEX_FALLBACK'] = True
+        super(UnindexedUserTest, self).tearDown()
+
+    def test_getuser(self):
+        self.assertEqual(getuser(u'Kiran').username, u'Kiran')
+        self.assertEqual(getuser(u'Kiran@example.com').username, u'Kiran')
+        self.assertEqual(getuser(u'nobody'), None)
+
+    def test_login(self):
+        self.assertLoggedIn(self.login(u'Kiran'))
+
+    def test_fallback_disabled(self):
+        app.config['USER_INDEX_FALLBACK'] = False
+        self.assertEqual(getuser(u'Kiran'), None)
+
+
+class FakeResult(object):
+    def __init__(self, func, args, busy):
+        self.func, self.args, self.busy = func, args, busy
+
+    def get(self, timeout=None):
+        if self.busy:
+            raise TimeoutError()
+        return self.func(*self.args)
+
+
+class FakePool(object):
+    """
+    Stands in for a multiprocessing pool, running jobs inline, or timing out
+    as a backed up pool would.
+    """
+    def __init__(self, busy=False):
+        self.busy = busy
+        self.jobs = []
+
+    def apply_async(self, func, args):
+        self.jobs.append(func.__name__)
+        return FakeResult(func, args, self.busy)
+
+
+class PasswordPoolTest(TestCase):
+    def setUp(self):
+        super(PasswordPoolTest, self).setUp()
+        self.make_user()
+        self.pool = (hasher.processes, hasher._pool)
+        hasher.processes, hasher._pool = 1, FakePool()
+
+    def tearDown(self):
+        hasher.processes, hasher._pool = self.pool
+        super(PasswordPoolTest, self).tearDown()
+
+    def test_rehash_in_pool(self):
+        user = User.query.filter_by(username=u'user').one()
+        user.pw_hash = generate_password_hash(PASSWORD)
+        db.session.commit()
+        self.assertLoggedIn(self.login())
+        self.assertEqual(hasher._pool.jobs, ['_timed_check_password', '_timed_hash_password'])
+        db.session.expire_all()
+        self.assertTrue(User.query.filter_by(username=u'user').one().pw_hash.startswith(u'pbkdf2_sha256$'))
+
+    def test_busy_login(self):
+        hasher._pool.busy = True
+        timeouts = hasher.stats['timeouts']
+        self.assertEqual(self.login().status_code, 503)
+        self.assertEqual(hasher.stats['timeouts'], timeouts + 1)
+
+    def test_busy_password_grant(self):
+        client = self.make_client(User.query.filter_by(username=u'user').one(), trusted=True)
+        hasher._pool.busy = True
+        response = self.http.post('/token', data={'grant_type': 'password', 'client_id': client.key,
+            'client_secret': client.secret, 'username': u'user', 'password': PASSWORD, 'scope': u'id'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.data)['error'], 'temporarily_unavailable')
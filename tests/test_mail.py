@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import asyncore
+import smtpd
+from threading import Thread
+
+from flask import render_template
+from flaskext.mail import Message
+from markdown import markdown
+
+from lastuserapp import app
+from lastuserapp.mailclient import (mail, send_message, MailQueueWorker, mail_queue_stats,
+    email_verify_template, email_reset_template)
+from lastuserapp.models import db, OutboundMail, MAIL_STATUS
+from tests import TestCase
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """
+    A local SMTP server that keeps the messages it receives.
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.thread = Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def stop(self):
+        self.close()
+        self.thread.join(5)
+
+
+class MailQueueTest(TestCase):
+    def setUp(self):
+        super(MailQueueTest, self).setUp()
+        self.sink = SMTPSink()
+        self.settings = (app.config.get('MAIL_QUEUE'), mail.server, mail.port, mail.suppress)
+        app.config['MAIL_QUEUE'] = True
+        mail.server, mail.port, mail.suppress = '127.0.0.1', self.sink.port, False
+
+    def tearDown(self):
+        app.config['MAIL_QUEUE'], mail.server, mail.port, mail.suppress = self.settings
+        self.sink.stop()
+        super(MailQueueTest, self).tearDown()
+
+    def run_worker(self):
+        # In a thread of its own, as the worker runs outside any request
+        results = []
+        thread = Thread(target=lambda: results.append(MailQueueWorker().process()))
+        thread.start()
+        thread.join(30)
+        return results[0]
+
+    def test_queued_mail_is_delivered(self):
+        send_message(Message(subject=u"Hello", recipients=[u'user@example.com'], body=u"Hello there"))
+        db.session.commit()
+        self.assertEqual(self.sink.messages, [])
+        self.assertEqual(self.run_worker(), 1)
+        self.assertEqual(len(self.sink.messages), 1)
+        mailfrom, rcpttos, data = self.sink.messages[0]
+        self.assertEqual(mailfrom, app.config['DEFAULT_MAIL_SENDER'][1])
+        self.assertEqual(rcpttos, ['user@example.com'])
+        self.assertTrue('Hello there' in data)
+        db.session.expire_all()
+        message = OutboundMail.query.one()
+        self.assertEqual(message.status, MAIL_STATUS.SENT)
+        self.assertEqual(message.fail_reason, None)
+
+    def test_batch(self):
+        for index in range(3):
+            send_message(Message(subject=u"Message %d" % index, recipients=[u'user%d@example.com' % index],
+                body=u"Hello"))
+        db.session.commit()
+        sent = MailQueueWorker.stats['sent']
+        self.assertEqual(self.run_worker(), 3)
+        self.assertEqual(len(self.sink.messages), 3)
+        self.assertEqual(self.run_worker(), 0)
+        self.assertEqual(mail_queue_stats()['sent'], sent + 3)
+
+
+class MailTemplateTest(TestCase):
+    """
+    Compiled templates render exactly what a full Jinja and markdown render
+    would.
+    """
+    names = [u'Kiran', u'Kiran Jonnalagadda', u"O'Brien", u'José Müller', u'Dr. No',
+        u'<script>alert(1)</script>', u'Tom & Jerry', u'*Kiran*', u'_under_', u'[link](http://x)',
+        u'# Heading', u'Back\\slash', u'`code`', u'']
+    urls = [u'https://lastuser.example.com/confirm/abc/def', u'http://example.com/?a=1&b=<2>',
+        u'http://example.com/*star*_x_', u'javascript:alert("x")']
+
+    def assertSameRender(self, template, **values):
+        body = render_template(template.template, **values)
+        self.assertEqual(template.render(**values), (body, markdown(body)))
+
+    def test_verify(self):
+        self.assertTrue(email_verify_template.compile())
+        for name in self.names:
+            for url in self.urls:
+                self.assertSameRender(email_verify_template, fullname=name, confirm_url=url)
+
+    def test_reset(self):
+        self.assertTrue(email_reset_template.compile())
+        for name in self.names:
+            for url in self.urls:
+                self.assertSameRender(email_reset_template, fullname=name, reset_url=url)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp import benchmark
+from lastuserapp.models import User
+from lastuserapp.queryplans import check_plans
+from tests import TestCase
+
+
+class QueryPlanTest(TestCase):
+    def setUp(self):
+        super(QueryPlanTest, self).setUp()
+        benchmark.seed(users=20, clients=2)
+
+    def test_plan_queries(self):
+        # Every query can be explained; no table is near this size
+        self.assertEqual(check_plans(threshold=10 ** 6), [])
+
+    def test_full_scan_reported(self):
+        queries = [
+            ('by userid', lambda: User.query.filter_by(userid='x' * 22)),
+            ('by fullname', lambda: User.query.filter_by(fullname=u'Nobody')),
+            ]
+        self.assertEqual(check_plans(threshold=10, queries=queries), [('by fullname', [('user', 20)])])
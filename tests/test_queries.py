@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+Query budgets for loading the current user and for logging in.
+"""
+
+from flask import g, session
+
+from lastuserapp import app
+from lastuserapp.forms import LoginForm
+from lastuserapp.models import db, UserPhone, UserExternalId, assert_max_queries
+from lastuserapp.views import lookup_current_user
+from tests import TestCase, PASSWORD
+
+
+class CurrentUserQueryTest(TestCase):
+    def setUp(self):
+        super(CurrentUserQueryTest, self).setUp()
+        user = self.make_user(email=u'user@example.com')
+        db.session.add(UserPhone(user=user, phone=u'+919999999999'))
+        db.session.add(UserExternalId(user=user, service='github', userid='user', username=u'user'))
+        db.session.commit()
+        self.userid = user.userid
+        self.strategy = app.config.get('USER_EAGER_LOAD')
+
+    def tearDown(self):
+        app.config['USER_EAGER_LOAD'] = self.strategy
+        super(CurrentUserQueryTest, self).tearDown()
+
+    def load_current_user(self, limit):
+        # Start with nothing in the session's identity map
+        db.session.remove()
+        with app.test_request_context('/'):
+            session['userid'] = self.userid
+            with assert_max_queries(limit):
+                lookup_current_user()
+                for attempt in range(2):
+                    self.assertEqual(unicode(g.user.email), u'user@example.com')
+                    self.assertEqual(len(g.user.phones), 1)
+                    self.assertEqual(len(g.user.externalids), 1)
+
+    def test_joined(self):
+        app.config['USER_EAGER_LOAD'] = 'joined'
+        self.load_current_user(1)
+
+    def test_subquery(self):
+        # The user, then one query for each relation
+        app.config['USER_EAGER_LOAD'] = 'subquery'
+        self.load_current_user(4)
+
+    def test_lazy(self):
+        # Each relation is loaded once, however often it is used
+        app.config['USER_EAGER_LOAD'] = None
+        self.load_current_user(4)
+
+
+class LoginQueryTest(TestCase):
+    def setUp(self):
+        super(LoginQueryTest, self).setUp()
+        self.make_user(email=u'user@example.com')
+        db.session.remove()
+
+    def validate(self, username, password=PASSWORD, limit=1):
+        with app.test_request_context('/login', method='POST',
+                data={'username': username, 'password': password}):
+            # Both fields look the user up; they share one query
+            with assert_max_queries(limit):
+                return LoginForm().validate()
+
+    def test_username(self):
+        self.assertTrue(self.validate(u'user'))
+
+    def test_email(self):
+        self.assertTrue(self.validate(u'User@Example.com'))
+
+    def test_wrong_password(self):
+        self.assertFalse(self.validate(u'user', u'wrong'))
+
+    def test_unknown_user(self):
+        # Misses are remembered too. Looking for names missing from the
+        # index the old way costs another query
+        self.assertFalse(self.validate(u'nobody', limit=2))
+        app.config['USER_INDEX_FALLBACK'] = False
+        try:
+            self.assertFalse(self.validate(u'nobody'))
+        finally:
+            app.config['USER_INDEX_FALLBACK'] = True
+
+    def test_login_request(self):
+        with assert_max_queries(1):
+            response = self.login()
+        self.assertEqual(response.status_code, 303)
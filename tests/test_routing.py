@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+from sqlalchemy import create_engine
+
+from lastuserapp import app
+from lastuserapp.models import db, Client, AuthToken, getclient, gettoken, use_replica
+from tests import TestCase
+
+
+class ReplicaTest(TestCase):
+    """
+    A primary and two replicas in SQLite files. The replicas have the tables
+    but none of the rows, as replicas that are behind would.
+    """
+    def setUp(self):
+        super(ReplicaTest, self).setUp()
+        self.replica_dir = tempfile.mkdtemp(prefix='lastuser')
+        uris = ['sqlite:///' + os.path.join(self.replica_dir, 'replica%d.db' % index) for index in range(2)]
+        for uri in uris:
+            db.Model.metadata.create_all(bind=create_engine(uri))
+        self.replica_uris = app.config.get('SQLALCHEMY_REPLICA_URIS')
+        app.config['SQLALCHEMY_REPLICA_URIS'] = uris
+        db._replicas = None
+        user = self.make_user()
+        client = self.make_client(user)
+        authtoken = AuthToken(user=user, client=client, scope=[u'id'])
+        db.session.add(authtoken)
+        db.session.commit()
+        self.key, self.token = client.key, authtoken.token
+        # Start reading afresh, from the replica
+        db.session.remove()
+        use_replica()
+
+    def tearDown(self):
+        app.config['SQLALCHEMY_REPLICA_URIS'] = self.replica_uris
+        db._replicas = None
+        super(ReplicaTest, self).tearDown()
+        shutil.rmtree(self.replica_dir)
+
+    def test_reads_from_replica(self):
+        self.assertTrue(db.session.reading_from_replica())
+        self.assertEqual(Client.query.filter_by(key=self.key).first(), None)
+        with db.session.using_primary():
+            self.assertFalse(db.session.reading_from_replica())
+            self.assertNotEqual(Client.query.filter_by(key=self.key).first(), None)
+
+    def test_getclient_falls_back_to_primary(self):
+        self.assertEqual(getclient(self.key).key, self.key)
+
+    def test_gettoken_falls_back_to_primary(self):
+        self.assertEqual(gettoken(self.token)['client'], self.key)
+
+    def test_one_replica_per_request(self):
+        replica = db.get_replica()
+        self.assertTrue(replica in db._replicas)
+        for attempt in range(20):
+            self.assertTrue(db.get_replica() is replica)
+            self.assertTrue(db.session().get_bind() is replica)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+from flask import json
+
+from lastuserapp import app, smsclient
+from lastuserapp.models import db, SMSMessage, SMS_STATUS
+from lastuserapp.smsclient import (LocalGateway, SMSGupShupGateway, SMSGatewayError, SMSDispatchWorker,
+    DeliveryReportBuffer, DeliveryReportFlushWorker, send_message, deliver, parse_delivery_report,
+    apply_delivery_reports)
+from tests import TestCase
+
+PHONE = '+919999999999'
+
+
+class FailingGateway(LocalGateway):
+    """
+    A local gateway that fails to send, with the given error.
+    """
+    def __init__(self, error):
+        LocalGateway.__init__(self)
+        self.error = error
+
+    def send(self, messages):
+        return [(None, self.error) for msg in messages]
+
+
+class SMSTestCase(TestCase):
+    def setUp(self):
+        super(SMSTestCase, self).setUp()
+        self.gateway = smsclient.gateway
+        self.queue = app.config.get('SMS_QUEUE')
+        smsclient.gateway = LocalGateway()
+
+    def tearDown(self):
+        smsclient.gateway = self.gateway
+        app.config['SMS_QUEUE'] = self.queue
+        super(SMSTestCase, self).tearDown()
+
+    def make_message(self, text=u'Your code is 1234', phone=PHONE):
+        msg = SMSMessage(phone_number=phone, message=text)
+        send_message(msg)
+        db.session.add(msg)
+        db.session.commit()
+        return msg
+
+
+class SendTest(SMSTestCase):
+    def test_queued(self):
+        app.config['SMS_QUEUE'] = True
+        msg = self.make_message()
+        self.assertEqual(msg.status, SMS_STATUS.QUEUED)
+        self.assertEqual(smsclient.gateway.outbox, [])
+        self.assertEqual(SMSDispatchWorker().process(), 1)
+        self.assertEqual(smsclient.gateway.outbox, [(PHONE, u'Your code is 1234')])
+        msg = SMSMessage.query.get(msg.id)
+        self.assertEqual(msg.status, SMS_STATUS.PENDING)
+        self.assertNotEqual(msg.transaction_id, None)
+
+    def test_sent_at_once(self):
+        app.config['SMS_QUEUE'] = False
+        msg = self.make_message()
+        self.assertEqual(msg.status, SMS_STATUS.PENDING)
+        self.assertEqual(msg.attempts, 1)
+        self.assertEqual(smsclient.gateway.outbox, [(PHONE, u'Your code is 1234')])
+
+
+class ClaimTest(SMSTestCase):
+    def setUp(self):
+        super(ClaimTest, self).setUp()
+        app.config['SMS_QUEUE'] = True
+        self.ids = [self.make_message().id for i in range(3)]
+
+    def test_claimed_once(self):
+        first, second = SMSDispatchWorker(lease=120), SMSDispatchWorker(lease=120)
+        self.assertEqual(sorted(msg.id for msg in first.claim()), self.ids)
+        self.assertEqual(second.claim(), [])
+
+    def test_batchsize(self):
+        first, second = SMSDispatchWorker(batchsize=2), SMSDispatchWorker(batchsize=2)
+        claimed = [msg.id for msg in first.claim()] + [msg.id for msg in second.claim()]
+        self.assertEqual(sorted(claimed), self.ids)
+
+    def test_lease_expires(self):
+        # A worker that claimed the messages and died before sending them
+        SMSDispatchWorker(lease=120).claim()
+        table = SMSMessage.__table__
+        db.session.execute(table.update().values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1)))
+        db.session.commit()
+        self.assertEqual(len(SMSDispatchWorker().claim()), 3)
+
+
+class DeliverTest(SMSTestCase):
+    def setUp(self):
+        super(DeliverTest, self).setUp()
+        app.config['SMS_QUEUE'] = True
+        self.msg = self.make_message()
+
+    def test_retry_backoff(self):
+        smsclient.gateway = FailingGateway(u'Gateway busy')
+        for attempt in [1, 2]:
+            before = datetime.utcnow()
+            deliver([self.msg], max_attempts=3)
+            self.assertEqual(self.msg.status, SMS_STATUS.QUEUED)
+            self.assertEqual(self.msg.attempts, attempt)
+            # 30 seconds, doubling with each attempt
+            delay = self.msg.next_attempt_at - before
+            self.assertTrue(timedelta(seconds=30 * 2 ** (attempt - 1)) <= delay <
+                timedelta(seconds=30 * 2 ** (attempt - 1) + 5))
+        deliver([self.msg], max_attempts=3)
+        self.assertEqual(self.msg.status, SMS_STATUS.FAILED)
+        self.assertEqual(self.msg.attempts, 3)
+        self.assertNotEqual(self.msg.status_at, None)
+
+    def test_fail_reason(self):
+        smsclient.gateway = FailingGateway(u'Number is on the do not disturb list')
+        deliver([self.msg])
+        db.session.commit()
+        # Cut to fit the column
+        self.assertEqual(SMSMessage.query.get(self.msg.id).fail_reason, u'Number is on the do not d')
+        smsclient.gateway = LocalGateway()
+        deliver([self.msg])
+        self.assertEqual(self.msg.fail_reason, None)
+        self.assertEqual(self.msg.status, SMS_STATUS.PENDING)
+
+
+class SMSGupShupTest(SMSTestCase):
+    def test_failed_request_fails_only_its_messages(self):
+        gateway = SMSGupShupGateway(userid='user', password='password', mask='MASK')
+        def request(params):
+            if params['msg'] == u'Second':
+                raise SMSGatewayError(u'Connection reset')
+            return '\n'.join('success | %s | tid%s' % (number, number[-1]) for number in params['send_to'].split(','))
+        gateway.request = request
+        messages = [SMSMessage(phone_number='+919999999991', message=u'First'),
+            SMSMessage(phone_number='+919999999992', message=u'Second'),
+            SMSMessage(phone_number='+919999999993', message=u'First')]
+        self.assertEqual(gateway.send(messages), [('tid1', None), (None, u'Connection reset'), ('tid3', None)])
+
+
+class DeliveryReportTest(SMSTestCase):
+    def setUp(self):
+        super(DeliveryReportTest, self).setUp()
+        for index in [1, 2]:
+            db.session.add(SMSMessage(phone_number='+91999999999%d' % index, message=u'Hello',
+                transaction_id=u'tid%d' % index, status=SMS_STATUS.PENDING))
+        db.session.commit()
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.stop()
+            worker.join()
+        super(DeliveryReportTest, self).tearDown()
+
+    def message(self, transaction_id):
+        db.session.expire_all()
+        return SMSMessage.query.filter_by(transaction_id=transaction_id).one()
+
+    def report(self, transaction_id, phone, status='SUCCESS', delivered=1325419200000, cause=None):
+        params = {'externalId': transaction_id, 'phoneNo': phone, 'status': status}
+        if delivered is not None:
+            params['deliveredTS'] = str(delivered)
+        if cause is not None:
+            params['cause'] = cause
+        return parse_delivery_report(params)
+
+    def test_apply(self):
+        self.assertEqual(apply_delivery_reports([self.report(u'tid1', '919999999991'),
+            self.report(u'tid2', '919999999992', 'FAIL', cause=u'Absent subscriber')]), 2)
+        db.session.commit()
+        self.assertEqual(self.message(u'tid1').status, SMS_STATUS.DELIVERED)
+        self.assertNotEqual(self.message(u'tid1').status_at, None)
+        self.assertEqual(self.message(u'tid2').status, SMS_STATUS.FAILED)
+        self.assertEqual(self.message(u'tid2').fail_reason, u'Absent subscriber')
+
+    def test_phone_mismatch(self):
+        self.assertEqual(apply_delivery_reports([self.report(u'tid1', '919999999992')]), 0)
+        db.session.commit()
+        self.assertEqual(self.message(u'tid1').status, SMS_STATUS.PENDING)
+
+    def test_latest_wins(self):
+        apply_delivery_reports([self.report(u'tid1', '919999999991', 'FAIL', cause=u'Busy'),
+            self.report(u'tid1', '919999999991')])
+        db.session.commit()
+        self.assertEqual(self.message(u'tid1').status, SMS_STATUS.DELIVERED)
+        self.assertEqual(self.message(u'tid1').fail_reason, None)
+
+    def test_no_delivery_time(self):
+        self.assertEqual(apply_delivery_reports([self.report(u'tid1', '919999999991', delivered=None)]), 1)
+        db.session.commit()
+        self.assertEqual(self.message(u'tid1').status, SMS_STATUS.DELIVERED)
+        self.assertEqual(self.message(u'tid1').status_at, None)
+
+    def test_unknown_status(self):
+        apply_delivery_reports([self.report(u'tid1', '919999999991', 'UNDELIVERABLE_SOMEHOW')])
+        db.session.commit()
+        self.assertEqual(self.message(u'tid1').status, SMS_STATUS.UNKNOWN)
+
+    def test_buffer_flushes_on_maxsize(self):
+        buffer = DeliveryReportBuffer(maxsize=2, interval=60)
+        buffer.add([self.report(u'tid1', '919999999991'), self.report(u'tid2', '919999999992')])
+        self.assertEqual(buffer._worker, None)
+        self.assertEqual(self.message(u'tid1').status, SMS_STATUS.DELIVERED)
+        self.assertEqual(self.message(u'tid2').status, SMS_STATUS.DELIVERED)
+
+    def test_buffer_flushes_on_interval(self):
+        buffer = DeliveryReportBuffer(maxsize=100, interval=60)
+        buffer.add([self.report(u'tid1', '919999999991')])
+        # Waiting, with a flush worker started
+        self.workers.append(buffer._worker)
+        buffer._worker.stop()
+        buffer._worker.join()
+        self.assertEqual(self.message(u'tid1').status, SMS_STATUS.PENDING)
+        self.assertFalse(buffer.due())
+        buffer._since -= 60
+        self.assertTrue(buffer.due())
+        DeliveryReportFlushWorker(buffer).process()
+        self.assertEqual(self.message(u'tid1').status, SMS_STATUS.DELIVERED)
+        # A report arriving after the interval flushes at once
+        buffer.add([self.report(u'tid2', '919999999992')])
+        buffer._since -= 60
+        buffer.add([])
+        self.assertEqual(self.message(u'tid2').status, SMS_STATUS.DELIVERED)
+
+    def test_bulk_endpoint(self):
+        response = self.http.post('/report/smsgupshup/bulk', data=json.dumps([
+            {'externalId': 'tid1', 'phoneNo': '919999999991', 'status': 'SUCCESS', 'deliveredTS': '1325419200000'},
+            {'externalId': 'tid2', 'phoneNo': '919999999991', 'status': 'SUCCESS'},
+            ]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, '1 of 2 statuses updated')
+
+    def test_bulk_endpoint_bad_json(self):
+        for data in ['not json', '{"externalId": "tid1"}', '[1, 2]']:
+            response = self.http.post('/report/smsgupshup/bulk', data=data)
+            self.assertEqual(response.status_code, 400)
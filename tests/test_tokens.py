@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+from base64 import b64encode
+from datetime import datetime, timedelta
+
+from flask import json
+
+from lastuserapp import app
+from lastuserapp.authcodes import SQLAuthCodeStore
+from lastuserapp.models import db, User, Client, AuthCode, AuthToken, RevokedToken, gettoken, token_cache
+from lastuserapp.tokens import issue_token, get_refreshable_token, refresh_token
+from lastuserapp.utils import newid
+from tests import TestCase
+
+
+class TokenRevocationTest(TestCase):
+    def setUp(self):
+        super(TokenRevocationTest, self).setUp()
+        user = self.make_user()
+        client = self.make_client(user, trusted=True)
+        self.credentials = 'Basic ' + b64encode('%s:%s' % (client.key, client.secret))
+        authtoken = AuthToken(user=user, client=client, scope=[u'id'])
+        db.session.add(authtoken)
+        db.session.commit()
+        self.token = authtoken.token
+
+    def verify(self, token):
+        response = self.http.post('/api/1/token/verify', data={'access_token': token},
+            headers={'Authorization': self.credentials})
+        return response.status_code, json.loads(response.data)
+
+    def test_revoked_token_stops_verifying(self):
+        status, data = self.verify(self.token)
+        self.assertEqual(status, 200)
+        self.assertEqual(data['scope'], [u'id'])
+        self.assertNotEqual(token_cache.get(self.token), None)
+        db.session.delete(AuthToken.query.filter_by(token=self.token).one())
+        db.session.commit()
+        status, data = self.verify(self.token)
+        self.assertEqual(status, 400)
+        self.assertEqual(data['error'], 'invalid_token')
+
+    def test_evicted_after_commit(self):
+        info = gettoken(self.token)
+        db.session.delete(AuthToken.query.filter_by(token=self.token).one())
+        db.session.flush()
+        # Another request reads the row before the commit and caches it again
+        token_cache.set(self.token, info)
+        db.session.commit()
+        self.assertEqual(token_cache.get(self.token), None)
+        self.assertEqual(gettoken(self.token), None)
+
+    def test_rollback_keeps_token(self):
+        gettoken(self.token)
+        db.session.delete(AuthToken.query.filter_by(token=self.token).one())
+        db.session.flush()
+        db.session.rollback()
+        self.assertNotEqual(gettoken(self.token), None)
+
+    def test_local_copies_are_short_lived(self):
+        # Without a shared cache, a revocation in another process only
+        # shows once the local copy expires
+        self.assertEqual(token_cache.local.ttl, app.config['TOKEN_CACHE_LOCAL_TTL'])
+
+
+class RefreshTokenTest(TestCase):
+    def setUp(self):
+        super(RefreshTokenTest, self).setUp()
+        user = self.make_user()
+        client = self.make_client(user, trusted=True)
+        self.key, self.secret = client.key, client.secret
+        authtoken = issue_token(user, client, [u'id'])
+        db.session.commit()
+        self.token_id = authtoken.id
+        self.refresh = authtoken.refresh_token
+
+    def refresh_grant(self, refresh):
+        response = self.http.post('/token', data={'grant_type': 'refresh_token', 'client_id': self.key,
+            'client_secret': self.secret, 'refresh_token': refresh})
+        return response.status_code, json.loads(response.data)
+
+    def test_refresh(self):
+        status, data = self.refresh_grant(self.refresh)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(data['refresh_token'], self.refresh)
+        # The old refresh token is used up
+        status, data = self.refresh_grant(self.refresh)
+        self.assertEqual(status, 400)
+        self.assertEqual(data['error'], 'invalid_grant')
+
+    def test_concurrent_refresh(self):
+        client = Client.query.filter_by(key=self.key).one()
+        token = get_refreshable_token(self.refresh, client)
+        # Another request refreshes with the same refresh token, and commits first
+        table = AuthToken.__table__
+        db.engine.execute(table.update().where(table.c.id == self.token_id).values(refresh_token=newid()))
+        self.assertEqual(refresh_token(token), None)
+        db.session.commit()
+        self.assertNotEqual(AuthToken.query.get(self.token_id).refresh_token, self.refresh)
+
+
+class RevokedTokensTest(TestCase):
+    def setUp(self):
+        super(RevokedTokensTest, self).setUp()
+        client = self.make_client(self.make_user())
+        self.credentials = 'Basic ' + b64encode('%s:%s' % (client.key, client.secret))
+        self.settings = app.config.get('REVOKED_TOKEN_PAGE_SIZE'), app.config.get('REVOKED_TOKEN_OVERLAP')
+        app.config['REVOKED_TOKEN_PAGE_SIZE'], app.config['REVOKED_TOKEN_OVERLAP'] = 3, 2
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['REVOKED_TOKEN_PAGE_SIZE'], app.config['REVOKED_TOKEN_OVERLAP'] = self.settings
+        super(RevokedTokensTest, self).tearDown()
+
+    def revoke(self, *ids):
+        for id in ids:
+            db.session.add(RevokedToken(id=id, tokenid=u'token%d' % id,
+                expires_at=datetime.utcnow() + timedelta(minutes=5)))
+        db.session.commit()
+
+    def poll(self, since):
+        response = self.http.get('/api/1/token/revoked?since=%d' % since,
+            headers={'Authorization': self.credentials})
+        data = json.loads(response.data)
+        return [tokenid for tokenid, expires in data['revoked']], data['cursor'], data['more']
+
+    def test_paging(self):
+        self.revoke(1, 2, 3, 4, 5)
+        self.assertEqual(self.poll(0), ([u'token1', u'token2', u'token3'], 3, True))
+        self.assertEqual(self.poll(3), ([u'token2', u'token3', u'token4'], 4, True))
+        self.assertEqual(self.poll(4), ([u'token3', u'token4', u'token5'], 5, False))
+        self.assertEqual(self.poll(5), ([u'token4', u'token5'], 5, False))
+
+    def test_late_commit(self):
+        # Token 6 got its id first, but its transaction committed last
+        self.revoke(5, 7)
+        tokens, cursor, more = self.poll(0)
+        self.assertEqual(cursor, 7)
+        self.revoke(6)
+        tokens, cursor, more = self.poll(cursor)
+        self.assertTrue(u'token6' in tokens)
+        self.assertEqual(cursor, 7)
+
+
+class SQLAuthCodeTest(TestCase):
+    def setUp(self):
+        super(SQLAuthCodeTest, self).setUp()
+        self.store = SQLAuthCodeStore(ttl=60)
+        user = self.make_user()
+        self.client = self.make_client(user)
+        self.code = self.store.create(user, self.client, [u'id'], u'http://app.example.com/callback')
+        db.session.commit()
+
+    def test_consumed_once(self):
+        authcode = self.store.consume(self.code, self.client)
+        self.assertEqual(authcode['scope'], [u'id'])
+        self.assertEqual(self.store.consume(self.code, self.client), None)
+
+    def test_request_session_untouched(self):
+        user = User.query.filter_by(username=u'user').one()
+        user.fullname = u'Changed'
+        self.assertNotEqual(self.store.consume(self.code, self.client), None)
+        # The request's change wasn't committed, and loaded instances weren't expired
+        self.assertTrue('fullname' in user.__dict__)
+        db.session.rollback()
+        self.assertEqual(User.query.filter_by(username=u'user').one().fullname, u'User')
+        # The code stays used
+        self.assertEqual(AuthCode.query.filter_by(code=self.code).one().used, True)